@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+
+"""Offline benchmark of the ruteplan pipeline, against local stand-in servers
+
+test_ruteplan.py calls the live service, so it can't tell whether a change makes things
+faster or slower. This module starts a local stand-in HTTP server (StandInServer) that
+replays ruteplanrespons.json style payloads and answers synthetic
+/vegnett/veglenkesekvenser/<id> and /vegobjekter/<type> requests, with configurable
+latency, payload size and error rate. The pipeline is then run stage by stage for a
+number of problem sizes (number of routes):
+
+    request      calls to ruteplan with RuteplanClient (concurrent, pooled, with retries)
+    parse        ruteplan.parseruteplan
+    shapely      ruteplan.features2dict, i.e. shapely geometries per feature
+    rutekolonner rutekolonner.RouteBatch.from_data and bulk shapely geometries
+    nvdbnett     prefetch of link sequences into nvdbnettverk.VeglenkesekvensLager
+    kb2vt        KB => VT mapping of all nvdbReferenceLinks with kb2vt
+    vegobjekter  speed limits along the mapped links with nvdbsporring.hentvegobjekter
+    export       RouteBatch.to_arrow written to parquet
+
+For each stage and size we record wall time, throughput (items per second), p50/p99
+latency per item (for the stages that work item by item), the number of failed http
+requests (after retries), peak memory as traced by tracemalloc and the net number of
+memory blocks allocated. The memory figures come from a
+separate run of the stage, so tracing doesn't distort the timings.
+
+Results are written as json, and two result files can be compared to spot regressions:
+
+    python benchmark.py --sizes 1,10,100,1000 --latency 0.005 --output benchmark.json
+    python benchmark.py --sizes 1,10,100,1000 --compare benchmark.json --output ny.json
+
+or from python:
+
+    import benchmark
+    resultat = benchmark.kjor( sizes=[1, 10, 100] )
+    benchmark.lagre( resultat, 'benchmark.json' )
+
+Nothing is sent over the internet.
+"""
+
+import argparse
+import datetime
+import gc
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import ruteplan
+import nvdbnettverk
+import kb2vt
+import nvdbsporring
+from rutekolonner import RouteBatch
+
+
+STAGES = ( 'request', 'parse', 'shapely', 'rutekolonner', 'nvdbnett', 'kb2vt', 'vegobjekter', 'export' )
+
+# Syntetiske veglenkesekvenser på kjørebanenivå stedfestes på VT-lenkesekvensen id + SUPER
+SUPER = 10**9
+_RESPONSFIL = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'ruteplanrespons.json' )
+
+
+def syntetisk_veglenkesekvens( veglenkesekvensid, antall=4 ):
+    """Synthetic /vegnett/veglenkesekvenser/<id> response: KB road links with superstedfesting"""
+    vid = int( veglenkesekvensid )
+    x0, y0 = 200000.0 + ( vid % 1000 ) * 100, 6600000.0 + ( vid // 1000 % 1000 ) * 100
+    veglenker = []
+    for ii in range( antall ):
+        fra, til = ii / antall, ( ii + 1 ) / antall
+        veglenker.append( { 'veglenkenummer' : ii + 1, 'startposisjon' : fra, 'sluttposisjon' : til,
+                            'startdato' : '2020-01-01', 'type' : 'HOVED', 'detaljnivå' : 'Kjørebane',
+                            'typeVeg' : 'Enkel bilveg', 'startnode' : f"{vid}-{ii}", 'sluttnode' : f"{vid}-{ii+1}",
+                            'feltoversikt' : [ '1' ],
+                            'geometri' : { 'wkt' : f"LINESTRING Z ({x0 + 25*ii} {y0} 0, {x0 + 25*ii + 25} {y0} 0)" },
+                            'superstedfesting' : { 'veglenkesekvensid' : vid + SUPER, 'startposisjon' : round( fra * 0.8, 8 ),
+                                                   'sluttposisjon' : round( til * 0.8, 8 ), 'retning' : 'MED',
+                                                   'kjørefelt' : [ '1' ] } } )
+    return { 'veglenkesekvensid' : vid, 'veglenker' : veglenker }
+
+
+def syntetiske_vegobjekter( objekttype, veglenkesekvens ):
+    """Synthetic road objects for a 'veglenkesekvens' filter value: One object per quarter of each link sequence touched"""
+    records = []
+    for fra, til, vid in ( nvdbsporring._intervall( p ) for p in veglenkesekvens.split( ',' ) if p ):
+        for kvart in range( int( fra * 4 ), min( int( np.ceil( til * 4 ) ), 4 ) or 1 ):
+            records.append( { 'objekttype' : int( objekttype ), 'nvdbId' : vid * 4 + kvart, 'versjon' : 1,
+                              'veglenkesekvensid' : vid, 'startposisjon' : kvart / 4, 'sluttposisjon' : ( kvart + 1 ) / 4,
+                              'Fartsgrense' : 50 + 10 * ( vid % 4 ) } )
+    return records
+
+
+class _Handler( http.server.BaseHTTPRequestHandler ):
+    """Request handler of StandInServer"""
+    protocol_version = 'HTTP/1.1'       # keep-alive, så pooled sessions faktisk blir testet
+    disable_nagle_algorithm = True      # Ellers gir Nagle + delayed ACK ca 40 ms ekstra per kall
+
+    def do_GET( self ):
+        status, body = self.server.standin.svar( self.path )
+        self.send_response( status )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def log_message( self, *args ):
+        pass
+
+
+class StandInServer:
+    """Local stand-in for the ruteplan service and NVDB api, running in a background thread
+
+    KEYWORDS
+        ruteplanrespons = path to ruteplanrespons.json, the ruteplan payload that is replayed
+
+        latency = 0.0, seconds to wait before answering each request
+
+        error_rate = 0.0, fraction of requests answered with HTTP 503
+
+        payload_scale = 1, the features and nvdbReferenceLinks of the ruteplan payload are
+        repeated this many times, to test larger responses
+
+        seed = 0, seed for drawing errors
+
+    Use as context manager, or call start() and stop()
+    """
+
+    def __init__( self, ruteplanrespons=_RESPONSFIL, latency=0.0, error_rate=0.0, payload_scale=1, seed=0 ):
+        with open( ruteplanrespons, encoding='utf-8' ) as f:
+            data = json.load( f )
+        for rute in data['routes']:
+            rute['features'] = rute['features'] * payload_scale
+            rute['nvdbReferenceLinks'] = rute.get( 'nvdbReferenceLinks', [] ) * payload_scale
+
+        self.ruteplandata   = data
+        self.ruteplanbody   = json.dumps( data ).encode( 'utf-8' )
+        self.latency        = latency
+        self.error_rate     = error_rate
+        self.calls          = { 'ruteplan' : 0, 'vegnett' : 0, 'vegobjekter' : 0, 'feil' : 0 }
+        self._random        = random.Random( seed )
+        self._lock          = threading.Lock()
+        self._server        = None
+
+    def start( self ):
+        self._server = http.server.ThreadingHTTPServer( ( '127.0.0.1', 0 ), _Handler )
+        self._server.daemon_threads = True
+        self._server.standin = self
+        threading.Thread( target=self._server.serve_forever, daemon=True ).start()
+        return self
+
+    def stop( self ):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__( self ):
+        return self.start()
+
+    def __exit__( self, *args ):
+        self.stop()
+
+    @property
+    def url( self ):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    @property
+    def ruteplan_url( self ):
+        return self.url + '/Route/best'
+
+    @property
+    def vegnett_url( self ):
+        return self.url + '/vegnett/veglenkesekvenser/'
+
+    @property
+    def vegobjekter_url( self ):
+        return self.url + '/vegobjekter/'
+
+    def credfile( self, katalog ):
+        """Writes a credentials file pointing to this server, returns the file name"""
+        filnavn = os.path.join( katalog, 'credentials.json' )
+        with open( filnavn, 'w' ) as f:
+            json.dump( { 'ruteplan' : { 'url' : self.ruteplan_url, 'user' : 'benchmark', 'pw' : 'benchmark' } }, f )
+        return filnavn
+
+    def svar( self, path ):
+        """Returns ( http status, body ) for a request path"""
+        if self.latency:
+            time.sleep( self.latency )
+        with self._lock:
+            feil = self.error_rate and self._random.random() < self.error_rate
+            if feil:
+                self.calls['feil'] += 1
+        if feil:
+            return 503, b'{"error" : "stand-in server error"}'
+
+        url = urlsplit( path )
+        deler = url.path.rstrip( '/' ).split( '/' )
+        if url.path.endswith( '/Route/best' ):
+            with self._lock:
+                self.calls['ruteplan'] += 1
+            return 200, self.ruteplanbody
+        if 'veglenkesekvenser' in deler and deler[-1].isdigit():
+            with self._lock:
+                self.calls['vegnett'] += 1
+            return 200, json.dumps( syntetisk_veglenkesekvens( deler[-1] ) ).encode( 'utf-8' )
+        if 'vegobjekter' in deler and deler[-1].isdigit():
+            with self._lock:
+                self.calls['vegobjekter'] += 1
+            filter = parse_qs( url.query ).get( 'veglenkesekvens', [ '' ] )[0]
+            return 200, json.dumps( syntetiske_vegobjekter( deler[-1], filter ) ).encode( 'utf-8' )
+        return 404, b'{"error" : "not found"}'
+
+
+def _sesjon( pool_size=8, retries=3, backoff_factor=0.01 ):
+    """Pooled requests session with retries, for the NVDB stand-in"""
+    session = requests.Session()
+    retry = Retry( total=retries, backoff_factor=backoff_factor, status_forcelist=( 429, 500, 502, 503, 504 ),
+                   allowed_methods=frozenset( ['GET'] ), raise_on_status=False )
+    adapter = HTTPAdapter( pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry )
+    session.mount( 'http://', adapter )
+    return session
+
+
+# Stegene. Hvert steg tar ( kontekst, n ) og returnerer ( antall elementer, liste med tid per element eller None,
+# antall feilede http-kall ). Resultater som senere steg trenger legges i kontekst
+
+# Syntetiske vegobjekter: Hver rute får sine egne VT-lenkesekvenser, id + rutenummer * SKIFT
+SKIFT = 10**7
+
+
+def _respons( ctx ):
+    if 'respons' not in ctx:
+        raise RuntimeError( 'No successful ruteplan response to build on, all requests in the request stage failed' )
+    return ctx['respons']
+
+
+def _steg_request( ctx, n ):
+    klient = ctx['klient']
+    coordinates = [ (262819.18, 6649657.89), (260805.98, 6649240.36) ]
+
+    def kall( ii ):
+        t0 = time.perf_counter()
+        try:
+            r = klient.route( coordinates=coordinates )
+        except requests.RequestException:
+            r = None
+        return time.perf_counter() - t0, r
+
+    latencies = []
+    feil = 0
+    with ThreadPoolExecutor( max_workers=ctx['concurrency'] ) as executor:
+        for tid, r in executor.map( kall, range( n ) ):
+            latencies.append( tid )
+            if r is None or not r.ok:
+                feil += 1
+            else:
+                ctx['respons'] = r
+    return n, latencies, feil
+
+
+def _steg_parse( ctx, n ):
+    latencies = []
+    features = []
+    respons = _respons( ctx )
+    for ii in range( n ):
+        t0 = time.perf_counter()
+        features.append( ruteplan.parseruteplan( respons ) )
+        latencies.append( time.perf_counter() - t0 )
+    ctx['features'] = features
+    return n, latencies, 0
+
+
+def _steg_shapely( ctx, n ):
+    latencies = []
+    data = []
+    for features in ctx['features']:
+        t0 = time.perf_counter()
+        data.append( ruteplan.features2dict( features ) )
+        latencies.append( time.perf_counter() - t0 )
+    ctx['dict'] = data
+    return n, latencies, 0
+
+
+def _steg_rutekolonner( ctx, n ):
+    respons = _respons( ctx )
+    batch = RouteBatch.from_data( ruteplan.lesrespons( respons ) for ii in range( n ) )
+    batch.geometries()
+    ctx['batch'] = batch
+    return len( batch ), None, 0
+
+
+def _steg_nvdbnett( ctx, n ):
+    refs = _respons( ctx ).json()['routes'][0]['nvdbReferenceLinks']
+    ids = sorted( { int( ref['nvdbReferenceId'] ) for ref in refs } )
+    ids += list( range( 10**6, 10**6 + max( n - len( ids ), 0 ) ) )
+
+    filnavn = os.path.join( ctx['katalog'], 'nvdbnettverk.sqlite' )
+    if os.path.exists( filnavn ):
+        os.remove( filnavn )
+    lager = nvdbnettverk.VeglenkesekvensLager( filnavn, url=ctx['server'].vegnett_url, concurrency=ctx['concurrency'] )
+    lager.session.close()
+    lager.session = _sesjon( pool_size=ctx['concurrency'] )
+    lager.prefetch( ids )
+    ctx['veglenker'] = lager.veglenker( ids )
+    feil = len( lager.failed )
+    lager.close()
+    return len( ids ), None, feil
+
+
+def _steg_kb2vt( ctx, n ):
+    refs = _respons( ctx ).json()['routes'][0]['nvdbReferenceLinks'] * n
+    ctx['mapped'] = kb2vt.kb2vt( refs, ctx['veglenker'] )
+    return len( refs ), None, 0
+
+
+def _steg_vegobjekter( ctx, n ):
+    session = ctx['nvdbsesjon']
+    url = ctx['server'].vegobjekter_url
+    latencies = []
+    feil = []
+
+    def hent( objekttype, filter ):
+        t0 = time.perf_counter()
+        try:
+            r = session.get( url + str( objekttype ), params=filter )
+        except requests.RequestException:
+            r = None
+        latencies.append( time.perf_counter() - t0 )
+        if r is None or not r.ok:
+            feil.append( filter['veglenkesekvens'] )
+            return []
+        return r.json()
+
+    # ctx['mapped'] er n kopier av samme rute. Flytter hver kopi til egne lenkesekvenser, ellers slår
+    # nvdbsporring dem sammen til de samme kallene uansett n
+    rute = ctx['mapped'][:len( ctx['mapped'] ) // n] if n else []
+    posisjoner = [ ( ref['fromLength'], ref['toLength'], int( ref['nvdbReferenceId'] ) + ii * SKIFT )
+                   for ii in range( n ) for ref in rute ]
+    records = list( nvdbsporring.hentvegobjekter( 105, posisjoner, concurrency=ctx['concurrency'], hentfunksjon=hent ) )
+    return len( records ), latencies, len( feil )
+
+
+def _steg_export( ctx, n ):
+    import pyarrow.parquet as pq
+    batch = ctx['batch']
+    pq.write_table( batch.to_arrow(), os.path.join( ctx['katalog'], 'ruter.parquet' ) )
+    return len( batch ), None, 0
+
+
+_STEGFUNKSJONER = { 'request' : _steg_request, 'parse' : _steg_parse, 'shapely' : _steg_shapely,
+                    'rutekolonner' : _steg_rutekolonner, 'nvdbnett' : _steg_nvdbnett, 'kb2vt' : _steg_kb2vt,
+                    'vegobjekter' : _steg_vegobjekter, 'export' : _steg_export }
+
+# Hvilken nøkkel i kontekst hvert steg lager, fjernes før steget kjøres så minnemålingen blir riktig
+_UTDATA = { 'request' : 'respons', 'parse' : 'features', 'shapely' : 'dict', 'rutekolonner' : 'batch',
+            'nvdbnett' : 'veglenker', 'kb2vt' : 'mapped', 'vegobjekter' : None, 'export' : None }
+
+
+def maal( stage, ctx, n, minne=True ):
+    """Runs one stage for problem size n, returns dictionary of metrics
+
+    The stage is run once for timing. With minne=True it is run once more under tracemalloc
+    to find the peak memory use. Failed http requests don't stop the stage, they are counted
+    in 'errors' (from the timing run).
+    """
+    funksjon = _STEGFUNKSJONER[stage]
+
+    def kjor_en_gang():
+        if _UTDATA[stage]:
+            ctx.pop( _UTDATA[stage], None )
+        gc.collect()
+        blokker = sys.getallocatedblocks()
+        t0 = time.perf_counter()
+        antall, latencies, feil = funksjon( ctx, n )
+        sekunder = time.perf_counter() - t0
+        return antall, latencies, feil, sekunder, sys.getallocatedblocks() - blokker
+
+    antall, latencies, feil, sekunder, blokker = kjor_en_gang()
+    resultat = { 'stage' : stage, 'size' : n, 'items' : antall, 'seconds' : sekunder,
+                 'throughput' : antall / sekunder if sekunder > 0 else None, 'errors' : feil,
+                 'p50_ms' : None, 'p99_ms' : None, 'peak_bytes' : None, 'alloc_blocks' : blokker }
+    if latencies:
+        resultat['p50_ms'] = float( np.percentile( latencies, 50 ) * 1000 )
+        resultat['p99_ms'] = float( np.percentile( latencies, 99 ) * 1000 )
+
+    if minne:
+        tracemalloc.start()
+        try:
+            kjor_en_gang()
+            resultat['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return resultat
+
+
+def _git_commit():
+    try:
+        return subprocess.run( [ 'git', 'rev-parse', 'HEAD' ], capture_output=True, text=True, timeout=10,
+                               cwd=os.path.dirname( os.path.abspath( __file__ ) ) ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def kjor( sizes=( 1, 10, 100, 1000 ), stages=STAGES, latency=0.0, error_rate=0.0, payload_scale=1,
+          concurrency=8, minne=True, seed=0, verbose=False ):
+    """Runs the benchmark against a local stand-in server
+
+    KEYWORDS
+        sizes = ( 1, 10, 100, 1000 ), problem sizes, i.e. number of routes
+
+        stages = all stages, see STAGES. Stages depend on earlier stages ( e.g. parse needs request ),
+        those are run too but only the selected stages are reported
+
+        latency, error_rate, payload_scale, seed : see StandInServer
+
+        concurrency = 8, number of concurrent http requests
+
+        minne = True, also measure peak memory (runs each stage twice)
+
+        verbose = False, print results as they are ready
+
+    RETURNS
+        dictionary { 'meta' : {...}, 'resultater' : [ one dictionary per stage and size ] }
+    """
+    meta = { 'tidspunkt' : datetime.datetime.now().isoformat( timespec='seconds' ),
+             'python' : platform.python_version(), 'platform' : platform.platform(),
+             'git_commit' : _git_commit(), 'numpy' : np.__version__,
+             'konfig' : { 'sizes' : list( sizes ), 'latency' : latency, 'error_rate' : error_rate,
+                          'payload_scale' : payload_scale, 'concurrency' : concurrency, 'seed' : seed } }
+    resultater = []
+
+    katalog = tempfile.mkdtemp( prefix='ruteplanbenchmark' )
+    try:
+        with StandInServer( latency=latency, error_rate=error_rate, payload_scale=payload_scale, seed=seed ) as server:
+            klient = ruteplan.RuteplanClient( credfile=server.credfile( katalog ), pool_size=concurrency,
+                                              backoff_factor=0.01 )
+            ctx = { 'server' : server, 'klient' : klient, 'katalog' : katalog, 'concurrency' : concurrency,
+                    'nvdbsesjon' : _sesjon( pool_size=concurrency ) }
+
+            # Alle steg fram til det siste valgte kjøres, fordi de bygger på hverandre
+            siste = max( STAGES.index( stage ) for stage in stages )
+            for n in sizes:
+                for stage in STAGES[:siste+1]:
+                    resultat = maal( stage, ctx, n, minne=minne and stage in stages )
+                    if stage in stages:
+                        resultater.append( resultat )
+                        if verbose:
+                            print( _formater( resultat ) )
+            klient.close()
+            ctx['nvdbsesjon'].close()
+            meta['kall'] = dict( server.calls )
+    finally:
+        shutil.rmtree( katalog, ignore_errors=True )
+
+    return { 'meta' : meta, 'resultater' : resultater }
+
+
+def _formater( r ):
+    tall = lambda x, f: '-' if x is None else format( x, f )
+    return ( f"{r['stage']:<13} n={r['size']:<7} items={r['items']:<9} {r['seconds']:9.4f} s "
+             f"{tall( r['throughput'], '12.1f' )}/s  p50={tall( r['p50_ms'], '.3f' )} ms  "
+             f"p99={tall( r['p99_ms'], '.3f' )} ms  errors={r.get( 'errors', 0 )}  peak={tall( r['peak_bytes'] and r['peak_bytes'] / 2**20, '.1f' )} MiB" )
+
+
+def lagre( resultat, filnavn ):
+    """Writes benchmark results to a json file"""
+    with open( filnavn, 'w', encoding='utf-8' ) as f:
+        json.dump( resultat, f, indent=1, ensure_ascii=False )
+
+
+def les( filnavn ):
+    """Reads benchmark results from a json file"""
+    with open( filnavn, encoding='utf-8' ) as f:
+        return json.load( f )
+
+
+def sammenlign( gammel, ny, terskel=0.10 ):
+    """Compares two benchmark results, stage by stage and size by size
+
+    ARGUMENTS
+        gammel, ny : results from kjor (or les)
+
+    KEYWORDS
+        terskel = 0.10, relative increase in time or peak memory that counts as a regression
+
+    RETURNS
+        list of dictionaries with stage, size, metric, old and new value and the ratio, for
+        every metric that got worse by more than terskel
+    """
+    gamle = { ( r['stage'], r['size'] ) : r for r in gammel['resultater'] }
+    regresjoner = []
+    for r in ny['resultater']:
+        g = gamle.get( ( r['stage'], r['size'] ) )
+        if g is None:
+            continue
+        for metrikk in ( 'seconds', 'p99_ms', 'peak_bytes' ):
+            if g.get( metrikk ) and r.get( metrikk ) is not None and r[metrikk] > g[metrikk] * ( 1 + terskel ):
+                regresjoner.append( { 'stage' : r['stage'], 'size' : r['size'], 'metrikk' : metrikk,
+                                      'gammel' : g[metrikk], 'ny' : r[metrikk], 'forhold' : r[metrikk] / g[metrikk] } )
+    return regresjoner
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser( description='Offline benchmark of the ruteplan pipeline against local stand-in servers' )
+    parser.add_argument( '--sizes', default='1,10,100,1000', help='comma separated problem sizes (number of routes)' )
+    parser.add_argument( '--stages', default=','.join( STAGES ), help='comma separated stages to report' )
+    parser.add_argument( '--latency', type=float, default=0.0, help='server latency per request, seconds' )
+    parser.add_argument( '--error-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 503' )
+    parser.add_argument( '--payload-scale', type=int, default=1, help='repeat the ruteplan features this many times' )
+    parser.add_argument( '--concurrency', type=int, default=8 )
+    parser.add_argument( '--no-memory', action='store_true', help='skip the tracemalloc run' )
+    parser.add_argument( '--output', default='benchmark.json', help='json file for the results' )
+    parser.add_argument( '--compare', help='earlier result file to compare with' )
+    parser.add_argument( '--threshold', type=float, default=0.10, help='relative change that counts as a regression' )
+    args = parser.parse_args()
+
+    resultat = kjor( sizes=[ int( n ) for n in args.sizes.split( ',' ) ], stages=args.stages.split( ',' ),
+                     latency=args.latency, error_rate=args.error_rate, payload_scale=args.payload_scale,
+                     concurrency=args.concurrency, minne=not args.no_memory, verbose=True )
+    lagre( resultat, args.output )
+    print( 'Results written to', args.output )
+
+    if args.compare:
+        regresjoner = sammenlign( les( args.compare ), resultat, terskel=args.threshold )
+        for reg in regresjoner:
+            print( f"REGRESSION {reg['stage']} n={reg['size']} {reg['metrikk']}: {reg['gammel']:.4g} => {reg['ny']:.4g} ({reg['forhold']:.2f}x)" )
+        if regresjoner:
+            sys.exit( 1 )
+        print( 'No regressions' )
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+"""Instrumentation of the ruteplan and NVDB pipeline: timing spans, counters and hooks
+
+The modules ruteplan, ruteplanbatch, nvdbnettverk, kb2vt and nvdbsporring report timing
+spans (with byte counts where it makes sense) and counters to this module. By default
+nothing is recorded: The module level functions span() and tell() then return / do
+nothing, at the cost of one global lookup per call.
+
+Spans and counters in use:
+
+    ruteplan.request          one http call to ruteplan (bytes = response size)
+    ruteplan.parse            decoding and parsing of a ruteplan response (bytes = response size)
+    ruteplan.shapely          features2dict, i.e. shapely geometries
+    nvdb.vegnett              fetching one link sequence from NVDB api (bytes = response size)
+    nvdb.lagre                storing one link sequence in the local store
+    nvdb.vegobjekter          one chunk of road objects from NVDB api
+    kb2vt.map                 KB => VT mapping of an array of linear references
+
+    ruteplan.kall             calls that actually reached the ruteplan API (every attempt, retries included)
+    ruteplan.cache_treff      answers taken from the cache
+    ruteplan.cache_bom        cache lookups that missed
+    ruteplan.retries          retries after 429 / 5xx responses or connection errors
+    ruteplan.feil             responses with http error status
+    kvote.brukt               calls counted against the daily quota (TokenBucket)
+    kvote.ventetid_s          seconds spent waiting for the rate limiter
+    kvote.oppbrukt            calls refused because the daily quota was used up
+    nvdb.segmenter            road object segments returned by nvdbsporring
+    nvdb.duplikater           road object segments dropped as duplicates by nvdbsporring
+
+Usage:
+
+    import instrumentering
+    with instrumentering.instrumentert() as maaling:
+        ... run the batch ...
+    print( maaling.rapport() )
+
+Hooks get a call at the start and end of every span, and for every counter. Use them to
+export metrics (JsonLinjeHook), profile with cProfile (ProfilHook) or sample memory use
+with tracemalloc (MinneHook):
+
+    maaling = instrumentering.aktiver( hooks=[ instrumentering.ProfilHook( 'ruteplan.parse' ) ] )
+"""
+
+import contextlib
+import cProfile
+import json
+import threading
+import time
+import tracemalloc
+from array import array
+
+import numpy as np
+
+
+class _NullSpan:
+    """Shared no-op span, returned when instrumentation is off"""
+    __slots__ = ()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        return False
+
+    def sett( self, **attrs ):
+        pass
+
+
+_NULLSPAN = _NullSpan()
+
+
+class Span:
+    """Timing span, use as context manager. Extra attributes (e.g. bytes) can be set with sett()"""
+    __slots__ = ( 'maaling', 'navn', 'attrs', 'start' )
+
+    def __init__( self, maaling, navn, attrs ):
+        self.maaling = maaling
+        self.navn = navn
+        self.attrs = attrs
+        self.start = None
+
+    def __enter__( self ):
+        for hook in self.maaling.hooks:
+            hook.span_start( self.navn, self.attrs )
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        sekunder = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs['feil'] = exc_type.__name__
+        self.maaling._registrer( self.navn, sekunder, self.attrs )
+        return False
+
+    def sett( self, **attrs ):
+        self.attrs.update( attrs )
+
+
+class Instrumentering:
+    """Collects timing spans and counters. Thread safe
+
+    KEYWORDS
+        hooks = [], list of hook objects, see Hook
+    """
+
+    def __init__( self, hooks=None ):
+        self.hooks      = list( hooks or [] )
+        self.tider      = {}        # navn => array med varighet i sekunder
+        self.bytes      = {}        # navn => sum bytes
+        self.feil       = {}        # navn => antall spans som endte med exception
+        self.tellere    = {}
+        self.startet    = time.time()
+        self._lock      = threading.Lock()
+
+    def span( self, navn, **attrs ):
+        return Span( self, navn, attrs )
+
+    def _registrer( self, navn, sekunder, attrs ):
+        with self._lock:
+            if navn not in self.tider:
+                self.tider[navn] = array( 'd' )
+                self.bytes[navn] = 0
+                self.feil[navn] = 0
+            self.tider[navn].append( sekunder )
+            self.bytes[navn] += attrs.get( 'bytes', 0 ) or 0
+            if 'feil' in attrs:
+                self.feil[navn] += 1
+        for hook in self.hooks:
+            hook.span_slutt( navn, sekunder, attrs )
+
+    def tell( self, navn, antall=1, **attrs ):
+        with self._lock:
+            self.tellere[navn] = self.tellere.get( navn, 0 ) + antall
+        for hook in self.hooks:
+            hook.teller( navn, antall, attrs )
+
+    def legg_til_hook( self, hook ):
+        self.hooks.append( hook )
+        return hook
+
+    def oppsummering( self ):
+        """Summary as a dictionary { 'spans' : { navn : {...} }, 'tellere' : {...}, 'varighet_s' : ... }"""
+        with self._lock:
+            tider = { navn : np.frombuffer( verdier, dtype=np.float64 ).copy() for navn, verdier in self.tider.items() }
+            bytes_ = dict( self.bytes )
+            feil = dict( self.feil )
+            tellere = dict( self.tellere )
+
+        spans = {}
+        for navn, t in tider.items():
+            spans[navn] = { 'antall' : len( t ), 'total_s' : float( t.sum() ),
+                            'snitt_ms' : float( t.mean() * 1000 ), 'p50_ms' : float( np.percentile( t, 50 ) * 1000 ),
+                            'p99_ms' : float( np.percentile( t, 99 ) * 1000 ), 'max_ms' : float( t.max() * 1000 ),
+                            'bytes' : bytes_[navn], 'feil' : feil[navn] }
+        return { 'spans' : spans, 'tellere' : tellere, 'varighet_s' : time.time() - self.startet }
+
+    def rapport( self ):
+        """Summary as readable text"""
+        oppsummering = self.oppsummering()
+        linjer = [ f"{'span':<20} {'antall':>8} {'total s':>10} {'snitt ms':>10} {'p50 ms':>10} {'p99 ms':>10} {'MiB':>9} {'feil':>5}" ]
+        for navn, s in sorted( oppsummering['spans'].items(), key=lambda x: -x[1]['total_s'] ):
+            linjer.append( f"{navn:<20} {s['antall']:>8} {s['total_s']:>10.3f} {s['snitt_ms']:>10.3f} {s['p50_ms']:>10.3f} "
+                           f"{s['p99_ms']:>10.3f} {s['bytes'] / 2**20:>9.2f} {s['feil']:>5}" )
+        for navn, verdi in sorted( oppsummering['tellere'].items() ):
+            linjer.append( f"{navn:<20} {verdi:>8g}" )
+        linjer.append( f"Varighet {oppsummering['varighet_s']:.1f} s" )
+        return '\n'.join( linjer )
+
+
+# Aktiv instrumentering, None betyr avslått
+_aktiv = None
+
+
+def span( navn, **attrs ):
+    """Timing span for the active instrumentation, or a no-op span if instrumentation is off
+
+        with instrumentering.span( 'ruteplan.request' ) as s:
+            r = session.get( ... )
+            s.sett( bytes=len( r.content ) )
+    """
+    if _aktiv is None:
+        return _NULLSPAN
+    return _aktiv.span( navn, **attrs )
+
+
+def tell( navn, antall=1, **attrs ):
+    """Adds to a counter of the active instrumentation. Does nothing if instrumentation is off"""
+    if _aktiv is not None:
+        _aktiv.tell( navn, antall, **attrs )
+
+
+def aktiv():
+    """Returns the active Instrumentering instance, or None"""
+    return _aktiv
+
+
+def aktiver( maaling=None, hooks=None ):
+    """Turns instrumentation on, returns the Instrumentering instance that collects the data"""
+    global _aktiv
+    if maaling is None:
+        maaling = Instrumentering( hooks=hooks )
+    _aktiv = maaling
+    return maaling
+
+
+def deaktiver():
+    """Turns instrumentation off, returns the Instrumentering instance that was active (or None)"""
+    global _aktiv
+    maaling, _aktiv = _aktiv, None
+    for hook in ( maaling.hooks if maaling else [] ):
+        hook.lukk()
+    return maaling
+
+
+@contextlib.contextmanager
+def instrumentert( hooks=None ):
+    """Context manager, instrumentation is on inside the with block"""
+    forrige = _aktiv
+    maaling = aktiver( hooks=hooks )
+    try:
+        yield maaling
+    finally:
+        deaktiver()
+        if forrige is not None:
+            aktiver( forrige )
+
+
+class Hook:
+    """Base class for hooks. Override the methods you need
+
+    Hooks are called synchronously, from the thread doing the work. Keep them cheap.
+    """
+
+    def span_start( self, navn, attrs ):
+        pass
+
+    def span_slutt( self, navn, sekunder, attrs ):
+        pass
+
+    def teller( self, navn, antall, attrs ):
+        pass
+
+    def lukk( self ):
+        pass
+
+
+class JsonLinjeHook( Hook ):
+    """Metrics exporter, writes one json line per finished span and counter update
+
+    ARGUMENTS
+        fil : file name, or an open text file
+    """
+
+    def __init__( self, fil ):
+        self._eier = isinstance( fil, str )
+        self.fil = open( fil, 'a', encoding='utf-8' ) if self._eier else fil
+        self._lock = threading.Lock()
+
+    def _skriv( self, data ):
+        linje = json.dumps( data, ensure_ascii=False, default=str )
+        with self._lock:
+            self.fil.write( linje + '\n' )
+
+    def span_slutt( self, navn, sekunder, attrs ):
+        self._skriv( dict( attrs, type='span', navn=navn, tid=time.time(), sekunder=sekunder ) )
+
+    def teller( self, navn, antall, attrs ):
+        self._skriv( dict( attrs, type='teller', navn=navn, tid=time.time(), antall=antall ) )
+
+    def lukk( self ):
+        with self._lock:
+            if self._eier:
+                self.fil.close()
+            else:
+                self.fil.flush()
+
+
+class ProfilHook( Hook ):
+    """Runs cProfile inside the spans with the given names
+
+    cProfile only sees the thread that starts the span, and only one span is profiled at a
+    time. Print the result with hook.stats().print_stats( 20 )
+
+    ARGUMENTS
+        navn : span names to profile, e.g. 'ruteplan.parse'. None means all spans
+    """
+
+    def __init__( self, *navn ):
+        self.navn = set( navn ) or None
+        self.profil = cProfile.Profile()
+        self._lock = threading.Lock()
+        self._eier = None
+
+    def span_start( self, navn, attrs ):
+        if self.navn is not None and navn not in self.navn:
+            return
+        if self._lock.acquire( blocking=False ):
+            self._eier = ( threading.get_ident(), navn )
+            self.profil.enable()
+
+    def span_slutt( self, navn, sekunder, attrs ):
+        if self._eier == ( threading.get_ident(), navn ):
+            self.profil.disable()
+            self._eier = None
+            self._lock.release()
+
+    def stats( self ):
+        import pstats
+        return pstats.Stats( self.profil ).sort_stats( 'cumulative' )
+
+
+class MinneHook( Hook ):
+    """Samples memory use with tracemalloc: Peak memory traced during every n'th span
+
+    Starts tracemalloc if it isn't running (which slows everything down). The peak is
+    process wide, so with concurrent spans it includes memory used by other threads.
+    Results in hook.peak, { navn : max peak bytes seen }
+
+    KEYWORDS
+        hver = 10, sample every n'th span per span name
+    """
+
+    def __init__( self, hver=10 ):
+        self.hver = hver
+        self.peak = {}
+        self._antall = {}
+        self._aktive = {}
+        self._lock = threading.Lock()
+        self._startet = not tracemalloc.is_tracing()
+        if self._startet:
+            tracemalloc.start()
+
+    def span_start( self, navn, attrs ):
+        with self._lock:
+            self._antall[navn] = self._antall.get( navn, 0 ) + 1
+            if self._antall[navn] % self.hver == 1 or self.hver == 1:
+                tracemalloc.reset_peak()
+                self._aktive[( threading.get_ident(), navn )] = tracemalloc.get_traced_memory()[0]
+
+    def span_slutt( self, navn, sekunder, attrs ):
+        with self._lock:
+            start = self._aktive.pop( ( threading.get_ident(), navn ), None )
+            if start is not None:
+                peak = tracemalloc.get_traced_memory()[1] - start
+                self.peak[navn] = max( self.peak.get( navn, 0 ), peak )
+
+    def lukk( self ):
+        if self._startet and tracemalloc.is_tracing():
+            tracemalloc.stop()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""Vectorized mapping of linear positions from "Kjørebane" (KB) to "Vegtrasé" (VT) topology level
+
+See mappingRoute2nvdb.md for the background. The road links of a KB link sequence carry a
+superstedfesting, i.e. which part of a VT link sequence they correspond to. Mapping a
+position on the KB link sequence means finding the road link it falls on and interpolating
+between the superstedfesting positions of that link.
+
+KB2VTIndeks builds a sorted interval index over all road links with a superstedfesting,
+grouped per (KB link sequence, super VT link sequence) pair, and maps whole arrays of
+positions at once with searchsorted and vectorized interpolation. A KB link sequence
+may map to several VT link sequences (example: 1878200 => 1878165 and 1878201), then one
+output row is produced per VT link sequence the input interval overlaps.
+
+Positions are handled with 8 decimals precision, like NVDB does. The lower end of an
+interval that falls outside the road links of a group (before the first link, or in a gap
+where links have been terminated, such as 0.693934-0.715763 @ 625977) is moved up to the
+start of the next link, and the upper end is moved down to the end of the previous link.
+
+Usage:
+
+    import kb2vt
+    indeks = kb2vt.KB2VTIndeks( veglenker )      # e.g. from nvdbnettverk.VeglenkesekvensLager.veglenker()
+    res = indeks.map( nvdbReferenceId, fromLength, toLength )
+"""
+
+import numpy as np
+
+import instrumentering
+
+
+# Posisjoner lagres som heltall med 8 desimaler presisjon, slik NVDB gjør
+SKALA = 10**8
+_POSBITS = 27       # 2**27 > SKALA
+
+
+def _kolonne( veglenker, navn, dtype=np.float64 ):
+    """Column from DataFrame or list of dictionaries as numpy array. None => NaN"""
+    if hasattr( veglenker, 'columns' ):
+        return veglenker[navn].to_numpy( dtype=dtype, na_value=np.nan )
+    return np.array( [ np.nan if lenke.get( navn ) is None else lenke[navn] for lenke in veglenker ], dtype=dtype )
+
+
+def _heltall( posisjon ):
+    return np.rint( np.asarray( posisjon, dtype=np.float64 ) * SKALA ).astype( np.int64 )
+
+
+class KB2VTIndeks:
+    """Sorted interval index over road links with superstedfesting
+
+    ARGUMENTS
+        veglenker : pandas DataFrame or list of dictionaries with the (flattened) road links
+        of the KB link sequences, with the columns veglenkesekvensid, startposisjon,
+        sluttposisjon, super_veglenkesekvensid, super_startposisjon and super_sluttposisjon.
+        Road links without superstedfesting are ignored. Historical (inactive) road links
+        should be removed first, see nvdbnettverk.VeglenkesekvensLager.veglenker
+    """
+
+    def __init__( self, veglenker ):
+        vls     = _kolonne( veglenker, 'veglenkesekvensid' )
+        sup     = _kolonne( veglenker, 'super_veglenkesekvensid' )
+        start   = _kolonne( veglenker, 'startposisjon' )
+        slutt   = _kolonne( veglenker, 'sluttposisjon' )
+        sstart  = _kolonne( veglenker, 'super_startposisjon' )
+        sslutt  = _kolonne( veglenker, 'super_sluttposisjon' )
+
+        mask = ~np.isnan( sup )
+        vls, sup = vls[mask].astype( np.int64 ), sup[mask].astype( np.int64 )
+        start, slutt = np.round( start[mask], 8 ), np.round( slutt[mask], 8 )
+        sstart, sslutt = sstart[mask], sslutt[mask]
+
+        order = np.lexsort( ( start, sup, vls ) )
+        vls, sup, start, slutt, sstart, sslutt = ( a[order] for a in ( vls, sup, start, slutt, sstart, sslutt ) )
+
+        ny = np.ones( len( vls ), dtype=bool )
+        ny[1:] = ( vls[1:] != vls[:-1] ) | ( sup[1:] != sup[:-1] )
+        gruppe = np.cumsum( ny ) - 1
+
+        self.start      = start
+        self.slutt      = slutt
+        self.sstart     = sstart
+        self.sslutt     = sslutt
+        self.grp_first  = np.flatnonzero( ny )
+        self.grp_kb     = vls[self.grp_first]
+        self.grp_super  = sup[self.grp_first]
+        self.grp_min    = start[self.grp_first]
+        self.grp_max    = np.maximum.reduceat( slutt, self.grp_first ) if len( slutt ) else slutt
+        self.key        = ( gruppe.astype( np.int64 ) << _POSBITS ) | _heltall( start )
+
+    def kjorebane( self, ids ):
+        """Boolean array, True for link sequence IDs at the KB topology level (i.e. with superstedfesting)"""
+        return np.isin( np.asarray( ids, dtype=np.int64 ), self.grp_kb )
+
+    def _posisjon( self, g, p, nedre ):
+        """Maps positions p within groups g. nedre=True for the lower end of an interval"""
+
+        first = self.grp_first[g]
+        idx = np.searchsorted( self.key, ( g.astype( np.int64 ) << _POSBITS ) | _heltall( p ), side='right' ) - 1
+        foran = idx < first                          # Foran første veglenke i gruppen
+        idx = np.where( foran, first, idx )
+        inne = ~foran & ( p <= self.slutt[idx] )
+
+        lengde = self.slutt[idx] - self.start[idx]
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            andel = np.where( lengde > 0, ( p - self.start[idx] ) / lengde, 0.0 )
+        interpolert = self.sstart[idx] + andel * ( self.sslutt[idx] - self.sstart[idx] )
+
+        if nedre:
+            # Flytt opp til starten av neste veglenke
+            neste = np.where( foran, idx, np.minimum( idx + 1, len( self.start ) - 1 ) )
+            flyttet = self.sstart[neste]
+        else:
+            # Flytt ned til slutten av forrige veglenke
+            flyttet = self.sslutt[idx]
+
+        return np.round( np.where( inne, interpolert, flyttet ), 8 )
+
+    def map( self, nvdbReferenceId, fromLength, toLength ):
+        """Maps arrays of linear references from KB to VT topology level
+
+        ARGUMENTS
+            nvdbReferenceId, fromLength, toLength : array-like of the same length, the linear
+            references (e.g. nvdbReferenceLinks from ruteplan)
+
+        RETURNS
+            dictionary of numpy arrays, one element per output row:
+                'kilde' : index of the input row
+                'kjbane' : True if the row is mapped from KB level, False if passed through unchanged
+                'nvdbReferenceId', 'fromLength', 'toLength' : the VT level linear reference
+            Rows are ordered by input row. Input rows at the VT level are passed through
+            (positions rounded to 8 decimals). KB input rows may give zero, one or several output rows.
+        """
+
+        with instrumentering.span( 'kb2vt.map' ):
+            return self._map( nvdbReferenceId, fromLength, toLength )
+
+    def _map( self, nvdbReferenceId, fromLength, toLength ):
+        ids = np.asarray( nvdbReferenceId ).astype( np.int64 )
+        fra = np.round( np.asarray( fromLength, dtype=np.float64 ), 8 )
+        til = np.round( np.asarray( toLength, dtype=np.float64 ), 8 )
+        lo, hi = np.minimum( fra, til ), np.maximum( fra, til )
+
+        # Alle grupper (KB, VT)-par for hver inputrad
+        a = np.searchsorted( self.grp_kb, ids, side='left' )
+        b = np.searchsorted( self.grp_kb, ids, side='right' )
+        antall = b - a
+        gjennom = antall == 0
+
+        kilde = np.repeat( np.arange( len( ids ) ), antall )
+        forskyvning = np.arange( len( kilde ) ) - np.repeat( np.cumsum( antall ) - antall, antall )
+        g = np.repeat( a, antall ) + forskyvning
+
+        # Bare grupper som faktisk overlapper intervallet
+        lo_k, hi_k = lo[kilde], hi[kilde]
+        overlapp = ( lo_k < self.grp_max[g] ) & ( hi_k > self.grp_min[g] )
+        punkt = ( lo_k == hi_k ) & ( lo_k >= self.grp_min[g] ) & ( lo_k <= self.grp_max[g] )
+        behold = overlapp | punkt
+        kilde, g, lo_k, hi_k = kilde[behold], g[behold], lo_k[behold], hi_k[behold]
+
+        nedre = self._posisjon( g, lo_k, nedre=True )
+        ovre = self._posisjon( g, hi_k, nedre=False )
+        snudd = fra[kilde] > til[kilde]
+
+        # Slår sammen gjennomgående og kartlagte rader, sortert på inputrad
+        passkilde = np.flatnonzero( gjennom )
+        alle = np.concatenate( [ passkilde, kilde ] )
+        order = np.argsort( alle, kind='stable' )
+        return { 'kilde'           : alle[order],
+                 'kjbane'          : np.concatenate( [ np.zeros( len( passkilde ), dtype=bool ), np.ones( len( kilde ), dtype=bool ) ] )[order],
+                 'nvdbReferenceId' : np.concatenate( [ ids[passkilde], self.grp_super[g] ] )[order],
+                 'fromLength'      : np.concatenate( [ fra[passkilde], np.where( snudd, ovre, nedre ) ] )[order],
+                 'toLength'        : np.concatenate( [ til[passkilde], np.where( snudd, nedre, ovre ) ] )[order] }
+
+
+def kb2vt( linkrefs, veglenker ):
+    """Maps a list of ruteplan nvdbReferenceLinks from KB to VT topology level
+
+    Drop-in replacement for the mapping loop of mappingRoute2nvdb.py: Link references at the
+    VT level are returned unchanged, KB link references are replaced by one dictionary
+    { 'kjbane' : original linkref, 'nvdbReferenceId' : VT id, 'fromLength' : .., 'toLength' : .. }
+    per VT link sequence they map to.
+
+    ARGUMENTS
+        linkrefs : list of dictionaries with nvdbReferenceId, fromLength, toLength
+
+        veglenker : road links (or a ready made KB2VTIndeks), see KB2VTIndeks
+
+    RETURNS
+        list of dictionaries
+    """
+    indeks = veglenker if isinstance( veglenker, KB2VTIndeks ) else KB2VTIndeks( veglenker )
+    if not linkrefs:
+        return []
+
+    res = indeks.map( [ int( x['nvdbReferenceId'] ) for x in linkrefs ],
+                      [ x['fromLength'] for x in linkrefs ],
+                      [ x['toLength'] for x in linkrefs ] )
+
+    mapped = []
+    for kilde, kjbane, vid, fra, til in zip( res['kilde'], res['kjbane'], res['nvdbReferenceId'],
+                                            res['fromLength'], res['toLength'] ):
+        if kjbane:
+            mapped.append( { 'kjbane' : linkrefs[kilde], 'nvdbReferenceId' : int( vid ),
+                             'fromLength' : float( fra ), 'toLength' : float( til ) } )
+        else:
+            mapped.append( linkrefs[kilde] )
+    return mapped
@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+
+"""Offline routing over a cached NVDB road network ("fattigmannsnettanalyse")
+
+The ruteplan API has a quota of 2500 calls per day and a network round trip per route.
+For large problems it can pay off to route locally over the NVDB road network, e.g. as
+cached by nvdbnettverk.VeglenkesekvensLager. LokalRuter builds a directed graph of the
+road links, stored as compact CSR arrays, precomputes landmark distances (the ALT
+speedup technique: A* search with lower bounds from triangle inequalities over a few
+landmarks) and answers point-to-point and one-to-many queries.
+
+Results are returned in the same shape as responses from the ruteplan API, i.e.
+{ 'routes' : [ { 'statistic' : ..., 'features' : [...], 'nvdbReferenceLinks' : [...] } ] },
+so they can be used with ruteplan.parseruteplandata, rutekolonner.RouteBatch.from_data etc.
+
+Direction semantics follow the nvdbReferenceLinks of the ruteplan API: Travelling along a
+road link in the direction of its linear referencing (from startposisjon to sluttposisjon)
+is 'With', the opposite is 'Against'. Lanes in 'feltoversikt' with odd numbers run With,
+even numbers run Against. Road links without lane information are open in both directions.
+
+Road links at detaljnivå 'Vegtrasé' are left out, since traffic runs on the underlying
+"Kjørebane" links (see mappingRoute2nvdb.md).
+
+Usage:
+
+    import lokalruting
+    ruter = lokalruting.LokalRuter( lager.veglenker(), fart=50 )
+    data = ruter.rute( (262819.18, 6649657.89), (260805.98, 6649240.36) )
+    features = ruteplan.parseruteplandata( data )
+
+Everything works fully offline. syntetisknettverk() makes a small grid network for testing,
+and sammenlign() compares local routes with saved responses from the ruteplan service.
+"""
+
+import heapq
+import math
+import uuid
+
+import numpy as np
+import shapely
+from shapely.ops import substring
+
+import ruteplan
+
+
+def _retninger( feltoversikt ):
+    """( med, mot ) - which directions are open for traffic, from the feltoversikt text '1,2' """
+    if not feltoversikt:
+        return True, True
+
+    med = mot = False
+    for felt in str( feltoversikt ).split( ',' ):
+        siffer = ''
+        for tegn in felt.strip():
+            if not tegn.isdigit():
+                break
+            siffer += tegn
+        if siffer:
+            if int( siffer ) % 2:
+                med = True
+            else:
+                mot = True
+
+    if not ( med or mot ):
+        return True, True
+    return med, mot
+
+
+def _csr( kilde, nnoder ):
+    """Returns indptr and edge order for a CSR structure sorted on kilde"""
+    order = np.argsort( kilde, kind='stable' )
+    indptr = np.zeros( nnoder + 1, dtype=np.int64 )
+    np.cumsum( np.bincount( kilde, minlength=nnoder ), out=indptr[1:] )
+    return indptr, order
+
+
+def _dijkstra( indptr, nabo, vekt, kilde, nnoder ):
+    """Full single source Dijkstra, returns numpy array of distances (inf if unreachable)"""
+    dist = [ math.inf ] * nnoder
+    dist[kilde] = 0.0
+    heap = [ ( 0.0, kilde ) ]
+    while heap:
+        g, x = heapq.heappop( heap )
+        if g > dist[x]:
+            continue
+        for e in range( indptr[x], indptr[x+1] ):
+            y = nabo[e]
+            ng = g + vekt[e]
+            if ng < dist[y]:
+                dist[y] = ng
+                heapq.heappush( heap, ( ng, y ) )
+    return np.asarray( dist )
+
+
+class LokalRuter:
+    """Local routing engine over NVDB road links
+
+    ARGUMENTS
+        veglenker : pandas DataFrame or list of dictionaries with (active) road links, as returned
+        by nvdbnettverk.VeglenkesekvensLager.veglenker. Needed: veglenkesekvensid, startposisjon,
+        sluttposisjon and geometri (wkt). Used if present: startnode, sluttnode, feltoversikt,
+        detaljnivå. Without startnode/sluttnode, road links are connected where their end
+        points coincide (rounded to 0.1 m)
+
+    KEYWORDS
+        fart = 50, speed in km/h. A number, or a function taking a road link dictionary and
+        returning the speed for that link
+
+        vekt = 'time', optimize travel time ('time') or distance ('length')
+
+        landemerker = 8, number of landmarks for the A* lower bounds. 0 means plain Dijkstra
+    """
+
+    def __init__( self, veglenker, fart=50, vekt='time', landemerker=8 ):
+
+        if hasattr( veglenker, 'to_dict' ):
+            veglenker = veglenker.to_dict( 'records' )
+        veglenker = [ lenke for lenke in veglenker
+                      if lenke.get( 'geometri' ) and lenke.get( 'detaljnivå' ) != 'Vegtrasé' ]
+        if not veglenker:
+            raise ValueError( 'No road links with geometry to build a routing graph from' )
+
+        self.geom   = shapely.force_2d( shapely.from_wkt( [ lenke['geometri'] for lenke in veglenker ] ) )
+        self.lengde = shapely.length( self.geom )
+        self.vls    = np.asarray( [ int( lenke['veglenkesekvensid'] ) for lenke in veglenker ], dtype=np.int64 )
+        self.start  = np.asarray( [ lenke['startposisjon'] for lenke in veglenker ], dtype=np.float64 )
+        self.slutt  = np.asarray( [ lenke['sluttposisjon'] for lenke in veglenker ], dtype=np.float64 )
+
+        if callable( fart ):
+            kmt = np.asarray( [ fart( lenke ) for lenke in veglenker ], dtype=np.float64 )
+        else:
+            kmt = np.full( len( veglenker ), float( fart ) )
+        self.tid = self.lengde / ( kmt / 3.6 )
+
+        # Noder - fra NVDB sine node-ID'er hvis vi har dem, ellers fra endepunktene til geometrien
+        forste = shapely.get_point( self.geom, 0 )
+        siste  = shapely.get_point( self.geom, -1 )
+        if all( lenke.get( 'startnode' ) is not None and lenke.get( 'sluttnode' ) is not None for lenke in veglenker ):
+            nokler = [ lenke['startnode'] for lenke in veglenker ] + [ lenke['sluttnode'] for lenke in veglenker ]
+        else:
+            xy = np.round( np.concatenate( [ shapely.get_coordinates( forste ), shapely.get_coordinates( siste ) ] ), 1 )
+            nokler = [ tuple( p ) for p in xy ]
+        oppslag = {}
+        noder = np.asarray( [ oppslag.setdefault( key, len( oppslag ) ) for key in nokler ], dtype=np.int64 )
+        self.nnoder = len( oppslag )
+        self.u = noder[:len( veglenker )]
+        self.v = noder[len( veglenker ):]
+
+        retning = [ _retninger( lenke.get( 'feltoversikt' ) ) for lenke in veglenker ]
+        self.med = np.asarray( [ r[0] for r in retning ], dtype=bool )
+        self.mot = np.asarray( [ r[1] for r in retning ], dtype=bool )
+
+        # Rettede kanter: Med => u til v, Mot => v til u
+        lenke_idx = np.arange( len( veglenker ) )
+        fra     = np.concatenate( [ self.u[self.med], self.v[self.mot] ] )
+        til     = np.concatenate( [ self.v[self.med], self.u[self.mot] ] )
+        lenke   = np.concatenate( [ lenke_idx[self.med], lenke_idx[self.mot] ] )
+        sign    = np.concatenate( [ np.ones( self.med.sum(), dtype=np.int8 ), -np.ones( self.mot.sum(), dtype=np.int8 ) ] )
+        kost    = ( self.tid if vekt == 'time' else self.lengde )[lenke]
+        self.kost = self.tid if vekt == 'time' else self.lengde
+
+        indptr, order = _csr( fra, self.nnoder )
+        self.indptr     = indptr
+        self.kant_til   = til[order]
+        self.kant_vekt  = kost[order]
+        self.kant_lenke = lenke[order]
+        self.kant_sign  = sign[order]
+
+        rindptr, rorder = _csr( til, self.nnoder )
+        self.rindptr    = rindptr
+        self.rkant_fra  = fra[rorder]
+        self.rkant_vekt = kost[rorder]
+
+        # Python-lister er raskere enn numpy-arrays for søket, som går element for element
+        self._indptr    = self.indptr.tolist()
+        self._til       = self.kant_til.tolist()
+        self._vekt      = self.kant_vekt.tolist()
+
+        self.tree = shapely.STRtree( self.geom )
+        self._landemerker( landemerker )
+
+    def _landemerker( self, antall ):
+        """Selects landmarks by farthest-first and precomputes distances to and from them"""
+        self.landemerker = []
+        self.fra_landemerke = np.empty( ( 0, self.nnoder ) )
+        self.til_landemerke = np.empty( ( 0, self.nnoder ) )
+        if not antall:
+            return
+
+        rindptr, rfra, rvekt = self.rindptr.tolist(), self.rkant_fra.tolist(), self.rkant_vekt.tolist()
+        fra_lm, til_lm = [], []
+        naermeste = np.full( self.nnoder, np.inf )
+        neste = int( np.argmax( np.diff( self.indptr ) ) )
+        for _ in range( min( antall, self.nnoder ) ):
+            self.landemerker.append( neste )
+            fra_lm.append( _dijkstra( self._indptr, self._til, self._vekt, neste, self.nnoder ) )
+            til_lm.append( _dijkstra( rindptr, rfra, rvekt, neste, self.nnoder ) )
+            naermeste = np.minimum( naermeste, np.where( np.isfinite( fra_lm[-1] ), fra_lm[-1], np.inf ) )
+            kandidat = np.where( np.isfinite( naermeste ), naermeste, -1 )
+            kandidat[self.landemerker] = -1
+            if kandidat.max() <= 0:
+                break
+            neste = int( np.argmax( kandidat ) )
+
+        self.fra_landemerke = np.asarray( fra_lm )
+        self.til_landemerke = np.asarray( til_lm )
+
+    def _nedregrense( self, maalnoder ):
+        """Lower bound of the cost from every node to the nearest of maalnoder (ALT heuristic)"""
+        if not self.landemerker:
+            return None
+
+        grense = np.full( self.nnoder, np.inf )
+        df, db = self.fra_landemerke, self.til_landemerke
+        for t in maalnoder:
+            with np.errstate( invalid='ignore' ):
+                b1 = np.where( np.isfinite( df ), df[:, [t]] - df, 0.0 )
+                b2 = np.where( np.isfinite( db ) & np.isfinite( db[:, [t]] ), db - db[:, [t]], 0.0 )
+            grense = np.minimum( grense, np.maximum( np.maximum( b1, b2 ).max( axis=0 ), 0.0 ) )
+        return np.nan_to_num( grense, nan=0.0 ).tolist()
+
+    def snap( self, punkt, maks_avstand=None ):
+        """Finds the nearest road link for a (x,y) point
+
+        RETURNS
+            tuple ( road link index, normalized position along the link's geometry, distance )
+        """
+        p = shapely.Point( punkt[0], punkt[1] )
+        treff = self.tree.query_nearest( p, max_distance=maks_avstand, return_distance=True )
+        if len( treff[0] ) == 0:
+            raise ValueError( f"No road link within {maks_avstand} m of {punkt}" )
+        lenke = int( treff[0][0] )
+        return lenke, float( self.geom[lenke].project( p, normalized=True ) ), float( treff[1][0] )
+
+    def _start( self, lenke, f ):
+        """Start labels for a stop on lenke at fraction f: list of ( node, cost, piece )"""
+        c = self.kost[lenke]
+        start = []
+        if self.med[lenke]:
+            start.append( ( int( self.v[lenke] ), ( 1 - f ) * c, ( lenke, f, 1.0 ) ) )
+        if self.mot[lenke]:
+            start.append( ( int( self.u[lenke] ), f * c, ( lenke, f, 0.0 ) ) )
+        return start
+
+    def _slutt( self, lenke, f ):
+        """Target labels for a stop on lenke at fraction f: list of ( node, cost, piece )"""
+        c = self.kost[lenke]
+        slutt = []
+        if self.med[lenke]:
+            slutt.append( ( int( self.u[lenke] ), f * c, ( lenke, 0.0, f ) ) )
+        if self.mot[lenke]:
+            slutt.append( ( int( self.v[lenke] ), ( 1 - f ) * c, ( lenke, 1.0, f ) ) )
+        return slutt
+
+    def _direkte( self, start, slutt ):
+        """Cost and piece if start and target are on the same road link, else None"""
+        ( lenke, f ), ( lenke2, g ) = start, slutt
+        if lenke != lenke2:
+            return None
+        if g >= f and self.med[lenke]:
+            return ( g - f ) * self.kost[lenke], ( lenke, f, g )
+        if g <= f and self.mot[lenke]:
+            return ( f - g ) * self.kost[lenke], ( lenke, f, g )
+        return None
+
+    def _sok( self, startlabels, h=None, sluttlabels=None, maalnoder=None ):
+        """Dijkstra (h=None) or A* search from the start labels
+
+        With sluttlabels (dictionary node => extra cost to target) the search stops as soon as
+        no better route to the target can be found. With maalnoder (set) the search stops when
+        all of them are settled.
+
+        RETURNS
+            g (dictionary node => cost), pred (dictionary node => edge index, or -1 for start nodes),
+            best (cost, node) for sluttlabels or None
+        """
+        indptr, nabo, vekt = self._indptr, self._til, self._vekt
+        g = {}
+        pred = {}
+        heap = []
+        for node, kost, _ in startlabels:
+            if kost < g.get( node, math.inf ):
+                g[node] = kost
+                pred[node] = -1
+                heapq.heappush( heap, ( kost + ( h[node] if h else 0.0 ), kost, node ) )
+
+        best = ( math.inf, None )
+        gjenstaar = set( maalnoder ) if maalnoder is not None else None
+        ferdig = set()
+        while heap:
+            k, gx, x = heapq.heappop( heap )
+            if x in ferdig:
+                continue
+            if sluttlabels is not None and k >= best[0]:
+                break
+            ferdig.add( x )
+
+            if sluttlabels is not None and x in sluttlabels and gx + sluttlabels[x] < best[0]:
+                best = ( gx + sluttlabels[x], x )
+            if gjenstaar is not None:
+                gjenstaar.discard( x )
+                if not gjenstaar:
+                    break
+
+            for e in range( indptr[x], indptr[x+1] ):
+                y = nabo[e]
+                ny = gx + vekt[e]
+                if ny < g.get( y, math.inf ):
+                    g[y] = ny
+                    pred[y] = e
+                    heapq.heappush( heap, ( ny + ( h[y] if h else 0.0 ), ny, y ) )
+
+        return g, pred, ( best if sluttlabels is not None else None )
+
+    def _stykker( self, pred, startlabels, node, sluttstykke ):
+        """Walks the predecessor edges back to the start, returns list of pieces ( link, from, to )"""
+        stykker = [ sluttstykke ]
+        while pred[node] != -1:
+            e = pred[node]
+            lenke = int( self.kant_lenke[e] )
+            if self.kant_sign[e] > 0:
+                stykker.append( ( lenke, 0.0, 1.0 ) )
+                node = int( self.u[lenke] )
+            else:
+                stykker.append( ( lenke, 1.0, 0.0 ) )
+                node = int( self.v[lenke] )
+        # Hvilken startbit ga lavest kostnad til denne noden?
+        startstykke = min( ( label for label in startlabels if label[0] == node ), key=lambda x: x[1] )[2]
+        stykker.append( startstykke )
+        return stykker[::-1]
+
+    def _rute( self, stykker ):
+        """Builds a route in the same shape as the ruteplan API from a list of pieces"""
+        features = []
+        refs = []
+        totallengde = 0.0
+        totaltid = 0.0
+        for lenke, a, b in stykker:
+            if a == b:
+                continue
+            andel = abs( b - a )
+            lengde = andel * float( self.lengde[lenke] )
+            tid = andel * float( self.tid[lenke] )
+            totallengde += lengde
+            totaltid += tid
+            retning = 'With' if b > a else 'Against'
+            start, slutt = float( self.start[lenke] ), float( self.slutt[lenke] )
+            pa = round( start + a * ( slutt - start ), 8 )
+            pb = round( start + b * ( slutt - start ), 8 )
+            geom = substring( self.geom[lenke], a, b, normalized=True )
+            features.append( { 'type' : 'Feature',
+                               'geometry' : { 'type' : 'LineString', 'coordinates' : shapely.get_coordinates( geom ).tolist() },
+                               'properties' : { 'time' : round( tid, 1 ), 'length' : round( lengde, 1 ),
+                                                'nvdbReferenceId' : str( self.vls[lenke] ), 'direction' : retning } } )
+
+            fra, til = min( pa, pb ), max( pa, pb )
+            forrige = refs[-1] if refs else None
+            if ( forrige and forrige['nvdbReferenceId'] == str( self.vls[lenke] ) and forrige['direction'] == retning
+                    and ( ( retning == 'With' and forrige['toLength'] == fra ) or ( retning == 'Against' and forrige['fromLength'] == til ) ) ):
+                forrige['fromLength'] = min( forrige['fromLength'], fra )
+                forrige['toLength'] = max( forrige['toLength'], til )
+            else:
+                refs.append( { 'nvdbReferenceId' : str( self.vls[lenke] ), 'fromLength' : fra,
+                               'toLength' : til, 'direction' : retning } )
+
+        statistic = { 'totalLength' : round( totallengde ), 'totalDriveTime' : round( totaltid / 60 ),
+                      'totalTime' : round( totaltid / 60 ) }
+        return { 'routeId' : str( uuid.uuid4() ), 'routeName' : '', 'nvdbReferenceLinks' : refs,
+                 'statistic' : statistic, 'type' : 'FeatureCollection', 'features' : features }
+
+    def rute( self, fra, til, maks_avstand=None ):
+        """Point-to-point route between two (x,y) points
+
+        RETURNS
+            dictionary in the same shape as a ruteplan API response, { 'routes' : [ route ] }
+        """
+        s = self.snap( fra, maks_avstand )[:2]
+        t = self.snap( til, maks_avstand )[:2]
+        startlabels = self._start( *s )
+        slutt = self._slutt( *t )
+        sluttlabels = {}
+        for node, kost, _ in slutt:
+            sluttlabels[node] = min( kost, sluttlabels.get( node, math.inf ) )
+
+        h = self._nedregrense( list( sluttlabels ) )
+        g, pred, ( bestkost, bestnode ) = self._sok( startlabels, h=h, sluttlabels=sluttlabels )
+
+        direkte = self._direkte( s, t )
+        if direkte is not None and direkte[0] <= bestkost:
+            return { 'routes' : [ self._rute( [ direkte[1] ] ) ] }
+        if bestnode is None:
+            raise ValueError( f"No route found from {fra} to {til}" )
+
+        sluttstykke = min( ( label for label in slutt if label[0] == bestnode ), key=lambda x: x[1] )[2]
+        return { 'routes' : [ self._rute( self._stykker( pred, startlabels, bestnode, sluttstykke ) ) ] }
+
+    def entilmange( self, fra, tilliste, maks_avstand=None ):
+        """One-to-many routes from one (x,y) point to a list of (x,y) points, with a single search
+
+        RETURNS
+            dictionary in the same shape as a ruteplan API response, with one element in 'routes'
+            per destination (in the same order). Destinations that can't be reached get a route
+            with no features and None in the statistic values
+        """
+        s = self.snap( fra, maks_avstand )[:2]
+        startlabels = self._start( *s )
+        maal = [ self.snap( til, maks_avstand )[:2] for til in tilliste ]
+        slutter = [ self._slutt( *t ) for t in maal ]
+        maalnoder = { node for slutt in slutter for node, _, _ in slutt }
+
+        g, pred, _ = self._sok( startlabels, maalnoder=maalnoder )
+
+        ruter = []
+        for t, slutt in zip( maal, slutter ):
+            kandidater = [ ( g[node] + kost, node, stykke ) for node, kost, stykke in slutt if node in g ]
+            direkte = self._direkte( s, t )
+            if direkte is not None and ( not kandidater or direkte[0] <= min( kandidater )[0] ):
+                ruter.append( self._rute( [ direkte[1] ] ) )
+            elif kandidater:
+                _, node, stykke = min( kandidater, key=lambda x: x[0] )
+                ruter.append( self._rute( self._stykker( pred, startlabels, node, stykke ) ) )
+            else:
+                rute = self._rute( [] )
+                rute['statistic'] = { key : None for key in rute['statistic'] }
+                ruter.append( rute )
+        return { 'routes' : ruter }
+
+    def features( self, fra, til, egenskaper={}, maks_avstand=None ):
+        """Point-to-point route as a list of geojson features, same as ruteplan.parseruteplan"""
+        return ruteplan.parseruteplandata( self.rute( fra, til, maks_avstand=maks_avstand ), egenskaper=egenskaper )
+
+
+def syntetisknettverk( nx=10, ny=10, avstand=100.0, enveis=0.0, seed=0 ):
+    """Makes a small synthetic grid road network for offline testing
+
+    Every edge of an nx * ny grid is one link sequence with one road link. A fraction
+    'enveis' of the road links are one-way (lane '1' only, i.e. open in the With direction).
+
+    RETURNS
+        list of road link dictionaries, same shape as nvdbnettverk.VeglenkesekvensLager.veglenker
+    """
+    rng = np.random.default_rng( seed )
+    veglenker = []
+    for ii in range( nx ):
+        for jj in range( ny ):
+            for di, dj in ( ( 1, 0 ), ( 0, 1 ) ):
+                if ii + di >= nx or jj + dj >= ny:
+                    continue
+                x0, y0 = ii * avstand, jj * avstand
+                x1, y1 = ( ii + di ) * avstand, ( jj + dj ) * avstand
+                veglenker.append( { 'veglenkesekvensid' : 1000000 + len( veglenker ),
+                                    'veglenkenummer' : 1, 'startposisjon' : 0.0, 'sluttposisjon' : 1.0,
+                                    'geometri' : f"LINESTRING ({x0} {y0}, {x1} {y1})",
+                                    'startnode' : f"{ii},{jj}", 'sluttnode' : f"{ii+di},{jj+dj}",
+                                    'feltoversikt' : '1' if rng.random() < enveis else '1,2',
+                                    'detaljnivå' : 'Vegtrasé og kjørebane' } )
+    return veglenker
+
+
+def _overlapp( refs1, refs2 ):
+    """Overlap (intersection over union) of two lists of nvdbReferenceLinks, in units of linear position"""
+    def intervaller( refs ):
+        per = {}
+        for ref in refs:
+            per.setdefault( int( ref['nvdbReferenceId'] ), [] ).append( ( min( ref['fromLength'], ref['toLength'] ),
+                                                                          max( ref['fromLength'], ref['toLength'] ) ) )
+        return per
+
+    def sum_lengde( per ):
+        return sum( til - fra for liste in per.values() for fra, til in liste )
+
+    a, b = intervaller( refs1 ), intervaller( refs2 )
+    snitt = 0.0
+    for vid in set( a ) & set( b ):
+        for fra1, til1 in a[vid]:
+            for fra2, til2 in b[vid]:
+                snitt += max( 0.0, min( til1, til2 ) - max( fra1, fra2 ) )
+    union = sum_lengde( a ) + sum_lengde( b ) - snitt
+    return snitt / union if union > 0 else 1.0
+
+
+def sammenlign( ruter, responser ):
+    """Compares local routes with saved responses from the ruteplan service
+
+    For each saved response the first route alternative is routed locally, between the first
+    and last coordinate of its geometry.
+
+    ARGUMENTS
+        ruter : LokalRuter instance
+
+        responser : list of decoded ruteplan responses (dictionaries), e.g. json.load of
+        ruteplanrespons.json
+
+    RETURNS
+        dictionary with one element per response in 'ruter' (service and local totalLength,
+        relative length difference and the overlap of nvdbReferenceLinks), plus the summary
+        values 'snitt_lengdeavvik' and 'snitt_overlapp'
+    """
+    resultat = []
+    for data in responser:
+        rute = data['routes'][0]
+        fra = rute['features'][0]['geometry']['coordinates'][0][:2]
+        til = rute['features'][-1]['geometry']['coordinates'][-1][:2]
+        try:
+            lokal = ruter.rute( fra, til )['routes'][0]
+        except ValueError as e:
+            resultat.append( { 'fra' : fra, 'til' : til, 'feil' : str( e ) } )
+            continue
+
+        tjeneste_lengde = float( rute['statistic']['totalLength'] )
+        lokal_lengde = float( lokal['statistic']['totalLength'] )
+        resultat.append( { 'fra' : fra, 'til' : til,
+                           'tjeneste_lengde' : tjeneste_lengde,
+                           'lokal_lengde' : lokal_lengde,
+                           'lengdeavvik' : ( lokal_lengde - tjeneste_lengde ) / tjeneste_lengde if tjeneste_lengde else None,
+                           'overlapp' : _overlapp( rute.get( 'nvdbReferenceLinks', [] ), lokal['nvdbReferenceLinks'] ) } )
+
+    ok = [ r for r in resultat if r.get( 'lengdeavvik' ) is not None ]
+    return { 'ruter' : resultat,
+             'snitt_lengdeavvik' : float( np.mean( [ abs( r['lengdeavvik'] ) for r in ok ] ) ) if ok else None,
+             'snitt_overlapp' : float( np.mean( [ r['overlapp'] for r in ok ] ) ) if ok else None }
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental KB => VT mapping of an archive of stored routes
+
+mappingRoute2nvdb.py maps the routes from scratch every time. For a large archive of routes
+that is wasteful, since only a few link sequences change between two NVDB updates (like
+625977 losing a section at sluttdato 2014-01-01, or 1878200 being split across two vegtrasé
+link sequences, see mappingRoute2nvdb.md).
+
+MappingArkiv keeps the nvdbReferenceLinks of every route in a SQLite file, together with
+the VT level mapping and the version of every link sequence the mapping was built from:
+the fingerprint from nvdbnettverk, and the first date (startdato / sluttdato) after which
+the set of active road links changes. oppdater() re-fetches the link sequences (or only the
+missing and stale ones), finds those whose version has changed, and maps again only the
+routes touching them, plus routes that have not been mapped yet. The cost of a daily update
+thus follows the size of the network change, not the size of the archive.
+
+oppdater_vegobjekter() brings a downstream layer, e.g. speed limits (105) in a GeoPackage,
+up to date in place for the VT link sequences affected by an update.
+
+Usage:
+
+    import nvdbnettverk
+    import mappingarkiv
+
+    lager = nvdbnettverk.VeglenkesekvensLager( 'nvdbnettverk.sqlite' )
+    arkiv = mappingarkiv.MappingArkiv( 'mappingarkiv.sqlite', lager )
+    arkiv.legg_til( 'Storgata-Munkedamsveien', data['routes'][0]['nvdbReferenceLinks'] )
+    endring = arkiv.oppdater()
+    mappingarkiv.oppdater_vegobjekter( arkiv, 105, 'fartsgrense.gpkg', vt_ids=endring['vt_ids'] )
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import kb2vt
+import nvdbnettverk
+import nvdbsporring
+import instrumentering
+
+
+def _versjon( veglenker, dato ):
+    """First date after 'dato' where the set of active road links changes, or None"""
+    datoer = [ lenke[navn] for lenke in veglenker for navn in ( 'startdato', 'sluttdato' )
+               if lenke.get( navn ) and lenke[navn] > dato ]
+    return min( datoer ) if datoer else None
+
+
+def _aktiv( lenke, dato ):
+    return ( not lenke.get( 'startdato' ) or lenke['startdato'] <= dato ) and ( not lenke.get( 'sluttdato' ) or lenke['sluttdato'] > dato )
+
+
+class MappingArkiv:
+    """SQLite archive of routes, their KB => VT mapping and the network versions it was built from
+
+    ARGUMENTS
+        filename : string, path to sqlite file
+
+        lager : nvdbnettverk.VeglenkesekvensLager with the link sequences
+    """
+
+    def __init__( self, filename='mappingarkiv.sqlite', lager=None ):
+        self.filename = filename
+        self.lager = lager if lager is not None else nvdbnettverk.VeglenkesekvensLager()
+        self._conn = sqlite3.connect( filename )
+        with self._conn:
+            self._conn.execute( """CREATE TABLE IF NOT EXISTS rute (
+                                    ruteid TEXT PRIMARY KEY,
+                                    linkrefs TEXT,
+                                    kartlagt INTEGER DEFAULT 0 )""" )
+            self._conn.execute( """CREATE TABLE IF NOT EXISTS rute_vls (
+                                    ruteid TEXT,
+                                    veglenkesekvensid INTEGER )""" )
+            self._conn.execute( """CREATE TABLE IF NOT EXISTS kartlagt (
+                                    ruteid TEXT,
+                                    nr INTEGER,
+                                    nvdbReferenceId INTEGER,
+                                    fromLength REAL,
+                                    toLength REAL,
+                                    direction TEXT,
+                                    kjbane_id INTEGER,
+                                    kjbane_fra REAL,
+                                    kjbane_til REAL )""" )
+            self._conn.execute( """CREATE TABLE IF NOT EXISTS nettversjon (
+                                    veglenkesekvensid INTEGER PRIMARY KEY,
+                                    fingeravtrykk TEXT,
+                                    gyldig_til TEXT )""" )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS rute_vls_vls ON rute_vls ( veglenkesekvensid )" )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS rute_vls_rute ON rute_vls ( ruteid )" )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS kartlagt_rute ON kartlagt ( ruteid )" )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS kartlagt_vt ON kartlagt ( nvdbReferenceId )" )
+
+    def __len__( self ):
+        return self._conn.execute( "SELECT COUNT(*) FROM rute" ).fetchone()[0]
+
+    def close( self ):
+        self._conn.close()
+
+    def legg_til( self, ruteid, linkrefs ):
+        """Adds (or replaces) a route, given by its nvdbReferenceLinks. It is mapped by the next oppdater()"""
+        refs = [ { 'nvdbReferenceId' : int( ref['nvdbReferenceId'] ), 'fromLength' : round( float( ref['fromLength'] ), 8 ),
+                   'toLength' : round( float( ref['toLength'] ), 8 ), 'direction' : ref.get( 'direction' ) }
+                 for ref in linkrefs ]
+        ruteid = str( ruteid )
+        finnes = self._conn.execute( "SELECT linkrefs FROM rute WHERE ruteid = ?", ( ruteid, ) ).fetchone()
+        if finnes is not None and json.loads( finnes[0] ) == refs:
+            return
+        with self._conn:
+            # Beholder den gamle kartleggingen til ruta er kartlagt på nytt, så oppdater() vet hvilke VT-id'er som er berørt
+            self._slett( [ ruteid ], kartlagt=False )
+            self._conn.execute( "INSERT INTO rute ( ruteid, linkrefs, kartlagt ) VALUES ( ?, ?, 0 )",
+                                ( ruteid, json.dumps( refs ) ) )
+            self._conn.executemany( "INSERT INTO rute_vls VALUES ( ?, ? )",
+                                    [ ( ruteid, vid ) for vid in sorted( { ref['nvdbReferenceId'] for ref in refs } ) ] )
+
+    def fjern( self, ruteider ):
+        """Removes routes from the archive. Returns the set of VT link sequence IDs they were mapped to"""
+        ruteider = [ str( r ) for r in ruteider ]
+        vt_ids = self._vt_ids( ruteider )
+        with self._conn:
+            self._slett( ruteider )
+        return vt_ids
+
+    def _slett( self, ruteider, kartlagt=True ):
+        for ruteid in ruteider:
+            for tabell in ( 'rute', 'rute_vls', 'kartlagt' ) if kartlagt else ( 'rute', 'rute_vls' ):
+                self._conn.execute( f"DELETE FROM {tabell} WHERE ruteid = ?", ( ruteid, ) )
+
+    def _vt_ids( self, ruteider ):
+        sql = "SELECT DISTINCT nvdbReferenceId FROM kartlagt WHERE ruteid IN ( SELECT value FROM json_each( ? ) )"
+        return { row[0] for row in self._conn.execute( sql, ( json.dumps( list( ruteider ) ), ) ) }
+
+    def veglenkesekvenser( self ):
+        """All link sequence IDs referenced by the routes in the archive"""
+        return [ row[0] for row in self._conn.execute( "SELECT DISTINCT veglenkesekvensid FROM rute_vls ORDER BY 1" ) ]
+
+    def endrede( self, dato=None ):
+        """Link sequences whose version in the store differs from the one the mapping was built from
+
+        Compares the fingerprints in the store with those recorded at mapping time, and checks if a
+        startdato or sluttdato has passed since. Does not fetch anything, see oppdater.
+
+        RETURNS
+            set of veglenkesekvens IDs
+        """
+        if dato is None:
+            dato = datetime.date.today().isoformat()
+        ids = self.veglenkesekvenser()
+        naa = self.lager.fingeravtrykk( ids )
+        brukt = { vid : ( fp, gyldig_til ) for vid, fp, gyldig_til in
+                  self._conn.execute( "SELECT veglenkesekvensid, fingeravtrykk, gyldig_til FROM nettversjon" ) }
+        endret = set()
+        for vid in ids:
+            if vid not in brukt:
+                continue
+            fp, gyldig_til = brukt[vid]
+            if naa.get( vid ) != fp or ( gyldig_til is not None and gyldig_til <= dato ):
+                endret.add( vid )
+        return endret
+
+    def ruter( self, vls=None, ukartlagte=False ):
+        """Route IDs touching these link sequences (and / or those not mapped yet)"""
+        ruter = set()
+        if vls:
+            sql = "SELECT DISTINCT ruteid FROM rute_vls WHERE veglenkesekvensid IN ( SELECT value FROM json_each( ? ) )"
+            ruter |= { row[0] for row in self._conn.execute( sql, ( json.dumps( sorted( vls ) ), ) ) }
+        if ukartlagte:
+            ruter |= { row[0] for row in self._conn.execute( "SELECT ruteid FROM rute WHERE kartlagt = 0" ) }
+        return ruter
+
+    def oppdater( self, hent=True, dato=None, chunk=10000, verbose=False ):
+        """Brings the mapping up to date with the network: Maps new routes and routes touching changed link sequences
+
+        KEYWORDS
+            hent = True, re-fetch all link sequences of the archive from NVDB api (VeglenkesekvensLager.oppdater).
+            If False, only missing and stale link sequences are fetched (prefetch), use this if the
+            store is kept up to date by some other job. An iterable of IDs re-fetches just those
+
+            dato = None, ISO date string for which road links are active. Default is today
+
+            chunk = 10000, routes mapped per transaction
+
+        RETURNS
+            dictionary with 'endrede' (changed link sequence IDs), 'ruter' (number of routes mapped),
+            'vt_ids' (VT link sequence IDs where the mapped intervals have changed, including
+            intervals that are gone, plus changed VT link sequences the routes use directly)
+            and 'sekunder'
+        """
+        t0 = time.time()
+        if dato is None:
+            dato = datetime.date.today().isoformat()
+        ids = self.veglenkesekvenser()
+
+        with instrumentering.span( 'mappingarkiv.nett' ):
+            if hent is True:
+                self.lager.oppdater( ids )
+            elif hent:
+                self.lager.oppdater( hent )
+            self.lager.prefetch( ids )
+
+        endret = self.endrede( dato=dato )
+        ruter = sorted( self.ruter( endret, ukartlagte=True ) )
+        if verbose:
+            print( f"{len( endret )} changed link sequences, mapping {len( ruter )} of {len( self )} routes" )
+
+        vt_ids = set()
+        for start in range( 0, len( ruter ), chunk ):
+            with instrumentering.span( 'mappingarkiv.kartlegg' ):
+                vt_ids |= self._kartlegg( ruter[start:start+chunk], dato )
+
+        # Endrede VT-sekvenser som rutene peker direkte på gir samme kartlegging, men vegobjektene kan ha endret seg
+        vt_ids |= self._kartlagte_ids( endret )
+
+        instrumentering.tell( 'mappingarkiv.ruter', len( ruter ) )
+        return { 'endrede' : endret, 'ruter' : len( ruter ), 'vt_ids' : vt_ids, 'sekunder' : time.time() - t0 }
+
+    def _kartlegg( self, ruteider, dato ):
+        """Maps one chunk of routes in one go, and records the network versions. Returns affected VT IDs"""
+        sql = "SELECT ruteid, linkrefs FROM rute WHERE ruteid IN ( SELECT value FROM json_each( ? ) )"
+        rader = self._conn.execute( sql, ( json.dumps( ruteider ), ) ).fetchall()
+        sql = "SELECT nvdbReferenceId, fromLength, toLength FROM kartlagt WHERE ruteid IN ( SELECT value FROM json_each( ? ) )"
+        gamle = collections.Counter( self._conn.execute( sql, ( json.dumps( ruteider ), ) ) )
+
+        refs = []
+        rute = []
+        for ruteid, linkrefs in rader:
+            for ref in json.loads( linkrefs ):
+                refs.append( ref )
+                rute.append( ruteid )
+        ids = sorted( { ref['nvdbReferenceId'] for ref in refs } )
+
+        # Alle veglenker (også historiske), så vi vet når settet av aktive lenker endrer seg
+        alle = self.lager.veglenker( ids, aktive=False )
+        per_vid = {}
+        for lenke in alle:
+            per_vid.setdefault( lenke['veglenkesekvensid'], [] ).append( lenke )
+        aktive = [ lenke for lenke in alle if _aktiv( lenke, dato ) ]
+        fingerprints = self.lager.fingeravtrykk( ids )
+
+        res = { 'kilde' : np.zeros( 0, dtype=np.int64 ) }
+        if refs:
+            res = kb2vt.KB2VTIndeks( aktive ).map( [ ref['nvdbReferenceId'] for ref in refs ],
+                                                    [ ref['fromLength'] for ref in refs ],
+                                                    [ ref['toLength'] for ref in refs ] )
+        nye = []
+        nr = {}
+        for ii, kilde in enumerate( res['kilde'].tolist() ):
+            ref = refs[kilde]
+            ruteid = rute[kilde]
+            nr[ruteid] = nr.get( ruteid, -1 ) + 1
+            kjbane = bool( res['kjbane'][ii] )
+            nye.append( ( ruteid, nr[ruteid], int( res['nvdbReferenceId'][ii] ), float( res['fromLength'][ii] ),
+                          float( res['toLength'][ii] ), ref.get( 'direction' ),
+                          ref['nvdbReferenceId'] if kjbane else None, ref['fromLength'] if kjbane else None,
+                          ref['toLength'] if kjbane else None ) )
+
+        with self._conn:
+            for ruteid in ruteider:
+                self._conn.execute( "DELETE FROM kartlagt WHERE ruteid = ?", ( ruteid, ) )
+            self._conn.executemany( "INSERT INTO kartlagt VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )", nye )
+            self._conn.executemany( "UPDATE rute SET kartlagt = 1 WHERE ruteid = ?", [ ( r, ) for r in ruteider ] )
+            self._conn.executemany( "INSERT OR REPLACE INTO nettversjon VALUES ( ?, ?, ? )",
+                                    [ ( vid, fingerprints.get( vid ), _versjon( per_vid.get( vid, [] ), dato ) ) for vid in ids ] )
+
+        # Bare VT-id'er der settet av kartlagte intervall faktisk er endret
+        endring = gamle.copy()
+        endring.subtract( collections.Counter( rad[2:5] for rad in nye ) )
+        return { key[0] for key, antall in endring.items() if antall }
+
+    def _kartlagte_ids( self, ids ):
+        """The subset of ids found as VT link sequence IDs in the mapping"""
+        sql = "SELECT DISTINCT nvdbReferenceId FROM kartlagt WHERE nvdbReferenceId IN ( SELECT value FROM json_each( ? ) )"
+        return { row[0] for row in self._conn.execute( sql, ( json.dumps( sorted( ids ) ), ) ) }
+
+    def kartlagt( self, ruteid ):
+        """The VT level mapping of one route, as a list of dictionaries like kb2vt.kb2vt returns"""
+        sql = """SELECT nvdbReferenceId, fromLength, toLength, direction, kjbane_id, kjbane_fra, kjbane_til
+                 FROM kartlagt WHERE ruteid = ? ORDER BY nr"""
+        resultat = []
+        for vid, fra, til, retning, kid, kfra, ktil in self._conn.execute( sql, ( str( ruteid ), ) ):
+            ref = { 'nvdbReferenceId' : vid, 'fromLength' : fra, 'toLength' : til, 'direction' : retning }
+            if kid is not None:
+                ref['kjbane'] = { 'nvdbReferenceId' : kid, 'fromLength' : kfra, 'toLength' : ktil, 'direction' : retning }
+            resultat.append( ref )
+        return resultat
+
+    def posisjoner( self, vt_ids=None ):
+        """Mapped intervals of all routes, as ( fra, til, veglenkesekvensid ) tuples for nvdbsporring
+
+        KEYWORDS
+            vt_ids = None, only intervals on these VT link sequences. Default is all
+        """
+        sql = "SELECT fromLength, toLength, nvdbReferenceId FROM kartlagt"
+        args = ()
+        if vt_ids is not None:
+            sql += " WHERE nvdbReferenceId IN ( SELECT value FROM json_each( ? ) )"
+            args = ( json.dumps( sorted( int( vid ) for vid in vt_ids ) ), )
+        return self._conn.execute( sql, args ).fetchall()
+
+
+def _gpkgfelt( filnavn, lag ):
+    """Field names of an existing GeoPackage layer, or None if the layer doesn't exist"""
+    if not os.path.exists( filnavn ):
+        return None
+    conn = sqlite3.connect( filnavn )
+    try:
+        if conn.execute( "SELECT 1 FROM gpkg_contents WHERE table_name = ?", ( lag, ) ).fetchone() is None:
+            return None
+        return [ row[1] for row in conn.execute( f'PRAGMA table_info( "{lag}" )' ) ]
+    finally:
+        conn.close()
+
+
+def oppdater_vegobjekter( arkiv, objekttype, filnavn, lag=None, vt_ids=None, crs=5973, **kwargs ):
+    """Updates a GeoPackage layer of road objects along the archived routes, in place
+
+    Rows on the affected VT link sequences are deleted, and road objects along all archived
+    intervals on those link sequences are fetched again (nvdbsporring.hentvegobjekter) and
+    appended. Rows on other link sequences are not touched.
+
+    ARGUMENTS
+        arkiv : MappingArkiv
+
+        objekttype : int, NVDB object type ID, e.g. 105 (speed limit)
+
+        filnavn : GeoPackage file
+
+    KEYWORDS
+        lag = None, layer name. Default is 'vegobjekt<objekttype>', e.g. 'vegobjekt105'
+
+        vt_ids = None, affected VT link sequence IDs, e.g. from MappingArkiv.oppdater()['vt_ids'].
+        None means rebuild the whole layer
+
+        crs = 5973
+
+        Any other keyword (filter, concurrency, hentfunksjon, statistikk ...) is passed to hentvegobjekter
+
+    RETURNS
+        dictionary with 'slettet' and 'skrevet', number of rows deleted and written
+    """
+    import pandas as pd
+    import geopandas as gpd
+    import pyogrio
+    from shapely import wkt
+
+    if lag is None:
+        lag = f"vegobjekt{objekttype}"
+    felt = _gpkgfelt( filnavn, lag )
+    statistikk = { 'slettet' : 0, 'skrevet' : 0 }
+    if vt_ids is not None and not vt_ids:
+        return statistikk
+
+    posisjoner = arkiv.posisjoner( vt_ids )
+    records = list( nvdbsporring.hentvegobjekter( objekttype, posisjoner, **kwargs ) ) if posisjoner else []
+    if vt_ids is not None:
+        # Bare segmentene på de berørte veglenkesekvensene, resten ligger allerede i kartlaget
+        vt_ids = { int( vid ) for vid in vt_ids }
+        records = [ rec for rec in records if 'veglenkesekvensid' not in rec or int( rec['veglenkesekvensid'] ) in vt_ids ]
+
+    if felt is not None:
+        conn = sqlite3.connect( filnavn )
+        try:
+            with conn:
+                if vt_ids is None:
+                    statistikk['slettet'] = conn.execute( f'DELETE FROM "{lag}"' ).rowcount
+                else:
+                    statistikk['slettet'] = conn.execute( f'DELETE FROM "{lag}" WHERE veglenkesekvensid IN ( SELECT value FROM json_each( ? ) )',
+                                                          ( json.dumps( sorted( vt_ids ) ), ) ).rowcount
+        finally:
+            conn.close()
+
+    if not records:
+        return statistikk
+
+    df = pd.DataFrame( records )
+    geometri = df.pop( 'geometri' ).apply( lambda x: wkt.loads( x ) if isinstance( x, str ) else None ) if 'geometri' in df else None
+    if felt is not None:
+        # Samme kolonner som kartlaget allerede har
+        df = df[[ kol for kol in df.columns if kol in felt ]]
+    for kol in df.columns:
+        if df[kol].map( lambda x: isinstance( x, ( list, dict ) ) ).any():
+            df[kol] = df[kol].map( lambda x: json.dumps( x, ensure_ascii=False ) if isinstance( x, ( list, dict ) ) else x )
+    gdf = gpd.GeoDataFrame( df, geometry=geometri, crs=crs )
+    pyogrio.write_dataframe( gdf, filnavn, layer=lag, driver='GPKG', append=felt is not None,
+                             layer_options={ 'SPATIAL_INDEX' : 'YES' } )
+    statistikk['skrevet'] = len( gdf )
+    return statistikk
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser( description='Incremental KB => VT mapping of archived routes, and in-place update of road object layers' )
+    parser.add_argument( 'arkiv', help='SQLite file with the route archive' )
+    parser.add_argument( '--network', default='nvdbnettverk.sqlite', help='SQLite file with the local NVDB network store' )
+    parser.add_argument( '--add', nargs='*', default=[], help='ruteplan response json files to add, one route per alternative' )
+    parser.add_argument( '--no-fetch', action='store_true', help='only fetch missing and stale link sequences' )
+    parser.add_argument( '--gpkg', help='GeoPackage with road object layers to update' )
+    parser.add_argument( '--objekttype', type=int, action='append', help='road object types to update, e.g. 105' )
+    args = parser.parse_args()
+
+    arkiv = MappingArkiv( args.arkiv, nvdbnettverk.VeglenkesekvensLager( args.network ) )
+    for filnavn in args.add:
+        with open( filnavn, encoding='utf-8' ) as f:
+            data = json.load( f )
+        for nr, route in enumerate( data['routes'] ):
+            arkiv.legg_til( f"{os.path.basename( filnavn )}#{nr}", route.get( 'nvdbReferenceLinks', [] ) )
+
+    endring = arkiv.oppdater( hent=not args.no_fetch, verbose=True )
+    print( f"Mapped {endring['ruter']} routes in {endring['sekunder']:.1f} s, {len( endring['vt_ids'] )} VT link sequences affected" )
+    if args.gpkg:
+        for objekttype in args.objekttype or [ 105 ]:
+            res = oppdater_vegobjekter( arkiv, objekttype, args.gpkg, vt_ids=endring['vt_ids'] )
+            print( f"Road object type {objekttype}: deleted {res['slettet']}, wrote {res['skrevet']} rows" )
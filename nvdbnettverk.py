@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+"""Local store of NVDB link sequences (veglenkesekvenser) for the KB => VT mapping
+
+Instead of one sequential http request to /vegnett/veglenkesekvenser/<id> per link sequence
+per route, the link sequences are fetched once, concurrently and over pooled connections,
+and kept in a local SQLite database as flattened road links (veglenker), including the
+superstedfesting fields used to map from "Kjørebane" to "Vegtrasé" topology level. See
+mappingRoute2nvdb.md for the background.
+
+Usage:
+
+    import nvdbnettverk
+    lager = nvdbnettverk.VeglenkesekvensLager( 'nvdbnettverk.sqlite' )
+    lager.prefetch( [ 625977, 625517, 1878200 ] )       # Only missing or stale ones are fetched
+    veglenker = lager.veglenker( [ 625977, 625517, 1878200 ] )
+
+Invalidation: A stored link sequence is considered stale and fetched again by prefetch when
+  * it is older than max_alder seconds (if given), or
+  * one of its links had a sluttdato in the future when it was fetched, and that date has
+    now passed, i.e. the network has changed since we fetched it.
+Use the method oppdater to re-fetch link sequences and find out which ones have actually
+changed (compared by a fingerprint of the link data).
+"""
+
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import instrumentering
+
+
+NVDB_URL = 'https://nvdbapiles-v3.atlas.vegvesen.no/vegnett/veglenkesekvenser/'
+NVDB_HEADERS = { 'accept' : 'application/vnd.vegvesen.nvdb-v3-rev2+json',
+                 'X-Client' : 'nvdbapi.py',
+                 'X-Kontaktperson' : 'jan.kristian.jensen@vegvesen.no' }
+
+# Kolonner i tabellen veglenke, i samme rekkefølge som i flatutveglenke
+VEGLENKEKOLONNER = ( 'veglenkesekvensid', 'veglenkenummer', 'startposisjon', 'sluttposisjon',
+                     'startdato', 'sluttdato', 'type', 'detaljnivå', 'typeVeg', 'geometri',
+                     'super_veglenkesekvensid', 'super_startposisjon', 'super_sluttposisjon',
+                     'super_retning', 'super_felt', 'startnode', 'sluttnode', 'feltoversikt' )
+_KOLONNER = ', '.join( '"' + kol + '"' for kol in VEGLENKEKOLONNER )
+
+
+def flatutveglenke( veglenkesekvensid, lenke ):
+    """Flattens one veglenke element from /vegnett/veglenkesekvenser/<id> into a flat dictionary
+
+    The superstedfesting element is flattened into the super_* fields, the same way as
+    mappingRoute2nvdb.py has always done it.
+    """
+    flat = { 'veglenkesekvensid' : int( veglenkesekvensid ),
+             'veglenkenummer'    : lenke.get( 'veglenkenummer' ),
+             'startposisjon'     : lenke.get( 'startposisjon' ),
+             'sluttposisjon'     : lenke.get( 'sluttposisjon' ),
+             'startdato'         : lenke.get( 'startdato' ),
+             'sluttdato'         : lenke.get( 'sluttdato' ),
+             'type'              : lenke.get( 'type' ),
+             'detaljnivå'        : lenke.get( 'detaljnivå' ),
+             'typeVeg'           : lenke.get( 'typeVeg' ),
+             'geometri'          : lenke.get( 'geometri', {} ).get( 'wkt' ),
+             'super_veglenkesekvensid' : None,
+             'super_startposisjon' : None,
+             'super_sluttposisjon' : None,
+             'super_retning'     : None,
+             'super_felt'        : None,
+             'startnode'         : lenke.get( 'startnode' ),
+             'sluttnode'         : lenke.get( 'sluttnode' ),
+             'feltoversikt'      : ','.join( lenke.get( 'feltoversikt', [] ) ) or None }
+
+    if 'superstedfesting' in lenke:
+        sup = lenke['superstedfesting']
+        flat['super_veglenkesekvensid'] = sup['veglenkesekvensid']
+        flat['super_startposisjon']     = sup['startposisjon']
+        flat['super_sluttposisjon']     = sup['sluttposisjon']
+        flat['super_retning']           = sup.get( 'retning' )
+        flat['super_felt']              = ','.join( sup.get( 'kjørefelt', [] ) )
+
+    return flat
+
+
+def fingeravtrykk( veglenker ):
+    """Fingerprint of the link data of one link sequence, used to detect changes"""
+    relevant = [ { key : lenke.get( key ) for key in ( 'veglenkenummer', 'startposisjon', 'sluttposisjon',
+                                                        'startdato', 'sluttdato', 'superstedfesting' ) }
+                 for lenke in veglenker ]
+    text = json.dumps( relevant, sort_keys=True, ensure_ascii=False )
+    return hashlib.sha1( text.encode( 'utf-8' ) ).hexdigest()
+
+
+class VeglenkesekvensLager:
+    """SQLite store of flattened NVDB road links, with bulk concurrent prefetch
+
+    ARGUMENTS
+        filename : string, path to sqlite file. Use ':memory:' for a non-persistent store
+
+    KEYWORDS
+        url = NVDB_URL, NVDB api endpoint for link sequences
+
+        headers = NVDB_HEADERS, http headers sent to NVDB api
+
+        concurrency = 8, number of concurrent requests in prefetch
+
+        max_alder = None, link sequences older than this many seconds are fetched again
+        by prefetch. None means no age limit
+
+        proxies = None, proxies passed on to requests
+
+    The store may be shared between threads, but fetching is done by prefetch / oppdater only.
+    """
+
+    def __init__( self, filename='nvdbnettverk.sqlite', url=NVDB_URL, headers=NVDB_HEADERS,
+                 concurrency=8, max_alder=None, proxies=None ):
+        self.filename       = filename
+        self.url            = url
+        self.concurrency    = concurrency
+        self.max_alder      = max_alder
+        self.fetched        = 0
+        self.failed         = {}
+        self._lock          = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers.update( headers )
+        if proxies:
+            self.session.proxies.update( proxies )
+        retry = Retry( total=3, backoff_factor=0.5, status_forcelist=( 429, 500, 502, 503, 504 ),
+                      allowed_methods=frozenset( ['GET'] ), raise_on_status=False )
+        adapter = HTTPAdapter( pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry )
+        self.session.mount( 'https://', adapter )
+        self.session.mount( 'http://', adapter )
+
+        self._conn = sqlite3.connect( filename, check_same_thread=False )
+        with self._conn:
+            self._conn.execute( """CREATE TABLE IF NOT EXISTS veglenkesekvens (
+                                    veglenkesekvensid INTEGER PRIMARY KEY,
+                                    hentet REAL,
+                                    gyldig_til TEXT,
+                                    fingeravtrykk TEXT )""" )
+            self._conn.execute( f"""CREATE TABLE IF NOT EXISTS veglenke (
+                                    {_KOLONNER} )""" )
+            # Legger til kolonner som mangler i databaser laget av eldre versjoner
+            finnes = { row[1] for row in self._conn.execute( "PRAGMA table_info( veglenke )" ) }
+            for kol in VEGLENKEKOLONNER:
+                if kol not in finnes:
+                    self._conn.execute( f'ALTER TABLE veglenke ADD COLUMN "{kol}"' )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS veglenke_vls ON veglenke ( veglenkesekvensid )" )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS veglenke_super ON veglenke ( super_veglenkesekvensid )" )
+
+    def _hent( self, veglenkesekvensid ):
+        """Fetches one link sequence from NVDB api. Runs in worker threads"""
+        with instrumentering.span( 'nvdb.vegnett' ) as span:
+            r = self.session.get( self.url + str( veglenkesekvensid ) )
+            span.sett( bytes=len( r.content ), status=r.status_code )
+        if not r.ok:
+            raise ValueError( f"Can't fetch road link ID {veglenkesekvensid} HTTP status={r.status_code} message={ ' '.join( r.text.split() )[:200]}" )
+        return r.json()
+
+    def _lagre( self, veglenkesekvensid, data ):
+        """Replaces one link sequence in the store. Returns the new fingerprint"""
+        veglenker = data.get( 'veglenker', [] )
+        fingerprint = fingeravtrykk( veglenker )
+
+        # Tidligste sluttdato som fortsatt ligger fram i tid => da er lagret kopi utdatert
+        today = datetime.date.today().isoformat()
+        fremtidige = [ lenke['sluttdato'] for lenke in veglenker if lenke.get( 'sluttdato' ) and lenke['sluttdato'] > today ]
+        gyldig_til = min( fremtidige ) if fremtidige else None
+
+        rader = []
+        for lenke in veglenker:
+            flat = flatutveglenke( veglenkesekvensid, lenke )
+            rader.append( tuple( flat[kol] for kol in VEGLENKEKOLONNER ) )
+
+        with self._lock, instrumentering.span( 'nvdb.lagre' ):
+            with self._conn:
+                self._conn.execute( "DELETE FROM veglenke WHERE veglenkesekvensid = ?", ( int( veglenkesekvensid ), ) )
+                self._conn.executemany( f"INSERT INTO veglenke VALUES ( { ','.join( '?' * len( VEGLENKEKOLONNER ) ) } )", rader )
+                self._conn.execute( """INSERT OR REPLACE INTO veglenkesekvens ( veglenkesekvensid, hentet, gyldig_til, fingeravtrykk )
+                                       VALUES ( ?, ?, ?, ? )""", ( int( veglenkesekvensid ), time.time(), gyldig_til, fingerprint ) )
+        return fingerprint
+
+    def fingeravtrykk( self, ids=None ):
+        """Returns dictionary { veglenkesekvensid : fingerprint } for stored link sequences"""
+        with self._lock:
+            rows = self._conn.execute( "SELECT veglenkesekvensid, fingeravtrykk FROM veglenkesekvens" ).fetchall()
+        fingerprints = dict( rows )
+        if ids is not None:
+            fingerprints = { int( vid ) : fingerprints[int( vid )] for vid in ids if int( vid ) in fingerprints }
+        return fingerprints
+
+    def mangler( self, ids ):
+        """Returns the subset of ids that are missing or stale in the store"""
+        ids = { int( vid ) for vid in ids }
+        today = datetime.date.today().isoformat()
+        with self._lock:
+            rows = self._conn.execute( "SELECT veglenkesekvensid, hentet, gyldig_til FROM veglenkesekvens" ).fetchall()
+
+        ferske = set()
+        for vid, hentet, gyldig_til in rows:
+            if self.max_alder is not None and time.time() - hentet > self.max_alder:
+                continue
+            if gyldig_til is not None and gyldig_til <= today:
+                continue
+            ferske.add( vid )
+        return sorted( ids - ferske )
+
+    def _hentmange( self, ids ):
+        """Fetches link sequences concurrently and stores them. Returns { id : fingerprint }"""
+        fingerprints = {}
+        if not ids:
+            return fingerprints
+
+        with ThreadPoolExecutor( max_workers=self.concurrency ) as executor:
+            futures = { executor.submit( self._hent, vid ) : vid for vid in ids }
+            for future in as_completed( futures ):
+                vid = futures[future]
+                try:
+                    fingerprints[vid] = self._lagre( vid, future.result() )
+                    self.fetched += 1
+                    self.failed.pop( vid, None )
+                except Exception as e:
+                    self.failed[vid] = e
+                    print( e )
+        return fingerprints
+
+    def prefetch( self, ids ):
+        """Fetches those link sequences that are missing or stale in the store
+
+        ARGUMENTS
+            ids : iterable of veglenkesekvens IDs (int or string)
+
+        RETURNS
+            list of IDs that were fetched
+        """
+        mangler = self.mangler( ids )
+        hentet = self._hentmange( mangler )
+        return sorted( hentet )
+
+    def oppdater( self, ids=None ):
+        """Re-fetches link sequences and returns the IDs whose link data have changed
+
+        ARGUMENTS
+            ids : iterable of veglenkesekvens IDs. Default is every link sequence in the store
+
+        RETURNS
+            set of IDs with new or changed fingerprint
+        """
+        gamle = self.fingeravtrykk( ids )
+        if ids is None:
+            ids = list( gamle.keys() )
+        nye = self._hentmange( sorted( { int( vid ) for vid in ids } ) )
+        return { vid for vid, fingerprint in nye.items() if gamle.get( vid ) != fingerprint }
+
+    def ugyldiggjor( self, ids ):
+        """Removes link sequences from the store, they will be fetched again by prefetch"""
+        with self._lock:
+            with self._conn:
+                for vid in ids:
+                    self._conn.execute( "DELETE FROM veglenke WHERE veglenkesekvensid = ?", ( int( vid ), ) )
+                    self._conn.execute( "DELETE FROM veglenkesekvens WHERE veglenkesekvensid = ?", ( int( vid ), ) )
+
+    def veglenker( self, ids=None, aktive=True, dato=None ):
+        """Returns flattened road links for these link sequences
+
+        KEYWORDS
+            ids = None, iterable of veglenkesekvens IDs. None means all stored road links
+
+            aktive = True, only return links that are valid at date dato, i.e. ignoring
+            historical (inactive) road links where "sluttdato" has passed
+
+            dato = None, ISO date string, default is today
+
+        RETURNS
+            list of dictionaries, see flatutveglenke
+        """
+
+        sql = f"SELECT {_KOLONNER} FROM veglenke"
+        betingelser = []
+        args = []
+        if aktive:
+            if dato is None:
+                dato = datetime.date.today().isoformat()
+            betingelser.append( "( sluttdato IS NULL OR sluttdato > ? )" )
+            args.append( dato )
+
+        if ids is not None:
+            ids = sorted( { int( vid ) for vid in ids } )
+            betingelser.append( "veglenkesekvensid IN ( SELECT value FROM json_each( ? ) )" )
+            args.append( json.dumps( ids ) )
+
+        if betingelser:
+            sql += ' WHERE ' + ' AND '.join( betingelser )
+        sql += ' ORDER BY veglenkesekvensid, startposisjon'
+
+        with self._lock:
+            rows = self._conn.execute( sql, args ).fetchall()
+        return [ dict( zip( VEGLENKEKOLONNER, row ) ) for row in rows ]
+
+    def close( self ):
+        self.session.close()
+        with self._lock:
+            self._conn.close()
+
+    def __len__( self ):
+        with self._lock:
+            return self._conn.execute( "SELECT COUNT(*) FROM veglenkesekvens" ).fetchone()[0]
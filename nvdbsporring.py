@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""Query planner for fetching NVDB road objects along many linear references
+
+Fetching e.g. speed limits (object type 105) along routes means querying NVDB api with the
+'veglenkesekvens' filter, a comma separated list of linear references like
+'0-0.4@625517,0.4-1@625517'. There is an upper limit for how much text you can fit into an
+HTTP GET query, so the list must be split into chunks. This module
+
+  1. merges overlapping and adjacent intervals per link sequence (across all routes), so
+     '0-0.4@625517' and '0.4-1@625517' become '0-1@625517'
+  2. packs the merged intervals into chunks up to a maximum (url encoded) length, instead
+     of a fixed number of intervals per chunk
+  3. fetches the chunks concurrently, and drops duplicates while streaming, keyed on the
+     segment (nvdbId, versjon, veglenkesekvensid, startposisjon, sluttposisjon): A segment
+     found by more than one chunk is only returned once, while the other segments of an
+     object spanning several link sequences (and thus several chunks) are kept
+
+Usage:
+
+    import nvdbsporring
+    fartsgrense = list( nvdbsporring.hentvegobjekter( 105, mapped_NVDBroadlinklist ) )
+
+By default the chunks are fetched with nvdbapiv3.nvdbFagdata( objekttype, filter=... ).to_records(),
+see https://github.com/LtGlahn/nvdbapi-V3 . Use the keyword hentfunksjon for other ways of
+fetching data.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote_plus
+
+import instrumentering
+
+
+def _intervall( posisjon ):
+    """Returns ( fra, til, veglenkesekvensid ) from a linkref dictionary, tuple or string 'fra-til@id'"""
+    if isinstance( posisjon, str ):
+        strekning, vid = posisjon.split( '@' )
+        fra, til = strekning.split( '-' )
+        fra, til, vid = float( fra ), float( til ), int( vid )
+    elif isinstance( posisjon, dict ):
+        fra, til, vid = posisjon['fromLength'], posisjon['toLength'], int( posisjon['nvdbReferenceId'] )
+    else:
+        fra, til, vid = posisjon
+        vid = int( vid )
+    fra, til = round( float( fra ), 8 ), round( float( til ), 8 )
+    return min( fra, til ), max( fra, til ), vid
+
+
+def formater( fra, til, veglenkesekvensid ):
+    """Linear reference as text, e.g. '0.37648714-0.72087082@605474'"""
+    tall = lambda x: f"{x:.8f}".rstrip( '0' ).rstrip( '.' )
+    return f"{tall( fra )}-{tall( til )}@{int( veglenkesekvensid )}"
+
+
+def slaasammen( posisjoner ):
+    """Merges overlapping and adjacent intervals per link sequence
+
+    ARGUMENTS
+        posisjoner : iterable of linear references, either as dictionaries with nvdbReferenceId,
+        fromLength and toLength (e.g. the ruteplan nvdbReferenceLinks or output from kb2vt),
+        tuples ( fra, til, veglenkesekvensid ) or strings 'fra-til@veglenkesekvensid'
+
+    RETURNS
+        list of tuples ( fra, til, veglenkesekvensid ), sorted by link sequence and position
+    """
+    intervaller = sorted( ( _intervall( p ) for p in posisjoner ), key=lambda x: ( x[2], x[0], x[1] ) )
+
+    resultat = []
+    for fra, til, vid in intervaller:
+        if resultat and resultat[-1][2] == vid and fra <= resultat[-1][1]:
+            if til > resultat[-1][1]:
+                resultat[-1] = ( resultat[-1][0], til, vid )
+        else:
+            resultat.append( ( fra, til, vid ) )
+    return resultat
+
+
+def pakk( intervaller, maks_lengde=3000 ):
+    """Packs intervals into chunks, each fitting within maks_lengde characters when url encoded
+
+    ARGUMENTS
+        intervaller : list of tuples ( fra, til, veglenkesekvensid ), see slaasammen
+
+    KEYWORDS
+        maks_lengde = 3000, max length of the url encoded value of the 'veglenkesekvens' parameter
+
+    RETURNS
+        list of strings, each a comma separated list of linear references
+    """
+    komma = len( quote_plus( ',' ) )
+    chunks = []
+    chunk = []
+    lengde = 0
+    for intervall in intervaller:
+        tekst = formater( *intervall )
+        tekstlengde = len( quote_plus( tekst ) )
+        if chunk and lengde + komma + tekstlengde > maks_lengde:
+            chunks.append( ','.join( chunk ) )
+            chunk = []
+            lengde = 0
+        lengde += tekstlengde + ( komma if chunk else 0 )
+        chunk.append( tekst )
+
+    if chunk:
+        chunks.append( ','.join( chunk ) )
+    return chunks
+
+
+def planlegg( posisjoner, maks_lengde=3000 ):
+    """Merges and packs linear references into as few 'veglenkesekvens' filter values as possible
+
+    See slaasammen and pakk
+
+    RETURNS
+        list of strings, each a comma separated list of linear references
+    """
+    return pakk( slaasammen( posisjoner ), maks_lengde=maks_lengde )
+
+
+def _nvdbapiv3_records( objekttype, filter ):
+    """Default fetch function, using the nvdbapiv3 library"""
+    import nvdbapiv3
+    return nvdbapiv3.nvdbFagdata( objekttype, filter=filter ).to_records()
+
+
+def _hentchunk( hentfunksjon, objekttype, filter ):
+    """Fetches one chunk, as a list. Runs in worker threads"""
+    with instrumentering.span( 'nvdb.vegobjekter', objekttype=objekttype ) as span:
+        records = list( hentfunksjon( objekttype, filter ) )
+        span.sett( records=len( records ) )
+    return records
+
+
+def hentvegobjekter( objekttype, posisjoner, filter={}, maks_lengde=3000, concurrency=4,
+                    hentfunksjon=_nvdbapiv3_records, statistikk=None ):
+    """Fetches NVDB road objects of any type along a set of linear references
+
+    Generator, yields records (dictionaries) as the chunks complete. A record is one segment
+    of an object, and later copies of the same segment (nvdbId, versjon, veglenkesekvensid,
+    startposisjon, sluttposisjon) are dropped. Objects spanning several link sequences may
+    be found by different chunks, and keep all their segments.
+
+    ARGUMENTS
+        objekttype : int, NVDB object type ID, e.g. 105 (speed limit)
+
+        posisjoner : iterable of linear references, see slaasammen
+
+    KEYWORDS
+        filter = {}, additional filters passed on to NVDB api
+
+        maks_lengde = 3000, max length of each url encoded 'veglenkesekvens' filter value
+
+        concurrency = 4, number of concurrent requests
+
+        hentfunksjon = function( objekttype, filter ) returning an iterable of records with the
+        keys nvdbId and versjon, and normally the segment keys veglenkesekvensid,
+        startposisjon and sluttposisjon. Default is nvdbapiv3.nvdbFagdata( ... ).to_records()
+
+        statistikk = None, or a dictionary that will be updated with the keys 'chunks',
+        'records' and 'duplikater'
+
+    RETURNS
+        generator of records
+    """
+
+    chunks = planlegg( posisjoner, maks_lengde=maks_lengde )
+    if statistikk is None:
+        statistikk = {}
+    statistikk.update( { 'chunks' : len( chunks ), 'records' : 0, 'duplikater' : 0 } )
+
+    sett = set()
+    with ThreadPoolExecutor( max_workers=concurrency ) as executor:
+        futures = [ executor.submit( _hentchunk, hentfunksjon, objekttype, dict( filter, veglenkesekvens=chunk ) )
+                    for chunk in chunks ]
+        for future in as_completed( futures ):
+            for record in future.result():
+                key = ( record['nvdbId'], record['versjon'], record.get( 'veglenkesekvensid' ),
+                        record.get( 'startposisjon' ), record.get( 'sluttposisjon' ) )
+                if key in sett:
+                    statistikk['duplikater'] += 1
+                    instrumentering.tell( 'nvdb.duplikater' )
+                    continue
+                sett.add( key )
+                statistikk['records'] += 1
+                instrumentering.tell( 'nvdb.segmenter' )
+                yield record
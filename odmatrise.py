@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+"""Origin-destination (OD) cost matrices from the ruteplan API
+
+Point-to-point routing of N origins and M destinations needs N*M calls (N*M/2 if the
+costs are symmetric), which does not scale. This module covers the matrix with as
+few calls as possible:
+
+  * Repeated points are deduplicated before any call is made
+  * All destinations of one origin are sent in a single call to the one-to-many
+    endpoint of the ruteplan service, i.e. ~N calls for an N x M matrix
+  * If the caller says costs are symmetric, each unordered pair is routed only once
+    and mirrored. Pairs between two origins or two destinations are never routed
+
+Only the 'statistic' block of each route is kept, and the result is a set of compact
+NumPy arrays (one N x M array per cost field), so memory is proportional to the matrix
+and not to the route geometries.
+
+Usage:
+
+    import odmatrise
+    depoter = [ (262819.18, 6649657.89), (260805.98, 6649240.36) ]
+    kunder  = [ (262796.12, 6647150.74), (262449.77, 6649115.56), (262819.18, 6649657.89) ]
+    mat = odmatrise.odmatrise( depoter, kunder )
+    print( mat['totalLength'] )
+
+The url of the one-to-many endpoint is read from the element 'url_en_til_mange' in the
+credentials file. If missing, it is derived from the 'url' element by replacing the
+final 'best' with 'OneToMany', e.g. .../api/Route/best => .../api/Route/OneToMany.
+Please check the swagger documentation (see README.md) if that does not work for your
+version of the service.
+
+The one-to-many request is sent with stops='origin;destination1;destination2;...', and
+the response is expected to hold one element in 'routes' per destination, in the same
+order as the stops. Use en_til_mange=False to route each pair with the point-to-point
+endpoint instead.
+"""
+
+import copy
+
+import numpy as np
+
+import ruteplan
+import ruteplanbatch
+
+
+# Felt fra "statistic"-elementet som vi tar vare på
+STATISTIKKFELT = ( 'totalLength', 'totalDriveTime', 'tollSmall', 'tollLarge' )
+
+
+def _stopstring( punkter ):
+    return ';'.join( ','.join( str( px ) for px in punkt ) for punkt in punkter )
+
+
+def _unike( punkter ):
+    """Returns list of unique points and array mapping each input point to its unique index"""
+    unike = []
+    oppslag = {}
+    indeks = np.empty( len( punkter ), dtype=np.int64 )
+    for ii, punkt in enumerate( punkter ):
+        key = tuple( float( px ) for px in punkt )
+        if key not in oppslag:
+            oppslag[key] = len( unike )
+            unike.append( key )
+        indeks[ii] = oppslag[key]
+    return unike, indeks
+
+
+def _statistikk( rute, felt ):
+    """Henter tallverdier fra statistic-elementet. Some values are returned as strings by the API"""
+    statistic = rute.get( 'statistic', {} )
+    verdier = []
+    for navn in felt:
+        try:
+            verdier.append( float( statistic[navn] ) )
+        except ( KeyError, TypeError, ValueError ):
+            verdier.append( np.nan )
+    return verdier
+
+
+def enmangeurl( klient ):
+    """Url to the one-to-many endpoint for this client, see module documentation"""
+    if 'url_en_til_mange' in klient.credentials:
+        return klient.credentials['url_en_til_mange']
+
+    url = klient.url.rstrip( '/' )
+    if not url.endswith( '/best' ):
+        raise ValueError( f"Can't derive one-to-many url from {klient.url}, please add 'url_en_til_mange' to the credentials file" )
+    return url[:-len( 'best' )] + 'OneToMany'
+
+
+def planlegg( norigins, ndestinations, symmetric=False ):
+    """Decides which (origin, destinations) calls are needed to cover the matrix
+
+    With symmetric=True origins and destinations must be the same list of unique points,
+    and only the upper triangle (excluding the diagonal) is routed.
+
+    ARGUMENTS
+        norigins, ndestinations : int, number of unique origins and destinations
+
+    KEYWORDS
+        symmetric = False, see above
+
+    RETURNS
+        list of tuples ( origin index, numpy array of destination indices )
+    """
+    plan = []
+    for ii in range( norigins ):
+        if symmetric:
+            dest = np.arange( ii+1, ndestinations, dtype=np.int64 )
+        else:
+            dest = np.arange( ndestinations, dtype=np.int64 )
+        if len( dest ):
+            plan.append( ( ii, dest ) )
+    return plan
+
+
+def planlegg_symmetrisk( origins, destinations ):
+    """Plan for symmetric costs when origins and destinations are different sets of points
+
+    Only origin => destination pairs are routed. A pair is skipped when its mirror (the
+    destination as origin, the origin as destination) is also asked for and is routed
+    from an earlier origin, and pairs of the same point get cost 0.
+
+    ARGUMENTS
+        origins, destinations : lists of unique points (tuples)
+
+    RETURNS
+        tuple ( plan, speil, null ):
+            plan : list of tuples ( origin index, numpy array of destination indices )
+            speil : numpy array with rows ( origin, destination, mirror origin, mirror destination )
+                    for the pairs that are copied from their mirror
+            null : numpy array with rows ( origin, destination ) for pairs of the same point
+    """
+    fra_posisjon = { punkt : ii for ii, punkt in enumerate( origins ) }
+    til_posisjon = { punkt : jj for jj, punkt in enumerate( destinations ) }
+    # Indeks som startpunkt for hvert målpunkt, -1 hvis målpunktet ikke også er et startpunkt
+    som_fra = np.asarray( [ fra_posisjon.get( punkt, -1 ) for punkt in destinations ], dtype=np.int64 )
+    alle = np.arange( len( destinations ), dtype=np.int64 )
+
+    plan = []
+    speil = []
+    null = []
+    for ii, punkt in enumerate( origins ):
+        kk = til_posisjon.get( punkt )
+        if kk is None:
+            # Speilingen av paret er ikke etterspurt, alle må rutes
+            dest = alle
+        else:
+            hopp = ( som_fra >= 0 ) & ( som_fra < ii )
+            hopp[kk] = True
+            null.append( ( ii, kk ) )
+            skip = np.flatnonzero( hopp & ( alle != kk ) )
+            speil.extend( ( ii, jj, som_fra[jj], kk ) for jj in skip.tolist() )
+            dest = alle[~hopp]
+        if len( dest ):
+            plan.append( ( ii, dest ) )
+    return ( plan, np.asarray( speil, dtype=np.int64 ).reshape( -1, 4 ),
+             np.asarray( null, dtype=np.int64 ).reshape( -1, 2 ) )
+
+
+def odmatrise( origins, destinations=None, klient=None, symmetric=False, en_til_mange=True,
+              ruteplanparams={}, felt=STATISTIKKFELT, dtype=np.float32, max_destinasjoner=200,
+              concurrency=4, ratelimiter=None ):
+    """Computes an origin-destination cost matrix
+
+    ARGUMENTS
+        origins : list of (x,y) tuples
+
+    KEYWORDS
+        destinations = None, list of (x,y) tuples. None means the same as origins
+
+        klient = None, ruteplan.RuteplanClient instance. Default is ruteplan.standardklient()
+
+        symmetric = False, set to True if cost(a,b) == cost(b,a). Each unordered pair of
+        points is then routed only once. If origins and destinations are the same set of
+        points only the upper triangle is routed, otherwise only origin => destination pairs
+        (skipping those whose mirror is routed anyway)
+
+        en_til_mange = True, use the one-to-many endpoint (one call per origin). If False,
+        each pair is routed with the point-to-point endpoint of the client
+
+        ruteplanparams = {}, extra parameters for the ruteplan API (not 'stops')
+
+        felt = STATISTIKKFELT, which fields from the 'statistic' block to return
+
+        dtype = np.float32, data type of the cost arrays
+
+        max_destinasjoner = 200, max number of destinations per one-to-many call
+
+        concurrency = 4, number of concurrent calls, see ruteplanbatch.rutebatch
+
+        ratelimiter = None, ruteplanbatch.TokenBucket instance
+
+    RETURNS
+        dictionary with one N x M numpy array per field in felt (NaN where routing failed,
+        0 for pairs of the same point in symmetric matrices), plus the keys
+            'calls' : number of calls sent to the ruteplan API (or answered from cache)
+            'errors' : list of ( origin index, destination indices, exception ) for failed calls.
+                        The indices refer to the deduplicated points
+    """
+
+    if destinations is None:
+        destinations = origins
+
+    if klient is None:
+        klient = ruteplan.standardklient()
+
+    unike_fra, fra_indeks = _unike( origins )
+    unike_til, til_indeks = _unike( destinations )
+
+    trekant = symmetric and set( unike_fra ) == set( unike_til )
+    speil = null = None
+    if trekant:
+        # Samme punktmengde som start og mål: Bare øvre trekant rutes
+        posisjon = { punkt : ii for ii, punkt in enumerate( unike_fra ) }
+        til_indeks = np.asarray( [ posisjon[punkt] for punkt in unike_til ], dtype=np.int64 )[til_indeks]
+        unike_til = unike_fra
+        plan = planlegg( len( unike_fra ), len( unike_til ), symmetric=True )
+    elif symmetric:
+        # Ulike punktmengder: Bare start => mål, og par hvis speiling allerede er rutet hoppes over
+        plan, speil, null = planlegg_symmetrisk( unike_fra, unike_til )
+    else:
+        plan = planlegg( len( unike_fra ), len( unike_til ) )
+
+    if en_til_mange:
+        rutingklient = copy.copy( klient )
+        rutingklient.url = enmangeurl( klient )
+        jobber = []
+        for ii, dest in plan:
+            for start in range( 0, len( dest ), max_destinasjoner ):
+                jobber.append( ( ii, dest[start:start+max_destinasjoner] ) )
+    else:
+        rutingklient = klient
+        jobber = [ ( ii, dest[jj:jj+1] ) for ii, dest in plan for jj in range( len( dest ) ) ]
+
+    inputs = ( { 'ruteplanparams' : dict( ruteplanparams, stops=_stopstring( [ unike_fra[ii] ] + [ unike_til[jj] for jj in dest ] ) ) }
+               for ii, dest in jobber )
+
+    kost = np.full( ( len( felt ), len( unike_fra ), len( unike_til ) ), np.nan, dtype=dtype )
+    errors = []
+    for res in ruteplanbatch.rutebatch( inputs, klient=rutingklient, concurrency=concurrency,
+                                       ratelimiter=ratelimiter, ordered=False, parse='response' ):
+        ii, dest = jobber[res['index']]
+        try:
+            if res['error']:
+                raise res['error']
+            r = res['data']
+            if not r.ok:
+                raise ValueError( f"Invalid response from ruteplan: {r.status_code} {r.reason} {r.url}" )
+            data = r.json()
+            if 'messages' in data.keys():
+                raise ValueError( str( data['messages'] ) + ' ' + r.url )
+            if len( data['routes'] ) != len( dest ):
+                raise ValueError( f"Expected {len(dest)} routes from ruteplan, got {len(data['routes'])}" )
+            for jj, rute in zip( dest, data['routes'] ):
+                kost[:, ii, jj] = _statistikk( rute, felt )
+        except Exception as e:
+            errors.append( ( ii, dest, e ) )
+
+    if trekant:
+        # Bare øvre trekant er beregnet, speiler til nedre trekant
+        for kk in range( len( felt ) ):
+            kost[kk] = np.where( np.isnan( kost[kk] ), kost[kk].T, kost[kk] )
+            np.fill_diagonal( kost[kk], 0 )
+    elif symmetric:
+        kost[:, speil[:, 0], speil[:, 1]] = kost[:, speil[:, 2], speil[:, 3]]
+        kost[:, null[:, 0], null[:, 1]] = 0
+
+    result = { navn : kost[kk][np.ix_( fra_indeks, til_indeks )] for kk, navn in enumerate( felt ) }
+    result['calls'] = len( jobber )
+    result['errors'] = errors
+    return result
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""Columnar representation of many ruteplan responses
+
+ruteplan2dict returns one dictionary with a shapely LineString per geometry element,
+which is slow and memory hungry when you have thousands of routes. RouteBatch instead
+keeps all coordinates in ONE contiguous NumPy buffer with an offset array per feature
+(GeoArrow style ragged layout), and the per-feature attributes as typed arrays:
+
+    coords       (K, dims) float64 (or int32) array, all coordinates of all features
+    offsets      (F+1,) int64 array, coordinates of feature ii are coords[offsets[ii]:offsets[ii+1]]
+    route        (F,) int32, index of the response (i.e. the call to ruteplan) in the batch
+    alternative  (F,) int8, route alternative number (rutealternativNr)
+    time, length (F,) float32
+    maneuverType (F,) int16 codes into the list maneuverTypes, -1 if the feature has none
+
+Route level data (from the 'statistic' block) are kept once per route alternative in
+the dictionary of arrays RouteBatch.routes, and are not repeated on every feature.
+
+Shapely geometries are only created when asked for, in bulk with the vectorized
+constructors of shapely 2.
+
+Usage:
+
+    from rutekolonner import RouteBatch
+    batch = RouteBatch.from_responses( [ r1, r2, r3 ] )
+    gdf = batch.to_geopandas()
+    table = batch.to_arrow()
+"""
+
+import numpy as np
+import shapely
+
+import ruteplan
+
+
+# Felt fra "statistic"-elementet som lagres per ruteforslag
+RUTESTATISTIKK = ( 'totalLength', 'totalDriveTime', 'totalTime', 'tollSmall', 'tollLarge' )
+
+
+def _tall( verdi ):
+    """Some statistic values are returned as strings by the API"""
+    try:
+        return float( verdi )
+    except ( TypeError, ValueError ):
+        return np.nan
+
+
+class RouteBatch:
+    """Columnar container for the features of many ruteplan responses
+
+    Create instances with one of the constructors from_responses, from_data or concat.
+    """
+
+    def __init__( self, coords, offsets, route, alternative, time, length, maneuverType,
+                 maneuverTypes, routes, nroutes=None ):
+        self.coords         = coords
+        self.offsets        = offsets
+        self.route          = route
+        self.alternative    = alternative
+        self.time           = time
+        self.length         = length
+        self.maneuverType   = maneuverType
+        self.maneuverTypes  = maneuverTypes
+        self.routes         = routes
+        # Svar uten ruter teller også, ellers forskyves rutenumrene i concat
+        if nroutes is None:
+            nroutes = int( routes['route'].max() ) + 1 if len( routes['route'] ) else 0
+        self._nroutes       = nroutes
+
+    @classmethod
+    def from_responses( cls, responses, dtype=np.float64 ):
+        """Builds RouteBatch from an iterable of requests response objects
+
+        ARGUMENTS
+            responses : iterable of response objects from ruteplan.anropruteplan / RuteplanClient.route
+
+        KEYWORDS
+            dtype = np.float64, data type of the coordinate buffer. Use np.int32 to halve
+            memory if coordinates are whole meters (as they are from ruteplan V3)
+        """
+        return cls.from_data( ( ruteplan.lesrespons( r ) for r in responses ), dtype=dtype )
+
+    @classmethod
+    def from_data( cls, datalist, dtype=np.float64 ):
+        """Builds RouteBatch from an iterable of decoded ruteplan responses (dictionaries)
+
+        See from_responses
+        """
+
+        coordchunks     = []
+        lengths         = []
+        route           = []
+        alternative     = []
+        time            = []
+        length          = []
+        maneuverType    = []
+        oppslag         = {}
+        routes          = { 'route' : [], 'rutealternativNr' : [], 'routeName' : [] }
+        routes.update( { navn : [] for navn in RUTESTATISTIKK } )
+        nroutes         = 0
+
+        for ii, data in enumerate( datalist ):
+            nroutes = ii + 1
+            for alt, rute in enumerate( data['routes'] ):
+
+                routes['route'].append( ii )
+                routes['rutealternativNr'].append( alt )
+                routes['routeName'].append( rute.get( 'routeName' ) )
+                statistic = rute.get( 'statistic', {} )
+                for navn in RUTESTATISTIKK:
+                    routes[navn].append( _tall( statistic.get( navn ) ) )
+
+                punkter = []
+                for feature in rute['features']:
+                    if feature['geometry']['type'] != 'LineString':
+                        raise ValueError( f"Only LineString geometries are supported, got {feature['geometry']['type']}" )
+                    coordinates = feature['geometry']['coordinates']
+                    punkter.extend( coordinates )
+                    lengths.append( len( coordinates ) )
+
+                    props = feature['properties']
+                    route.append( ii )
+                    alternative.append( alt )
+                    time.append( props.get( 'time', np.nan ) )
+                    length.append( props.get( 'length', np.nan ) )
+                    maneuver = props.get( 'maneuverType' )
+                    if maneuver is None:
+                        maneuverType.append( -1 )
+                        continue
+                    if maneuver not in oppslag:
+                        oppslag[maneuver] = len( oppslag )
+                    maneuverType.append( oppslag[maneuver] )
+
+                # Én numpy-array per ruteforslag, så slipper vi å holde alle koordinatene som python-lister
+                if punkter:
+                    coordchunks.append( np.asarray( punkter, dtype=dtype ) )
+
+        if coordchunks:
+            coords = np.concatenate( coordchunks )
+        else:
+            coords = np.empty( ( 0, 2 ), dtype=dtype )
+
+        offsets = np.zeros( len( lengths ) + 1, dtype=np.int64 )
+        np.cumsum( lengths, out=offsets[1:] )
+
+        routes['route']             = np.asarray( routes['route'], dtype=np.int32 )
+        routes['rutealternativNr']  = np.asarray( routes['rutealternativNr'], dtype=np.int8 )
+        routes['routeName']         = np.asarray( routes['routeName'], dtype=object )
+        for navn in RUTESTATISTIKK:
+            routes[navn] = np.asarray( routes[navn], dtype=np.float64 )
+
+        return cls( coords, offsets,
+                    np.asarray( route, dtype=np.int32 ),
+                    np.asarray( alternative, dtype=np.int8 ),
+                    np.asarray( time, dtype=np.float32 ),
+                    np.asarray( length, dtype=np.float32 ),
+                    np.asarray( maneuverType, dtype=np.int16 ),
+                    list( oppslag.keys() ),
+                    routes, nroutes=nroutes )
+
+    @classmethod
+    def concat( cls, batches ):
+        """Concatenates several RouteBatch objects. Route numbers are renumbered consecutively"""
+
+        batches = list( batches )
+        if not batches:
+            return cls.from_data( [] )
+
+        maneuverTypes = []
+        oppslag = {}
+        offsets = [ np.zeros( 1, dtype=np.int64 ) ]
+        route = []
+        maneuverType = []
+        routes = { key : [] for key in batches[0].routes }
+        nroutes = 0
+        ncoords = 0
+
+        for batch in batches:
+            for navn in batch.maneuverTypes:
+                if navn not in oppslag:
+                    oppslag[navn] = len( maneuverTypes )
+                    maneuverTypes.append( navn )
+            remap = np.asarray( [ oppslag[navn] for navn in batch.maneuverTypes ] + [ -1 ], dtype=np.int16 )
+            # Kode -1 (mangler) peker på siste element, som er -1
+            maneuverType.append( remap[batch.maneuverType] )
+
+            offsets.append( batch.offsets[1:] + ncoords )
+            route.append( batch.route + nroutes )
+            for key in routes:
+                routes[key].append( batch.routes[key] + nroutes if key == 'route' else batch.routes[key] )
+
+            ncoords += len( batch.coords )
+            nroutes += batch.nroutes
+
+        return cls( np.concatenate( [ b.coords for b in batches ] ),
+                    np.concatenate( offsets ),
+                    np.concatenate( route ),
+                    np.concatenate( [ b.alternative for b in batches ] ),
+                    np.concatenate( [ b.time for b in batches ] ),
+                    np.concatenate( [ b.length for b in batches ] ),
+                    np.concatenate( maneuverType ),
+                    maneuverTypes,
+                    { key : np.concatenate( value ) for key, value in routes.items() },
+                    nroutes=nroutes )
+
+    def __len__( self ):
+        return len( self.offsets ) - 1
+
+    @property
+    def nroutes( self ):
+        """Number of responses (calls to ruteplan) in this batch, including responses without routes"""
+        return self._nroutes
+
+    @property
+    def nbytes( self ):
+        """Approximate memory use of the arrays, in bytes"""
+        arrays = [ self.coords, self.offsets, self.route, self.alternative, self.time, self.length,
+                   self.maneuverType ] + list( self.routes.values() )
+        return sum( a.nbytes for a in arrays )
+
+    def coordinates( self, ii ):
+        """Coordinates of feature ii, as a view into the coordinate buffer"""
+        return self.coords[self.offsets[ii]:self.offsets[ii+1]]
+
+    def geometries( self ):
+        """Returns numpy array of shapely LineStrings, built in bulk
+
+        One geometry per feature. Features with less than two coordinates get an empty LineString
+        """
+        antall = np.diff( self.offsets )
+        gyldig = antall >= 2
+        if gyldig.all():
+            indices = np.repeat( np.arange( len( self ) ), antall )
+            return shapely.linestrings( self.coords, indices=indices )
+
+        resultat = np.full( len( self ), shapely.LineString(), dtype=object )
+        if gyldig.any():
+            indices = np.repeat( np.arange( gyldig.sum() ), antall[gyldig] )
+            resultat[gyldig] = shapely.linestrings( self.coords[np.repeat( gyldig, antall )], indices=indices )
+        return resultat
+
+    def to_pandas( self ):
+        """Per-feature attributes as a pandas DataFrame, without geometry"""
+        import pandas as pd
+
+        return pd.DataFrame( {
+            'route'             : self.route,
+            'rutealternativNr'  : self.alternative,
+            'time'              : self.time,
+            'length'            : self.length,
+            'maneuverType'      : pd.Categorical.from_codes( self.maneuverType, categories=self.maneuverTypes ),
+        }, copy=False )
+
+    def routes_pandas( self ):
+        """Route level data (one row per route alternative) as a pandas DataFrame"""
+        import pandas as pd
+        return pd.DataFrame( self.routes, copy=False )
+
+    def to_geopandas( self, crs=5973 ):
+        """Per-feature attributes and geometries as a GeoDataFrame"""
+        import geopandas as gpd
+        return gpd.GeoDataFrame( self.to_pandas(), geometry=self.geometries(), crs=crs )
+
+    def to_arrow( self ):
+        """Per-feature attributes and geometry as a pyarrow Table
+
+        The geometry column uses the GeoArrow native linestring encoding with interleaved
+        coordinates, and shares memory with the coordinate buffer (float64 coordinates only)
+        """
+        import pyarrow as pa
+
+        dims = self.coords.shape[1] if self.coords.ndim == 2 else 2
+        flat = np.ascontiguousarray( self.coords, dtype=np.float64 ).reshape( -1 )
+        points = pa.FixedSizeListArray.from_arrays( pa.array( flat ), dims )
+        if self.offsets[-1] < np.iinfo( np.int32 ).max:
+            geometry = pa.ListArray.from_arrays( pa.array( self.offsets.astype( np.int32 ) ), points )
+        else:
+            geometry = pa.LargeListArray.from_arrays( pa.array( self.offsets ), points )
+
+        felt = [ pa.field( 'geometry', geometry.type,
+                          metadata={ b'ARROW:extension:name' : b'geoarrow.linestring' } ) ]
+        kolonner = [ geometry ]
+        for navn, values in ( ( 'route', self.route ), ( 'rutealternativNr', self.alternative ),
+                              ( 'time', self.time ), ( 'length', self.length ) ):
+            felt.append( pa.field( navn, pa.from_numpy_dtype( values.dtype ) ) )
+            kolonner.append( pa.array( values ) )
+
+        maneuver = pa.DictionaryArray.from_arrays( pa.array( self.maneuverType, mask=self.maneuverType < 0 ),
+                                                   pa.array( self.maneuverTypes, type=pa.string() ) )
+        felt.append( pa.field( 'maneuverType', maneuver.type ) )
+        kolonner.append( maneuver )
+
+        return pa.Table.from_arrays( kolonner, schema=pa.schema( felt ) )
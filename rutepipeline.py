@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+
+"""Resumable streaming pipeline: Origin/destination pairs from CSV/Parquet => routes in GeoPackage/Parquet
+
+Routes every origin/destination pair of an input file with ruteplan (concurrently, via
+ruteplanbatch.rutebatch and the same client as anropruteplan), and writes the features in
+batches of bounded size as they come in:
+
+  * GeoPackage: each batch is appended to the layer in one transaction, with spatial index
+  * Parquet: each batch is written as one part file (part-000001.parquet, ...) in the
+    output directory, i.e. a partitioned GeoParquet data set
+
+After each batch is written, a line is appended to the checkpoint file (default: output
+name + '.checkpoint'), recording how many input rows are done and which pairs failed. If
+the job stops (crash, network trouble, daily quota used up) a rerun with the same
+arguments removes any batch written after the last checkpoint and resumes with the next
+input row. Nothing but the current batch (and the window of calls in flight) is held in
+memory, so memory use is flat regardless of the size of the input.
+
+Pairs that ruteplan can't route (e.g. no route found) are recorded in the checkpoint file
+and skipped, see lesfeil(). Transient trouble (network errors, HTTP 429 / 5xx after the
+retries, daily quota used up) stops the job instead, so the pairs are tried again on rerun.
+
+The input has one row per pair, with the coordinates in the columns fra_x, fra_y, til_x,
+til_y (use --columns for other names) and optionally an id column. Command line:
+
+    python rutepipeline.py par.csv ruter.gpkg --id-column id --batch-size 500 --concurrency 4
+    python rutepipeline.py par.parquet ruter_parquet --rate 5 --daily-limit 2500 --quota-file kvote.json
+
+or from python:
+
+    import rutepipeline
+    statistikk = rutepipeline.kjor( 'par.csv', 'ruter.gpkg', id_kolonne='id' )
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sqlite3
+
+import requests
+from shapely.geometry import shape
+
+import ruteplan
+import ruteplanbatch
+import instrumentering
+from rutekolonner import RUTESTATISTIKK
+
+
+KOORDINATKOLONNER = ( 'fra_x', 'fra_y', 'til_x', 'til_y' )
+
+# Fast skjema for utdata, så alle batcher kan skrives til samme lag / samme parquet-datasett
+KOLONNER = ( 'par', 'rad', 'batch', 'rutealternativNr', 'routeName', 'time', 'length',
+             'maneuverType', 'maneuverText' ) + RUTESTATISTIKK
+
+
+def lespar( filnavn, id_kolonne=None, kolonner=KOORDINATKOLONNER, start=0, delimiter=None ):
+    """Streams origin/destination pairs from a CSV or Parquet file, or a directory of Parquet files
+
+    KEYWORDS
+        id_kolonne = None, column with the id of each pair. Default is the row number
+
+        kolonner = ( 'fra_x', 'fra_y', 'til_x', 'til_y' ), coordinate columns
+
+        start = 0, skip this many rows
+
+        delimiter = None, CSV delimiter. Default is to detect ',' or ';'
+
+    RETURNS
+        generator of tuples ( row number, pair id, (fra_x, fra_y), (til_x, til_y) )
+    """
+    if filnavn.lower().endswith( '.parquet' ) or os.path.isdir( filnavn ):
+        navn = list( kolonner ) + ( [ id_kolonne ] if id_kolonne else [] )
+        if os.path.isdir( filnavn ):
+            # Partisjonert datasett, f.eks. utdata fra rutepipeline. Part-filene leses i sortert rekkefølge,
+            # så radnumrene blir de samme ved omstart. Halvskrevne *.tmp-filer hoppes over
+            import pyarrow.dataset as ds
+            filer = sorted( f for f in ds.dataset( filnavn, format='parquet' ).files if f.endswith( '.parquet' ) )
+            batcher = ds.dataset( filer, format='parquet' ).to_batches( columns=navn, batch_size=10000 )
+        else:
+            import pyarrow.parquet as pq
+            batcher = pq.ParquetFile( filnavn ).iter_batches( batch_size=10000, columns=navn )
+        rader = ( rad for batch in batcher for rad in batch.to_pylist() )
+        yield from _par( rader, id_kolonne, kolonner, start )
+        return
+
+    with open( filnavn, newline='', encoding='utf-8-sig' ) as f:
+        if delimiter is None:
+            delimiter = ';' if f.readline().count( ';' ) > 0 else ','
+            f.seek( 0 )
+        yield from _par( csv.DictReader( f, delimiter=delimiter ), id_kolonne, kolonner, start )
+
+
+def _tall( verdi ):
+    """Coordinate value as float, also from text with decimal comma"""
+    if isinstance( verdi, str ):
+        return float( verdi.replace( ',', '.' ) )
+    return float( verdi )
+
+
+def _par( rader, id_kolonne, kolonner, start ):
+    fx, fy, tx, ty = kolonner
+    for radnr, rad in enumerate( itertools.islice( rader, start, None ), start=start ):
+        par = str( rad[id_kolonne] ) if id_kolonne else str( radnr )
+        yield radnr, par, ( _tall( rad[fx] ), _tall( rad[fy] ) ), ( _tall( rad[tx] ), _tall( rad[ty] ) )
+
+
+class Sjekkpunkt:
+    """Append-only checkpoint file, one json line per written batch
+
+    Each line is { 'batch' : batch number, 'rader' : input rows done in total,
+    'forste' : first pair id, 'siste' : last pair id, 'feil' : [ failed pairs ] }.
+    A half written last line (crash during write) is ignored and removed.
+    """
+
+    def __init__( self, filnavn ):
+        self.filnavn = filnavn
+        self.batch = 0
+        self.rader = 0
+        self.feil = 0
+
+        gyldig = 0
+        if os.path.exists( filnavn ):
+            with open( filnavn, 'rb' ) as f:
+                for linje in f:
+                    try:
+                        data = json.loads( linje )
+                    except ValueError:
+                        break
+                    if not linje.endswith( b'\n' ):
+                        break
+                    gyldig += len( linje )
+                    self.batch, self.rader = data['batch'], data['rader']
+                    self.feil += len( data.get( 'feil', [] ) )
+            if gyldig < os.path.getsize( filnavn ):
+                with open( filnavn, 'r+b' ) as f:
+                    f.truncate( gyldig )
+
+    def registrer( self, batch, rader, forste, siste, feil ):
+        linje = json.dumps( { 'batch' : batch, 'rader' : rader, 'forste' : forste, 'siste' : siste, 'feil' : feil },
+                            ensure_ascii=False )
+        with open( self.filnavn, 'a', encoding='utf-8' ) as f:
+            f.write( linje + '\n' )
+            f.flush()
+            os.fsync( f.fileno() )
+        self.batch, self.rader = batch, rader
+        self.feil += len( feil )
+
+
+def lesfeil( sjekkpunktfil ):
+    """Returns list of the failed pairs recorded in a checkpoint file"""
+    feil = []
+    with open( sjekkpunktfil, encoding='utf-8' ) as f:
+        for linje in f:
+            try:
+                feil.extend( json.loads( linje ).get( 'feil', [] ) )
+            except ValueError:
+                break
+    return feil
+
+
+class GpkgSkriver:
+    """Appends batches of features to a GeoPackage layer, one transaction per batch, with spatial index"""
+
+    def __init__( self, filnavn, lag='ruter', crs=5973 ):
+        self.filnavn = filnavn
+        self.lag = lag
+        self.crs = crs
+
+    def _finnes( self ):
+        if not os.path.exists( self.filnavn ):
+            return False
+        conn = sqlite3.connect( self.filnavn )
+        try:
+            return conn.execute( "SELECT 1 FROM gpkg_contents WHERE table_name = ?", ( self.lag, ) ).fetchone() is not None
+        finally:
+            conn.close()
+
+    def finnes( self ):
+        return os.path.exists( self.filnavn )
+
+    def rull_tilbake( self, batch ):
+        """Removes features from batches after batch number 'batch'"""
+        if not self._finnes():
+            return
+        conn = sqlite3.connect( self.filnavn )
+        try:
+            with conn:
+                conn.execute( f'DELETE FROM "{self.lag}" WHERE batch > ?', ( batch, ) )
+        finally:
+            conn.close()
+
+    def skriv( self, gdf, batch ):
+        import pyogrio
+        pyogrio.write_dataframe( gdf, self.filnavn, layer=self.lag, driver='GPKG', append=self._finnes(),
+                                 layer_options={ 'SPATIAL_INDEX' : 'YES' } )
+
+
+class ParquetSkriver:
+    """Writes each batch as one GeoParquet part file in a directory"""
+
+    def __init__( self, katalog, crs=5973 ):
+        self.katalog = katalog
+        self.crs = crs
+
+    def finnes( self ):
+        return os.path.isdir( self.katalog ) and any( navn.startswith( 'part-' ) for navn in os.listdir( self.katalog ) )
+
+    def _filnavn( self, batch ):
+        return os.path.join( self.katalog, f"part-{batch:06d}.parquet" )
+
+    def rull_tilbake( self, batch ):
+        """Removes part files from batches after batch number 'batch', and half written files"""
+        if not os.path.isdir( self.katalog ):
+            return
+        for navn in os.listdir( self.katalog ):
+            if not navn.startswith( 'part-' ):
+                continue
+            if navn.endswith( '.tmp' ) or int( navn[5:11] ) > batch:
+                os.remove( os.path.join( self.katalog, navn ) )
+
+    def skriv( self, gdf, batch ):
+        os.makedirs( self.katalog, exist_ok=True )
+        filnavn = self._filnavn( batch )
+        gdf.to_parquet( filnavn + '.tmp', index=False )
+        os.replace( filnavn + '.tmp', filnavn )
+
+
+def _geodataframe( rader, crs ):
+    """Batch of rows => GeoDataFrame with the fixed column set and types of KOLONNER"""
+    import pandas as pd
+    import geopandas as gpd
+
+    df = pd.DataFrame( rader, columns=list( KOLONNER ) + [ 'geometry' ] )
+    for kol in ( 'par', 'routeName', 'maneuverType', 'maneuverText' ):
+        df[kol] = df[kol].astype( object )
+    for kol in ( 'rad', 'batch' ):
+        df[kol] = df[kol].astype( 'int64' )
+    df['rutealternativNr'] = df['rutealternativNr'].astype( 'int32' )
+    for kol in ( 'time', 'length' ) + RUTESTATISTIKK:
+        df[kol] = pd.to_numeric( df[kol], errors='coerce' ).astype( 'float64' )
+    return gpd.GeoDataFrame( df, geometry='geometry', crs=crs )
+
+
+def _rader( features, radnr, par, batch ):
+    """Flattens the features of one routed pair into rows for the output"""
+    rader = []
+    for feat in features:
+        props = feat['properties']
+        statistic = props.get( 'statistic' ) or {}
+        rad = { 'par' : par, 'rad' : radnr, 'batch' : batch,
+                'rutealternativNr' : props.get( 'rutealternativNr', 0 ), 'routeName' : props.get( 'routeName' ),
+                'time' : props.get( 'time' ), 'length' : props.get( 'length' ),
+                'maneuverType' : props.get( 'maneuverType' ), 'maneuverText' : props.get( 'maneuverText' ),
+                'geometry' : shape( feat['geometry'] ) }
+        for navn in RUTESTATISTIKK:
+            rad[navn] = statistic.get( navn )
+        rader.append( rad )
+    return rader
+
+
+def _forbigaaende( r ):
+    """True if a response is worth trying again later (rate limited or server trouble)"""
+    return r.status_code == 429 or r.status_code >= 500
+
+
+def kjor( inn, ut, format=None, lag='ruter', batchstorrelse=500, concurrency=4, klient=None, ratelimiter=None,
+          ruteplanparams=None, id_kolonne=None, kolonner=KOORDINATKOLONNER, sjekkpunkt=None, crs=5973,
+          overskriv=False, delimiter=None, verbose=True ):
+    """Routes all origin/destination pairs of an input file and writes the routes, resumable
+
+    ARGUMENTS
+        inn : CSV or Parquet file with the pairs, see lespar
+
+        ut : output GeoPackage file, or directory for partitioned Parquet
+
+    KEYWORDS
+        format = None, 'gpkg' or 'parquet'. Default is 'gpkg' if ut ends with .gpkg, otherwise 'parquet'
+
+        lag = 'ruter', GeoPackage layer name
+
+        batchstorrelse = 500, number of pairs per batch (i.e. per transaction / part file)
+
+        concurrency = 4, number of concurrent calls to ruteplan
+
+        klient = None, ruteplan.RuteplanClient. Default is ruteplan.standardklient(), same as anropruteplan
+
+        ratelimiter = None, ruteplanbatch.TokenBucket
+
+        ruteplanparams = None, parameters for ruteplan (see anropruteplan). Default
+        { 'ReturnFields' : ['Geometry'] }
+
+        id_kolonne, kolonner, delimiter : see lespar
+
+        sjekkpunkt = None, checkpoint file. Default is ut + '.checkpoint'
+
+        crs = 5973
+
+        overskriv = False, start from scratch, deleting existing output and checkpoint
+
+        verbose = True, print progress per batch
+
+    RETURNS
+        dictionary with statistics: 'rader' (input rows done, in total), 'par' (pairs routed in
+        this run), 'features', 'feil' (failed pairs in this run), 'batcher' and 'stoppet'
+        (None if the whole input was processed, otherwise why the job stopped)
+    """
+    if format is None:
+        format = 'gpkg' if ut.lower().endswith( '.gpkg' ) else 'parquet'
+    skriver = GpkgSkriver( ut, lag=lag, crs=crs ) if format == 'gpkg' else ParquetSkriver( ut, crs=crs )
+    if sjekkpunkt is None:
+        sjekkpunkt = ut.rstrip( '/\\' ) + '.checkpoint'
+    if ruteplanparams is None:
+        ruteplanparams = { 'ReturnFields' : ['Geometry'] }
+
+    if overskriv:
+        if os.path.exists( sjekkpunkt ):
+            os.remove( sjekkpunkt )
+        skriver.rull_tilbake( -1 )
+        if format == 'gpkg' and os.path.exists( ut ):
+            os.remove( ut )
+    elif skriver.finnes() and not os.path.exists( sjekkpunkt ):
+        raise FileExistsError( f"{ut} exists, but there is no checkpoint file {sjekkpunkt}. Use overskriv=True to start from scratch" )
+
+    sjekk = Sjekkpunkt( sjekkpunkt )
+    skriver.rull_tilbake( sjekk.batch )
+    if verbose and sjekk.rader:
+        print( f"Resuming after {sjekk.rader} input rows ({sjekk.batch} batches)" )
+
+    statistikk = { 'rader' : sjekk.rader, 'par' : 0, 'features' : 0, 'feil' : 0, 'batcher' : 0, 'stoppet' : None }
+
+    # Input-radene holdes i en ordbok fram til resultatet kommer, begrenset av vinduet i rutebatch
+    underveis = {}
+    def jobber():
+        for radnr, par, fra, til in lespar( inn, id_kolonne=id_kolonne, kolonner=kolonner, start=start, delimiter=delimiter ):
+            underveis[radnr] = par
+            yield { 'coordinates' : [ fra, til ], 'ruteplanparams' : ruteplanparams }
+
+    def skriv_batch( rader, feil, antall, forste, siste ):
+        batch = sjekk.batch + 1
+        if rader:
+            for rad in rader:
+                rad['batch'] = batch
+            with instrumentering.span( 'pipeline.skriv', rader=len( rader ) ):
+                skriver.skriv( _geodataframe( rader, crs ), batch )
+        sjekk.registrer( batch, sjekk.rader + antall, forste, siste, feil )
+        statistikk['rader'] = sjekk.rader
+        statistikk['batcher'] += 1
+        if verbose:
+            print( f"Batch {batch}: {sjekk.rader} rows done, {len( rader )} features, {len( feil )} failed" )
+
+    rader, feil, antall, forste, siste = [], [], 0, None, None
+    start = sjekk.rader
+    resultater = ruteplanbatch.rutebatch( jobber(), klient=klient, concurrency=concurrency, ratelimiter=ratelimiter,
+                                          ordered=True, parse='response' )
+    try:
+        for res in resultater:
+            radnr = start + res['index']
+            par = underveis.pop( radnr )
+
+            # Forbigående feil => stopp, så paret blir forsøkt på nytt neste gang
+            if isinstance( res['error'], ( ruteplanbatch.QuotaExceeded, requests.RequestException ) ):
+                statistikk['stoppet'] = f"{type( res['error'] ).__name__}: {res['error']}"
+                break
+            if res['error'] is None and _forbigaaende( res['data'] ):
+                statistikk['stoppet'] = f"HTTP {res['data'].status_code} from ruteplan"
+                break
+
+            try:
+                if res['error'] is not None:
+                    raise res['error']
+                features = ruteplan.parseruteplan( res['data'] )
+                rader.extend( _rader( features, radnr, par, 0 ) )
+                statistikk['par'] += 1
+                statistikk['features'] += len( features )
+            except Exception as e:
+                feil.append( { 'rad' : radnr, 'par' : par, 'feil' : str( e ) } )
+                statistikk['feil'] += 1
+
+            forste = par if forste is None else forste
+            siste = par
+            antall += 1
+            if antall >= batchstorrelse:
+                skriv_batch( rader, feil, antall, forste, siste )
+                rader, feil, antall, forste = [], [], 0, None
+    finally:
+        resultater.close()
+
+    if antall:
+        skriv_batch( rader, feil, antall, forste, siste )
+
+    if verbose and statistikk['stoppet']:
+        print( f"Stopped: {statistikk['stoppet']}. Run again to resume" )
+    return statistikk
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser( description='Route origin/destination pairs from CSV/Parquet to GeoPackage/Parquet, resumable' )
+    parser.add_argument( 'input', help='CSV or Parquet file with one origin/destination pair per row' )
+    parser.add_argument( 'output', help='GeoPackage file (.gpkg) or directory for partitioned Parquet' )
+    parser.add_argument( '--format', choices=( 'gpkg', 'parquet' ) )
+    parser.add_argument( '--layer', default='ruter', help='GeoPackage layer name' )
+    parser.add_argument( '--batch-size', type=int, default=500, help='pairs per batch (transaction / part file)' )
+    parser.add_argument( '--concurrency', type=int, default=4 )
+    parser.add_argument( '--id-column', help='column with the id of each pair (default: row number)' )
+    parser.add_argument( '--columns', default=','.join( KOORDINATKOLONNER ), help='coordinate columns fra_x,fra_y,til_x,til_y' )
+    parser.add_argument( '--delimiter', help='CSV delimiter (default: detect , or ;)' )
+    parser.add_argument( '--ruteplanparams', help='json with ruteplan parameters, default {"ReturnFields": ["Geometry"]}' )
+    parser.add_argument( '--checkpoint', help='checkpoint file (default: output + .checkpoint)' )
+    parser.add_argument( '--crs', type=int, default=5973 )
+    parser.add_argument( '--server', default='ruteplan', help='server entry in credentials.json' )
+    parser.add_argument( '--cache', help='SQLite file for caching ruteplan responses' )
+    parser.add_argument( '--rate', type=float, help='max calls per second' )
+    parser.add_argument( '--daily-limit', type=int, default=2500, help='max calls per day (with --rate)' )
+    parser.add_argument( '--quota-file', help='json file keeping track of the daily quota (with --rate)' )
+    parser.add_argument( '--overwrite', action='store_true', help='start from scratch' )
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        from ruteplancache import RuteplanCache
+        cache = RuteplanCache( args.cache )
+    klient = ruteplan.RuteplanClient( server=args.server, pool_size=max( 10, args.concurrency ), cache=cache )
+    ratelimiter = None
+    if args.rate:
+        ratelimiter = ruteplanbatch.TokenBucket( rate=args.rate, daily_limit=args.daily_limit, statefile=args.quota_file )
+
+    statistikk = kjor( args.input, args.output, format=args.format, lag=args.layer, batchstorrelse=args.batch_size,
+                       concurrency=args.concurrency, klient=klient, ratelimiter=ratelimiter,
+                       ruteplanparams=json.loads( args.ruteplanparams ) if args.ruteplanparams else None,
+                       id_kolonne=args.id_column, kolonner=tuple( args.columns.split( ',' ) ), sjekkpunkt=args.checkpoint,
+                       crs=args.crs, overskriv=args.overwrite, delimiter=args.delimiter )
+    print( json.dumps( statistikk, indent=1 ) )
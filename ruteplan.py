@@ -21,16 +21,35 @@ content:
 import requests
 import json
 import copy
+import os
+import time
+from collections import ChainMap
+from types import MappingProxyType
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import geojson
 
+import ruteplancache
+import instrumentering
+
 # import STARTHER
 import ruteplan
-from copy import deepcopy 
 
 from shapely.geometry import shape
 
+# Valgfrie, raskere json-bibliotek 
+try: 
+    import orjson
+except ImportError: 
+    orjson = None 
+
+try: 
+    import ijson
+except ImportError: 
+    ijson = None 
+
 def ruteplan2dict( **kwargs ): 
     """
     Anrop ruteplantjenesten og få liste med dictionaries tilbake 
@@ -41,19 +60,8 @@ def ruteplan2dict( **kwargs ):
     og parseruteplan (returnerer liste med geojson-features). Se dokumentasjonen for disse funksjonene 
     """
 
-    data = None 
-    r = anropruteplan( **kwargs )
-    if r.ok: 
-        features = parseruteplan( r )
-        data = [] 
-        for feat in features: 
-            props = deepcopy( feat['properties'] )
-            props['geometry'] = shape( feat['geometry'] )
-            data.append( props )
-
-    else: 
-        print( f"Feilkode fra ruteplantjenesten HTTP STATUS={r.status_code} {r.text} ")
-    return data 
+    server = kwargs.pop( 'server', 'ruteplan' )
+    return standardklient( server ).route_dict( **kwargs )
 
 
 def lescredfil( credfile = 'credentials.json', server='ruteplan' ):
@@ -86,6 +94,181 @@ def lescredfil( credfile = 'credentials.json', server='ruteplan' ):
     return credentials
     
 
+class RuteplanClient: 
+    """Gjenbrukbar klient for ruteplantjenesten 
+
+    Reads the credentials file once and keeps a pooled requests.Session with keep-alive, 
+    so a loop over thousands of routes does not pay for file I/O and a new TLS handshake 
+    on every call. Requests that fail with HTTP 429 or 5xx are retried with exponential 
+    backoff (respecting any Retry-After header from the server). These retries are done 
+    by the client itself and not by urllib3, so each of them takes a token from the rate 
+    limiter and counts against the daily quota like any other call. 
+
+    Example: 
+        klient = RuteplanClient( pool_size=4 )
+        for fra, til in mylist: 
+            data = klient.route_dict( coordinates=[ fra, til ] )
+
+    KEYWORDS
+        server = 'ruteplan', element in the credentials file 
+
+        credfile = 'credentials.json', path to credentials file. Proxies are read from 
+        the 'proxies' element, if present 
+
+        pool_size = 10, maximum number of pooled connections (use at least the 
+        number of threads sharing this client) 
+
+        retries = 3, number of retries on HTTP 429 / 5xx and connection errors
+
+        backoff_factor = 0.5, sleep between retries is backoff_factor * 2**(retry number - 1) seconds
+
+        timeout = None, timeout (seconds) passed on to requests. 
+
+        cache = None or a ruteplancache.RuteplanCache instance, used for all requests 
+        made by this client
+
+        ratelimiter = None or a ruteplanbatch.TokenBucket instance. If given, every call that 
+        actually reaches the ruteplan API (i.e. not answered from the cache), including 
+        retries, must first acquire a token 
+    """
+
+    retry_statuses = ( 429, 500, 502, 503, 504 )
+
+    def __init__( self, server='ruteplan', credfile='credentials.json', pool_size=10, 
+                 retries=3, backoff_factor=0.5, timeout=None, cache=None, ratelimiter=None ): 
+
+        self.credentials = lescredfil( credfile=credfile, server=server )
+        self.url        = self.credentials['url']
+        self.timeout    = timeout 
+        self.cache      = cache
+        self.ratelimiter = ratelimiter
+        self.retries    = retries
+        self.backoff_factor = backoff_factor
+
+        self.session = requests.Session()
+        self.session.auth = self.credentials['auth']
+        if 'proxies' in self.credentials.keys(): 
+            self.session.proxies.update( self.credentials['proxies'] )
+
+        # urllib3 tar seg bare av nye forsøk ved tilkoblingsfeil. Nye forsøk ved 429 / 5xx gjøres i route(), 
+        # slik at hvert forsøk går gjennom rate limiter og teller mot kvoten 
+        retry = Retry( total=retries, backoff_factor=backoff_factor, status_forcelist=(), 
+                      allowed_methods=frozenset( ['GET'] ), raise_on_status=False )
+        adapter = HTTPAdapter( pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry )
+        self.session.mount( 'https://', adapter )
+        self.session.mount( 'http://', adapter )
+
+    def route( self, ruteplanparams={ 'ReturnFields' : ['Geometry', 'NvdbReferences'] }, 
+              coordinates = [ (269756.5,7038421.3), (269682.4,7039315.6)], debug=False, cache=None, **kwargs ): 
+        """Fetch data from the ruteplan API, returns a requests response object
+
+        Same arguments as the function anropruteplan. The cache keyword overrides 
+        the cache given to the client. 
+        """
+
+        params = lagruteplanparams( ruteplanparams=ruteplanparams, coordinates=coordinates, **kwargs )
+
+        if debug:
+            print( f"Ruteplan parametre: {json.dumps(params, indent=4)}")
+
+        # Har vi svaret fra før? 
+        if cache is None: 
+            cache = self.cache 
+        if cache is not None: 
+            key = ruteplancache.cachekey( self.url, params )
+            r = cache.get( key )
+            if r is not None: 
+                instrumentering.tell( 'ruteplan.cache_treff' )
+                if debug: 
+                    print( f"Ruteplan respons fra cache {key}")
+                return r 
+            instrumentering.tell( 'ruteplan.cache_bom' )
+
+        for forsok in range( self.retries + 1 ): 
+            if forsok: 
+                time.sleep( self._ventetid( r, forsok ) )
+                instrumentering.tell( 'ruteplan.retries' )
+
+            if self.ratelimiter is not None: 
+                self.ratelimiter.acquire()
+
+            with instrumentering.span( 'ruteplan.request' ) as span: 
+                r = self.session.get( self.url, params=params, timeout=self.timeout )
+                span.sett( bytes=len( r.content ), status=r.status_code )
+            instrumentering.tell( 'ruteplan.kall' )
+
+            # Nye forsøk gjort av urllib3 etter tilkoblingsfeil 
+            retries = getattr( getattr( r.raw, 'retries', None ), 'history', None )
+            if retries: 
+                instrumentering.tell( 'ruteplan.retries', len( retries ) )
+
+            if r.status_code not in self.retry_statuses: 
+                break 
+
+        if not r.ok: 
+            instrumentering.tell( 'ruteplan.feil', status=r.status_code )
+
+        if cache is not None: 
+            cache.put( key, r )
+
+        return r
+
+    def _ventetid( self, r, forsok ): 
+        """Seconds to wait before retry number 'forsok': Retry-After from the server, or exponential backoff"""
+        retry_after = r.headers.get( 'Retry-After' )
+        if retry_after: 
+            try: 
+                return Retry().parse_retry_after( retry_after )
+            except Exception: 
+                pass 
+        return self.backoff_factor * 2 ** ( forsok - 1 )
+
+    def route_features( self, egenskaper={}, **kwargs ): 
+        """Fetch data from the ruteplan API, returns list of geojson features 
+
+        See functions anropruteplan and parseruteplan 
+        """
+        return parseruteplan( self.route( **kwargs ), egenskaper=egenskaper )
+
+    def route_dict( self, **kwargs ): 
+        """Fetch data from the ruteplan API, returns list of dictionaries with shapely geometries 
+
+        Returns None if the ruteplan API responds with an error. See function ruteplan2dict 
+        """
+
+        data = None 
+        r = self.route( **kwargs )
+        if r.ok: 
+            data = features2dict( iterruteplan( r ) )
+
+        else: 
+            print( f"Feilkode fra ruteplantjenesten HTTP STATUS={r.status_code} {r.text} ")
+        return data 
+
+    def with_ratelimiter( self, ratelimiter ): 
+        """Returns a copy of this client using another rate limiter, sharing session and cache"""
+        klient = copy.copy( self )
+        klient.ratelimiter = ratelimiter
+        return klient 
+
+    def close( self ): 
+        self.session.close()
+
+
+# Standardklienter som brukes av funksjonene anropruteplan og ruteplan2dict, én per server 
+_standardklienter = {}
+
+def standardklient( server='ruteplan' ): 
+    """Returns the shared RuteplanClient for this server, created on first use
+
+    The module level functions anropruteplan and ruteplan2dict use this client, so the 
+    credentials file is read only once per process. 
+    """
+    if server not in _standardklienter: 
+        _standardklienter[server] = RuteplanClient( server=server )
+    return _standardklienter[server]
+
+
 def parseruteplan( responseobj, egenskaper={} ): 
     """Tar responsobjekt fra ruteplantjenesten, omsetter til en 
     liste med Geojson-features. Disse kan puttes inn i en featureCollection
@@ -110,35 +293,226 @@ def parseruteplan( responseobj, egenskaper={} ):
 
     """
     
+    return parseruteplandata( lesrespons( responseobj ), egenskaper=egenskaper )
+
+def parseruteplandata( data, egenskaper={} ): 
+    """Som parseruteplan, men for ferdig dekodet ruteplan-respons (dictionary) 
+
+    Useful for responses saved to file (e.g. ruteplanrespons.json) or produced 
+    by other means, such as the local routing engine in lokalruting.py 
+    """
+
+    featurelist = []
+    for ii, rute in enumerate( data['routes'] ): 
+        
+        metadata = rutemetadata( rute, ii, egenskaper=egenskaper )
+        for feature in rute['features']: 
+            feature['properties'].update( metadata )
+            featurelist.append(  feature ) 
+          
+    return featurelist
+
+def lesrespons( responseobj ): 
+    """Sjekker og dekoder responsobjekt fra ruteplantjenesten 
+
+    Uses orjson for decoding if it is installed, otherwise the json decoder of requests. 
+
+    Raises ValueError if the response has an HTTP error code or ruteplan reports an error 
+    in the 'messages' element. 
+
+    ARGUMENTS
+        response : http requests response object https://requests.readthedocs.io/en/latest/
+
+    RETURNS
+        dictionary with the decoded response 
+    """
+
     # Feilsituasjoner? 
     if not responseobj.ok: 
         message= ' '.join( [ 'Invalid response from ruteplan:', 
                             str(responseobj.status_code), responseobj.reason, responseobj.url ])
         raise ValueError( message )
 
-    data = responseobj.json()
+    with instrumentering.span( 'ruteplan.parse', bytes=len( responseobj.content ) ): 
+        if orjson is not None: 
+            data = orjson.loads( responseobj.content )
+        else: 
+            data = responseobj.json()
+
     if 'messages' in data.keys():
         message = str( data['messages']) + ' ' + responseobj.url
         raise ValueError( message)
 
-    featurelist = []
-    for ii, rute in enumerate( data['routes'] ): 
+    return data 
+
+def rutemetadata( rute, rutealternativNr, egenskaper={} ): 
+    """Metadata for ett ruteforslag, dvs alt unntatt 'features' og 'nvdbReferenceLinks' 
+
+    Shallow copy: nested elements such as 'statistic' are shared with the route. 
+    """
+    metadata = { key : value for key, value in rute.items() if key not in ( 'features', 'nvdbReferenceLinks' ) }
+    metadata['rutealternativNr'] = rutealternativNr
+    if egenskaper: 
+        metadata.update( egenskaper )
+    return metadata 
+
+def _iterruter( ruter, egenskaper ): 
+    for ii, rute in enumerate( ruter ): 
+        metadata = MappingProxyType( rutemetadata( rute, ii, egenskaper=egenskaper ) )
+        for feature in rute['features']: 
+            yield { 'type' : feature.get( 'type', 'Feature' ), 
+                    'geometry' : feature['geometry'], 
+                    'properties' : ChainMap( metadata, feature['properties'] ) }
+
+def iterruteplan( responseobj, egenskaper={} ): 
+    """Lazy, copy-free variant of parseruteplan 
+
+    Returns a generator yielding one geojson feature per geometry element. Nothing is 
+    copied: The 'properties' of each feature is a collections.ChainMap of ONE read-only 
+    metadata mapping shared by all features of the same route alternative (statistic, 
+    routeName, rutealternativNr, egenskaper etc) and the feature's own properties. As with 
+    parseruteplan the metadata wins if a key is in both, and the keys come in the same order: 
+    The feature's own properties first, then the metadata. 
+
+    Use dict( feature['properties'] ) if you need a plain (e.g. json serializable) dictionary. 
+
+    Errors in the response are raised immediately, not when the generator is consumed. 
+
+    ARGUMENTS
+        response : http requests response object https://requests.readthedocs.io/en/latest/
+
+    KEYWORDS
+        egenskaper : dictionary, ekstra metadata / data som føyes til hvert enkelt geojson-element
+
+    RETURNS
+        generator of geojson features 
+    """
+    data = lesrespons( responseobj )
+    return _iterruter( data['routes'], egenskaper )
+
+def _ijsonhendelser( fil ): 
+    """ijson parse events for a ruteplan response. Raises ValueError on a top level 'messages' element"""
+    meldinger = None 
+    for prefix, event, value in ijson.parse( fil, use_float=True ): 
+        if prefix[:8] == 'messages' and ( len( prefix ) == 8 or prefix[8] == '.' ): 
+            if meldinger is None: 
+                meldinger = ijson.ObjectBuilder()
+            meldinger.event( event, value )
+            if len( prefix ) == 8 and event not in ( 'start_map', 'start_array', 'map_key' ): 
+                raise ValueError( str( meldinger.value ) )
+        yield prefix, event, value 
+
+
+def _ijsonruter( fil ): 
+    """Route alternatives decoded incrementally with ijson. Raises ValueError on a top level 'messages' element, 
+    same error handling as lesrespons / parseruteplan 
+    """
+    if getattr( fil, 'seekable', None ) and fil.seekable(): 
+        # Filer: Et raskt første gjennomløp (i C) etter messages, deretter rutene 
+        start = fil.tell()
+        ingen = object()
+        meldinger = next( ijson.items( fil, 'messages', use_float=True ), ingen )
+        if meldinger is not ingen: 
+            raise ValueError( str( meldinger ) )
+        fil.seek( start )
+        return ijson.items( fil, 'routes.item', use_float=True )
+
+    # Strømmer (f.eks. http-respons) kan bare leses én gang: Sjekker messages underveis 
+    return ijson.items( _ijsonhendelser( fil ), 'routes.item' )
+
+
+def iterruteplanfil( fil, egenskaper={} ): 
+    """Streaming parser for large ruteplan responses, e.g. saved to file 
+
+    Like iterruteplan, but decodes the json incrementally with ijson (if installed), 
+    so only one route alternative is held in memory at a time. Without ijson the whole 
+    document is decoded with the json module. A response with a 'messages' element raises 
+    ValueError either way. For streams that can't seek (like r.raw) with ijson, features of 
+    routes that come before the messages in the document may already have been yielded. 
+
+    ARGUMENTS
+        fil : file name or file-like object opened in binary mode. A streamed http response 
+        can be used directly: 
+            r = klient.session.get( url, params=params, stream=True )
+            features = iterruteplanfil( r.raw )
+
+    KEYWORDS
+        egenskaper : dictionary, ekstra metadata / data som føyes til hvert enkelt geojson-element
+
+    RETURNS
+        generator of geojson features 
+    """
+    if isinstance( fil, ( str, os.PathLike ) ): 
+        with open( fil, 'rb' ) as f: 
+            yield from iterruteplanfil( f, egenskaper=egenskaper )
+        return 
+
+    if ijson is not None: 
+        ruter = _ijsonruter( fil )
+    else: 
+        data = json.load( fil )
+        if 'messages' in data.keys():
+            raise ValueError( str( data['messages'] ) )
+        ruter = data['routes']
+
+    yield from _iterruter( ruter, egenskaper )
+
+
+def lagruteplanparams( ruteplanparams={ 'ReturnFields' : ['Geometry', 'NvdbReferences'] }, 
+                      coordinates = [ (269756.5,7038421.3), (269682.4,7039315.6)], **kwargs ): 
+    """Lager det endelige settet med parametre for ruteplan-API'et 
+
+    Same rules as anropruteplan: If 'ruteplanparams' has no "stops" element it is built 
+    from the coordinate list. Any other keyword overrides the values of "ruteplanparams" 
+    and "coordinates". 
+
+    RETURNS
+        dictionary with query parameters 
+    """
+
+    # Siden vi modifiserer ruteplan-params så må vi kopiere, ellers kan du få kluss
+    params = copy.deepcopy( ruteplanparams )
+
+    # Har vi eksplisitt angitt "stops" i ruteplanparametrene? 
+    # Hvis ikke bygger vi det ut fra koordinatene
+    if not 'stops' in ruteplanparams.keys(): 
+        cords = copy.deepcopy( coordinates)
+
+        if len(cords) < 2: 
+            raise ValueError( 'Coordinate list must have at least 2 points')
         
-        metadata = deepcopy( rute ) 
-        metadata.pop('features', None )
-        metadata.pop('nvdbReferenceLinks', None )
-        metadata['rutealternativNr'] = ii
-        if egenskaper: 
-            metadata.update( egenskaper )
+        stopstrings  = []
+        while len(cords): 
+            stopstrings.append( ','.join( str(px) for px in cords.pop(0))  )
         
-        for feature in rute['features']: 
-            feature['properties'].update( metadata )
-            featurelist.append(  feature ) 
-          
-    return featurelist
+        params['stops'] = ';'.join( stopstrings)
+
+
+    # Any other keywords? These will override the values of the "ruteplanparams" or "coordinates" keywords
+    for key, value in kwargs.items(): 
+        params[key] = value
+
+    return params 
+
+def features2dict( features ): 
+    """Omsetter liste med geojson-features til liste med dictionaries
+
+    The properties of each feature are copied into a new dictionary (shallow copy, nested 
+    elements such as 'statistic' are shared), and the geometry is converted to a shapely 
+    object in the field 'geometry'. Works with the output from both parseruteplan and 
+    iterruteplan. 
+    """
+    data = [] 
+    with instrumentering.span( 'ruteplan.shapely' ): 
+        for feat in features: 
+            props = dict( feat['properties'] )
+            props['geometry'] = shape( feat['geometry'] )
+            data.append( props )
+    return data 
 
 def anropruteplan( ruteplanparams={ 'ReturnFields' : ['Geometry', 'NvdbReferences'] }, 
-                  server='ruteplan', coordinates = [ (269756.5,7038421.3), (269682.4,7039315.6)], debug=False, **kwargs ): 
+                  server='ruteplan', coordinates = [ (269756.5,7038421.3), (269682.4,7039315.6)], debug=False, 
+                  cache=None, **kwargs ): 
     """Fetch data from the NVDB roting API 
 
     Please note that there are two ways  to specify the ruteplan parameters: 
@@ -169,54 +543,21 @@ def anropruteplan( ruteplanparams={ 'ReturnFields' : ['Geometry', 'NvdbReference
 
         debug = False If true, prints debug information. 
 
+        cache = None or a ruteplancache.RuteplanCache instance. If given, identical 
+        requests are answered from the cache instead of calling the ruteplan API. 
+
         Any other keyword is passed directly to the ruteplan API. These additional 
         keywords will override the values of the "ruteplanparams" or "coordinates" keywords
         https://labs.vegdata.no/ruteplandoc/
     
     RETURNS: 
         Returns a request response object https://requests.readthedocs.io/en/latest/ 
-    """
-
-    # Henter info om server, brukernavn etc
-    credentials = lescredfil( credfile='credentials.json', server=server)
-    
-    # Har vi angitt proxy? 
-    proxies = {}
-    if 'proxies' in credentials.keys(): 
-        proxies = credentials['proxies']
-    
-    # Siden vi modifiserer ruteplan-params så må vi kopiere, ellers kan du få kluss
-    params = copy.deepcopy( ruteplanparams )
-
-    # Har vi eksplisitt angitt "stops" i ruteplanparametrene? 
-    # Hvis ikke bygger vi det ut fra koordinatene
-    if not 'stops' in ruteplanparams.keys(): 
-        cords = copy.deepcopy( coordinates)
-
-        if len(cords) < 2: 
-            raise ValueError( 'Coordinate list must have at least 2 points')
-        
-        stopstrings  = []
-        while len(cords): 
-            stopstrings.append( ','.join( str(px) for px in cords.pop(0))  )
-        
-        params['stops'] = ';'.join( stopstrings)
 
+    This is a thin wrapper around RuteplanClient.route, using a shared client per server 
+    (see function standardklient). Create your own RuteplanClient for control over 
+    connection pool size, retries and timeouts. 
+    """
 
-    # Any other keywords? These will override the values of the "ruteplanparams" or "coordinates" keywords
-    for key, value in kwargs.items(): 
-        params[key] = value
-
-    if credentials['auth']:
-        r = requests.get( credentials['url'], auth=credentials['auth'], 
-                         params=params, proxies=proxies)
-        
-    else: 
-        r = requests.get( credentials['url'], params=params, 
-                         proxies=proxies)
-
-    if debug:
-        print( f"Ruteplan parametre: {json.dumps(params, indent=4)}")
-
-    return r
+    return standardklient( server ).route( ruteplanparams=ruteplanparams, coordinates=coordinates, 
+                                          debug=debug, cache=cache, **kwargs )
 
@@ -1,2 +1,272 @@
+# -*- coding: utf-8 -*-
 
-# To be written
+"""Bulk export of ruteplan routes to GeoPackage or FlatGeobuf, for fast loading in QGIS
+
+Takes the output of ruteplan.parseruteplan / iterruteplan (geojson features) or
+ruteplan.ruteplan2dict (dictionaries with shapely geometries), for any number of routes,
+and writes these layers:
+
+    ruter               one row per route alternative, with the 'statistic' block as columns
+                        and the whole route as one LineString
+    ruter_<tolerance>   the same routes, simplified with tolerance 10, 100, 1000 m ...
+                        (overview layers, set min/max scale in QGIS to switch between them)
+    segmenter           one row per geometry element, with time and length only
+    manovrer            one point per maneuver (start of each geometry element), with
+                        maneuverType and maneuverText
+
+so route level attributes are not repeated on every segment. Each layer is written in one
+go from a columnar GeoDataFrame (one transaction per layer) with an R-tree spatial index.
+FlatGeobuf output is one .fgb file per layer in a directory, with the packed Hilbert R-tree
+index that allows streaming reads of just the area you look at.
+
+Usage:
+
+    import ruteplan
+    import ruteplan2qgis
+
+    features = []
+    for coordinates in mange_koordinatpar:
+        features.extend( ruteplan.parseruteplan( ruteplan.anropruteplan( coordinates=coordinates ) ) )
+    ruteplan2qgis.eksporter( features, 'ruter.gpkg' )
+    ruteplan2qgis.eksporter( features, 'ruter_fgb', format='FlatGeobuf' )
+
+Features are grouped into routes on the route alternative they belong to: The metadata of
+all features of one route alternative share the same 'statistic' object (also when the
+same response is parsed twice, e.g. from the cache, the two parses give two routes).
+"""
+
+import itertools
+import os
+import shutil
+
+import numpy as np
+import shapely
+
+from rutekolonner import RUTESTATISTIKK
+
+
+# Egenskaper per geometribit, resten av properties er metadata for hele ruteforslaget
+SEGMENTFELT = ( 'time', 'length' )
+MANOVERFELT = ( 'maneuverType', 'maneuverText' )
+_IKKE_RUTEFELT = set( SEGMENTFELT + MANOVERFELT ) | { 'geometry', 'statistic', 'roadFeatures', 'isOutsideOfNorway',
+                                                       'nvdbReferenceId', 'direction', 'type' }
+
+TOLERANSER = ( 10, 100, 1000 )
+
+
+def _tall( verdi ):
+    """Some statistic values are returned as strings by the API"""
+    try:
+        return float( verdi )
+    except ( TypeError, ValueError ):
+        return np.nan
+
+
+def _skalar( verdi ):
+    return verdi is None or isinstance( verdi, ( str, int, float, bool, np.integer, np.floating ) )
+
+
+def _flat( features ):
+    """Accepts one list of features, or an iterable of lists (e.g. one list per call to ruteplan)"""
+    for feat in features:
+        if isinstance( feat, list ):
+            yield from feat
+        else:
+            yield feat
+
+
+def _koordinater( coordchunks ):
+    """List of coordinate lists => ( n, 2 ) numpy array"""
+    punkter = list( itertools.chain.from_iterable( coordchunks ) )
+    try:
+        return np.asarray( punkter, dtype=np.float64 ).reshape( len( punkter ), -1 )[:, :2]
+    except ValueError:
+        # Blanding av 2D og 3D
+        return np.asarray( [ p[:2] for p in punkter ], dtype=np.float64 ).reshape( -1, 2 )
+
+
+def kolonner( features ):
+    """Collects the features in columnar form, one pass over the data
+
+    RETURNS
+        dictionary with numpy arrays:
+            'coords', 'offsets'         coordinate buffer and offsets per segment
+            'segment_rute'              route number per segment
+            'time', 'length'            per segment
+            'maneuverType', 'maneuverText' per segment (object arrays)
+        and per route: 'ruter' (dictionary of lists: rutealternativNr, routeName, statistic fields
+        and other scalar metadata)
+    """
+    coordarrays = []
+    coordchunks = []
+    lengths = []
+    segment_rute = []
+    time = []
+    length = []
+    maneuverType = []
+    maneuverText = []
+    ruter = { 'rute' : [], 'rutealternativNr' : [], 'routeName' : [] }
+    ruter.update( { navn : [] for navn in RUTESTATISTIKK } )
+    ekstra = {}
+
+    forrige = None
+    rutenr = -1
+    for feat in _flat( features ):
+        props = feat['properties'] if 'properties' in feat else feat
+        statistic = props.get( 'statistic' )
+        key = ( id( statistic ) if statistic is not None else props.get( 'routeId' ), props.get( 'rutealternativNr' ) )
+
+        if key != forrige:
+            # Nytt ruteforslag
+            forrige = key
+            rutenr += 1
+            ruter['rute'].append( rutenr )
+            ruter['rutealternativNr'].append( props.get( 'rutealternativNr', 0 ) )
+            ruter['routeName'].append( props.get( 'routeName' ) )
+            for navn in RUTESTATISTIKK:
+                ruter[navn].append( _tall( ( statistic or {} ).get( navn ) ) )
+            for navn, verdi in props.items():
+                if navn in ruter or navn in _IKKE_RUTEFELT or not _skalar( verdi ):
+                    continue
+                if navn not in ekstra:
+                    ekstra[navn] = [ None ] * rutenr
+                ekstra[navn].append( verdi )
+            for navn, verdier in ekstra.items():
+                if len( verdier ) == rutenr:
+                    verdier.append( None )
+
+        geometry = feat['geometry']
+        if isinstance( geometry, dict ):
+            punkter = geometry['coordinates']
+            coordchunks.append( punkter )
+            lengths.append( len( punkter ) )
+        else:
+            punkter = shapely.get_coordinates( geometry )
+            coordchunks.append( punkter.tolist() )
+            lengths.append( len( punkter ) )
+
+        # Python-lister med koordinater tar mye plass, så de gjøres om til numpy med jevne mellomrom
+        if len( coordchunks ) >= 10000:
+            coordarrays.append( _koordinater( coordchunks ) )
+            coordchunks = []
+
+        segment_rute.append( rutenr )
+        time.append( props.get( 'time', np.nan ) )
+        length.append( props.get( 'length', np.nan ) )
+        maneuverType.append( props.get( 'maneuverType' ) )
+        maneuverText.append( props.get( 'maneuverText' ) )
+
+    ruter.update( ekstra )
+    coordarrays.append( _koordinater( coordchunks ) )
+    coords = np.concatenate( coordarrays )
+    offsets = np.zeros( len( lengths ) + 1, dtype=np.int64 )
+    np.cumsum( lengths, out=offsets[1:] )
+
+    return { 'coords' : coords, 'offsets' : offsets,
+             'segment_rute' : np.asarray( segment_rute, dtype=np.int64 ),
+             'time' : np.asarray( time, dtype=np.float64 ), 'length' : np.asarray( length, dtype=np.float64 ),
+             'maneuverType' : np.asarray( maneuverType, dtype=object ), 'maneuverText' : np.asarray( maneuverText, dtype=object ),
+             'ruter' : ruter }
+
+
+def lagtabeller( features, toleranser=TOLERANSER, crs=5973, segmenter=True, manovrer=True ):
+    """Builds the layers as GeoDataFrames, see the module documentation
+
+    RETURNS
+        dictionary { layer name : GeoDataFrame }
+    """
+    import pandas as pd
+    import geopandas as gpd
+
+    kol = kolonner( features )
+    coords, offsets = kol['coords'], kol['offsets']
+    antall = np.diff( offsets )
+    segment_index = np.repeat( np.arange( len( antall ) ), antall )
+    lag = {}
+
+    # Hele ruta som én linje, av alle koordinatene til geometribitene (uten doble punkt i skjøtene)
+    ruter = pd.DataFrame( kol['ruter'] )
+    punkt_rute = kol['segment_rute'][segment_index]
+    dobbel = np.zeros( len( coords ), dtype=bool )
+    dobbel[1:] = ( punkt_rute[1:] == punkt_rute[:-1] ) & np.all( coords[1:] == coords[:-1], axis=1 )
+    rutegeom = shapely.linestrings( coords[~dobbel], indices=punkt_rute[~dobbel] ) if len( coords ) else []
+    lag['ruter'] = gpd.GeoDataFrame( ruter, geometry=np.asarray( rutegeom ), crs=crs )
+
+    for toleranse in toleranser:
+        forenklet = shapely.simplify( lag['ruter'].geometry.values, toleranse, preserve_topology=False )
+        lag[f"ruter_{toleranse:g}"] = gpd.GeoDataFrame( ruter[['rute', 'rutealternativNr', 'routeName'] + list( RUTESTATISTIKK )],
+                                                        geometry=forenklet, crs=crs )
+
+    if segmenter:
+        geom = shapely.linestrings( coords, indices=segment_index ) if len( coords ) else []
+        lag['segmenter'] = gpd.GeoDataFrame( { 'rute' : kol['segment_rute'], 'time' : kol['time'], 'length' : kol['length'] },
+                                             geometry=np.asarray( geom ), crs=crs )
+
+    if manovrer:
+        har = np.asarray( [ bool( m ) for m in kol['maneuverType'] ], dtype=bool ) & ( antall > 0 )
+        start = coords[offsets[:-1][har]]
+        lag['manovrer'] = gpd.GeoDataFrame( { 'rute' : kol['segment_rute'][har],
+                                              'maneuverType' : kol['maneuverType'][har],
+                                              'maneuverText' : kol['maneuverText'][har] },
+                                            geometry=shapely.points( start ), crs=crs )
+    return lag
+
+
+def _skriv( gdf, filnavn, lag, driver ):
+    """Writes one layer in one go, with spatial index"""
+    import pyogrio
+    kwargs = { 'driver' : driver, 'layer_options' : { 'SPATIAL_INDEX' : 'YES' } }
+    if driver == 'GPKG':
+        kwargs['layer'] = lag
+    try:
+        pyogrio.write_dataframe( gdf, filnavn, use_arrow=True, **kwargs )
+    except Exception:
+        # Eldre GDAL / uten pyarrow
+        pyogrio.write_dataframe( gdf, filnavn, **kwargs )
+
+
+def eksporter( features, filnavn, format=None, toleranser=TOLERANSER, crs=5973, segmenter=True, manovrer=True ):
+    """Exports routes to GeoPackage or FlatGeobuf for QGIS
+
+    ARGUMENTS
+        features : output from parseruteplan, iterruteplan or ruteplan2dict (list, or iterable
+        of lists, one per call to ruteplan)
+
+        filnavn : GeoPackage file, or directory for FlatGeobuf files (one per layer). Existing
+        output is replaced
+
+    KEYWORDS
+        format = None, 'GPKG' or 'FlatGeobuf'. Default is GPKG if filnavn ends with .gpkg,
+        otherwise FlatGeobuf
+
+        toleranser = ( 10, 100, 1000 ), simplification tolerances (meters) of the overview layers
+
+        crs = 5973
+
+        segmenter = True, write the layer with one row per geometry element
+
+        manovrer = True, write the maneuver point layer
+
+    RETURNS
+        dictionary { layer name : number of features }
+    """
+    if format is None:
+        format = 'GPKG' if filnavn.lower().endswith( '.gpkg' ) else 'FlatGeobuf'
+    if format not in ( 'GPKG', 'FlatGeobuf' ):
+        raise ValueError( f"format must be 'GPKG' or 'FlatGeobuf', not {format}" )
+
+    lag = lagtabeller( features, toleranser=toleranser, crs=crs, segmenter=segmenter, manovrer=manovrer )
+
+    if format == 'GPKG':
+        if os.path.exists( filnavn ):
+            os.remove( filnavn )
+        for navn, gdf in lag.items():
+            _skriv( gdf, filnavn, navn, 'GPKG' )
+    else:
+        if os.path.isdir( filnavn ):
+            shutil.rmtree( filnavn )
+        os.makedirs( filnavn )
+        for navn, gdf in lag.items():
+            _skriv( gdf, os.path.join( filnavn, navn + '.fgb' ), navn, 'FlatGeobuf' )
+
+    return { navn : len( gdf ) for navn, gdf in lag.items() }
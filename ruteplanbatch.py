@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""Concurrent batch routing against the ruteplan API
+
+Routes many origin/destination pairs with a pool of threads sharing one
+ruteplan.RuteplanClient (and hence one pooled HTTP session), while a token bucket
+enforces both a per-second rate and the daily quota of 2500 calls. The daily
+budget is persisted to a small json file, so it survives process restarts and can be
+shared by several processes (on platforms with fcntl, i.e. not Windows).
+
+Usage:
+
+    import ruteplanbatch
+
+    limiter = ruteplanbatch.TokenBucket( rate=5, daily_limit=2500, statefile='ruteplankvote.json' )
+    inputs = [ [ (262819.18, 6649657.89), (260805.98, 6649240.36) ],
+               { 'stops' : '277648.7,6760327.3;292465.4,6695768.8' } ]
+    for res in ruteplanbatch.rutebatch( inputs, concurrency=4, ratelimiter=limiter ):
+        if res['error']:
+            print( res['index'], res['error'] )
+        else:
+            print( res['index'], len( res['data'] ) )
+
+Each result is a dictionary with the keys 'index' (position in the input),
+'input', 'data' and 'error'. Errors (HTTP errors, error messages from ruteplan,
+exhausted quota, network problems) are captured per item instead of being raised.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import ruteplan
+import instrumentering
+
+# Fillås for kvotefila, finnes ikke på Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class QuotaExceeded( RuntimeError ):
+    """Raised when the daily call budget is used up"""
+    pass
+
+
+class TokenBucket:
+    """Thread safe token bucket rate limiter with a persisted daily budget
+
+    KEYWORDS
+        rate = 5, sustained number of calls per second
+
+        burst = None, bucket size, i.e. how many calls may be made back to back.
+        Defaults to max( 1, rate )
+
+        daily_limit = 2500, maximum number of calls per calendar day (local time).
+        None means no daily limit
+
+        statefile = None, path to json file where the number of calls made today is
+        stored. If None the daily budget is only counted in memory. The count is read
+        again and updated under a file lock (statefile + '.lock') for every call, so
+        several processes using the same statefile share one daily budget. Without
+        fcntl (Windows) there is no file lock, use one process per statefile there
+
+    The rate limit (and burst) applies per TokenBucket instance, not across processes.
+    """
+
+    def __init__( self, rate=5, burst=None, daily_limit=2500, statefile=None ):
+        if rate is None or not rate > 0:
+            raise ValueError( f"rate must be a positive number of calls per second, not {rate}" )
+        if burst is not None and not burst >= 1:
+            raise ValueError( f"burst must be at least 1, not {burst}" )
+        if daily_limit is not None and not daily_limit >= 0:
+            raise ValueError( f"daily_limit must be zero or more, or None, not {daily_limit}" )
+        self.rate           = rate
+        self.burst          = burst if burst is not None else max( 1, rate )
+        self.daily_limit    = daily_limit
+        self.statefile      = statefile
+        self._tokens        = self.burst
+        self._last          = time.monotonic()
+        self._lock          = threading.Lock()
+        self._day           = datetime.date.today().isoformat()
+        self._used          = 0
+        self._used          = self._load()
+
+    def _load( self ):
+        """Number of calls made today according to the statefile (or in memory without one)"""
+        if not self.statefile:
+            return self._used
+        try:
+            with open( self.statefile ) as f:
+                state = json.load( f )
+        except FileNotFoundError:
+            return 0
+        return state.get( 'brukt', 0 ) if state.get( 'dato' ) == self._day else 0
+
+    def _rollover( self ):
+        """New day, new budget. Caller must hold the lock"""
+        today = datetime.date.today().isoformat()
+        if today != self._day:
+            self._day = today
+            self._used = 0
+        # Andre prosesser kan ha brukt av kvoten
+        self._used = self._load()
+
+    @contextlib.contextmanager
+    def _filelock( self ):
+        """Exclusive lock on statefile + '.lock', shared with other processes. Caller must hold the lock"""
+        if not self.statefile or fcntl is None:
+            yield
+            return
+        with open( self.statefile + '.lock', 'a' ) as f:
+            fcntl.flock( f, fcntl.LOCK_EX )
+            try:
+                yield
+            finally:
+                fcntl.flock( f, fcntl.LOCK_UN )
+
+    def _reserve( self ):
+        """Counts one call against the daily budget, False if it is used up. Caller must hold the lock"""
+        with self._filelock():
+            self._rollover()
+            if self.daily_limit is not None and self._used >= self.daily_limit:
+                return False
+            self._used += 1
+            self._save()
+        return True
+
+    def _oppbrukt( self ):
+        instrumentering.tell( 'kvote.oppbrukt' )
+        return QuotaExceeded( f"Daily quota of {self.daily_limit} calls to ruteplan is used up" )
+
+    def _save( self ):
+        """Caller must hold the lock"""
+        if self.statefile:
+            tmpfile = f"{self.statefile}.{os.getpid()}.tmp"
+            with open( tmpfile, 'w' ) as f:
+                json.dump( { 'dato' : self._day, 'brukt' : self._used }, f )
+            os.replace( tmpfile, self.statefile )
+
+    def remaining( self ):
+        """Number of calls left of today's budget (None if there is no daily limit)"""
+        with self._lock:
+            self._rollover()
+            if self.daily_limit is None:
+                return None
+            return max( self.daily_limit - self._used, 0 )
+
+    def used( self ):
+        """Number of calls made today"""
+        with self._lock:
+            self._rollover()
+            return self._used
+
+    def acquire( self ):
+        """Blocks until a call may be made. Raises QuotaExceeded if the daily budget is used up"""
+
+        while True:
+            with self._lock:
+                self._rollover()
+                if self.daily_limit is not None and self._used >= self.daily_limit:
+                    raise self._oppbrukt()
+
+                now = time.monotonic()
+                self._tokens = min( self.burst, self._tokens + ( now - self._last ) * self.rate )
+                self._last = now
+
+                if self._tokens >= 1:
+                    if not self._reserve():
+                        raise self._oppbrukt()
+                    self._tokens -= 1
+                    break
+
+                wait_time = ( 1 - self._tokens ) / self.rate
+
+            instrumentering.tell( 'kvote.ventetid_s', wait_time )
+            time.sleep( wait_time )
+
+        instrumentering.tell( 'kvote.brukt' )
+
+
+def _rutekall( klient, item, parse ):
+    """Routes one input item, returns the parsed data. Raises on any error"""
+
+    if isinstance( item, dict ):
+        kwargs = dict( item )
+    else:
+        kwargs = { 'coordinates' : list( item ) }
+
+    r = klient.route( **kwargs )
+    if parse == 'response':
+        return r
+
+    features = ruteplan.parseruteplan( r )
+    if parse == 'features':
+        return features
+
+    return ruteplan.features2dict( features )
+
+
+def rutebatch( inputs, klient=None, concurrency=4, ratelimiter=None, ordered=True, parse='dict' ):
+    """Routes an iterable of coordinate lists or parameter dicts concurrently
+
+    Generator, yields one result dictionary per input item:
+        { 'index' : position in input, 'input' : the input item, 'data' : parsed data or None,
+          'error' : exception instance or None }
+
+    ARGUMENTS
+        inputs : iterable. Each item is either a list of (x,y) tuples (the coordinates keyword
+        of anropruteplan) or a dictionary with keywords for anropruteplan, e.g.
+        { 'coordinates' : [...], 'ruteplanparams' : {...} } or { 'stops' : '...' }
+
+    KEYWORDS
+        klient = None, ruteplan.RuteplanClient instance. Default is ruteplan.standardklient()
+
+        concurrency = 4, number of worker threads. Make sure the connection pool of the
+        client is at least this large
+
+        ratelimiter = None, TokenBucket instance. Defaults to the rate limiter of the client.
+        Only calls that actually reach the ruteplan API (i.e. not cache hits) use tokens, and every
+        retry after a 429 / 5xx response uses one more
+
+        ordered = True, yield results in input order. If False results are yielded as they complete
+
+        parse = 'dict', one of 'dict' (same as ruteplan2dict), 'features' (same as parseruteplan)
+        or 'response' (the raw requests response object)
+
+    RETURNS
+        generator of result dictionaries
+    """
+
+    if parse not in ( 'dict', 'features', 'response' ):
+        raise ValueError( f"parse must be one of 'dict', 'features', 'response', not {parse}" )
+
+    if klient is None:
+        klient = ruteplan.standardklient()
+
+    if ratelimiter is not None and ratelimiter is not klient.ratelimiter:
+        klient = klient.with_ratelimiter( ratelimiter )
+
+    def worker( index, item ):
+        result = { 'index' : index, 'input' : item, 'data' : None, 'error' : None }
+        try:
+            result['data'] = _rutekall( klient, item, parse )
+        except Exception as e:
+            result['error'] = e
+        return result
+
+    # Begrenser antall samtidige jobber i køen, slik at minnebruken er uavhengig av antall inputs
+    window = max( 1, concurrency ) * 4
+    iterator = enumerate( inputs )
+    with ThreadPoolExecutor( max_workers=concurrency ) as executor:
+
+        pending = deque()
+        for index, item in iterator:
+            pending.append( executor.submit( worker, index, item ) )
+            if len( pending ) >= window:
+                break
+
+        if ordered:
+            while pending:
+                yield pending.popleft().result()
+                for index, item in iterator:
+                    pending.append( executor.submit( worker, index, item ) )
+                    break
+
+        else:
+            running = set( pending )
+            while running:
+                done, running = wait( running, return_when=FIRST_COMPLETED )
+                for future in done:
+                    yield future.result()
+                    for index, item in iterator:
+                        running.add( executor.submit( worker, index, item ) )
+                        break
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent on-disk cache for responses from the ruteplan API
+
+Saves quota (2500 calls per day) and wall time when the same routes are requested
+over and over again, for example in nightly re-runs of batch jobs.
+
+Usage:
+
+    import ruteplan
+    from ruteplancache import RuteplanCache
+
+    cache = RuteplanCache( 'ruteplancache.sqlite', ttl=7*24*3600, max_entries=100000 )
+    r = ruteplan.anropruteplan( coordinates=[ (269756.5,7038421.3), (269682.4,7039315.6)], cache=cache )
+    features = ruteplan.parseruteplan( r )
+    print( cache.stats() )
+
+The cache key is computed from the fully merged request, i.e. the server url and the
+final set of query parameters (ruteplanparams + the "stops" string built from
+coordinates + keyword overrides), see function cachekey. Only successful responses
+(HTTP 2xx) are stored.
+
+Cached responses are returned as regular requests.Response objects, so ruteplan2dict and
+parseruteplan work exactly the same on cached and fresh responses. Cached responses have
+the attribute from_cache = True.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+def cachekey( url, params ):
+    """Normalized, deterministic cache key for a ruteplan request
+
+    Parameter names are sorted, all values are converted to strings (the query string
+    makes no difference between 5 and '5') and list values (e.g. ReturnFields) are sorted,
+    since they are sent as repeated query parameters where the order does not matter.
+
+    ARGUMENTS
+        url : string, url to ruteplan endpoint
+
+        params : dict, the final query parameters
+
+    RETURNS
+        string, sha256 hex digest
+    """
+
+    normalized = {}
+    for key, value in params.items():
+        if isinstance( value, (list, tuple, set) ):
+            normalized[str(key)] = sorted( str( x ) for x in value )
+        elif value is None:
+            continue
+        else:
+            normalized[str(key)] = str( value )
+
+    text = json.dumps( { 'url' : url, 'params' : normalized }, sort_keys=True,
+                      separators=(',', ':'), ensure_ascii=False )
+    return hashlib.sha256( text.encode( 'utf-8') ).hexdigest()
+
+
+class RuteplanCache:
+    """SQLite-backed response cache with TTL and size bounded LRU eviction
+
+    ARGUMENTS
+        filename : string, path to sqlite file. Use ':memory:' for a non-persistent cache
+
+    KEYWORDS
+        ttl = None : Time to live in seconds. None means entries never expire
+
+        max_entries = None : Maximum number of cached responses. Least recently used
+                            entries are evicted when exceeded. None = no limit
+
+        max_bytes = None : Maximum total size (bytes) of cached response bodies. Least recently
+                            used entries are evicted when exceeded. None = no limit
+
+    The cache is thread safe, one instance may be shared between threads.
+    """
+
+    def __init__( self, filename='ruteplancache.sqlite', ttl=None, max_entries=None, max_bytes=None ):
+        self.filename       = filename
+        self.ttl            = ttl
+        self.max_entries    = max_entries
+        self.max_bytes      = max_bytes
+        self.hits           = 0
+        self.misses         = 0
+        self.evictions      = 0
+        self._lock          = threading.Lock()
+        self._conn          = sqlite3.connect( filename, check_same_thread=False )
+        with self._conn:
+            self._conn.execute( """CREATE TABLE IF NOT EXISTS responses (
+                                    key TEXT PRIMARY KEY,
+                                    url TEXT,
+                                    status_code INTEGER,
+                                    reason TEXT,
+                                    headers TEXT,
+                                    content BLOB,
+                                    size INTEGER,
+                                    created REAL,
+                                    accessed REAL )""" )
+            self._conn.execute( "CREATE INDEX IF NOT EXISTS responses_accessed ON responses ( accessed )" )
+
+    def get( self, key ):
+        """Returns cached requests.Response object for this key, or None"""
+
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute( """SELECT url, status_code, reason, headers, content, created
+                                         FROM responses WHERE key = ?""", (key,) ).fetchone()
+
+            if row and self.ttl is not None and now - row[5] > self.ttl:
+                with self._conn:
+                    self._conn.execute( "DELETE FROM responses WHERE key = ?", (key,) )
+                self.evictions += 1
+                row = None
+
+            if not row:
+                self.misses += 1
+                return None
+
+            with self._conn:
+                self._conn.execute( "UPDATE responses SET accessed = ? WHERE key = ?", (now, key) )
+            self.hits += 1
+
+        r = requests.Response()
+        r.url           = row[0]
+        r.status_code   = row[1]
+        r.reason        = row[2]
+        r.headers       = CaseInsensitiveDict( json.loads( row[3] ) )
+        r._content      = row[4]
+        r.encoding      = 'utf-8'
+        r.from_cache    = True
+        return r
+
+    def put( self, key, response ):
+        """Stores a requests.Response object. Unsuccessful responses are ignored"""
+
+        if not response.ok:
+            return
+
+        content = response.content
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute( """INSERT OR REPLACE INTO responses
+                                       ( key, url, status_code, reason, headers, content, size, created, accessed )
+                                       VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )""",
+                                   ( key, response.url, response.status_code, response.reason,
+                                     json.dumps( dict( response.headers ) ), content, len( content ), now, now ) )
+            self._evict()
+
+    def _evict( self ):
+        """Removes expired entries, then least recently used entries until within size bounds.
+        Caller must hold the lock"""
+
+        with self._conn:
+            if self.ttl is not None:
+                cur = self._conn.execute( "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,) )
+                self.evictions += max( cur.rowcount, 0 )
+
+            if self.max_entries is not None:
+                count = self._conn.execute( "SELECT COUNT(*) FROM responses" ).fetchone()[0]
+                if count > self.max_entries:
+                    cur = self._conn.execute( """DELETE FROM responses WHERE key IN
+                                                 ( SELECT key FROM responses ORDER BY accessed LIMIT ? )""",
+                                             (count - self.max_entries,) )
+                    self.evictions += max( cur.rowcount, 0 )
+
+            if self.max_bytes is not None:
+                total = self._conn.execute( "SELECT COALESCE( SUM(size), 0) FROM responses" ).fetchone()[0]
+                if total > self.max_bytes:
+                    excess = total - self.max_bytes
+                    keys = []
+                    for key, size in self._conn.execute( "SELECT key, size FROM responses ORDER BY accessed" ):
+                        keys.append( (key,) )
+                        excess -= size
+                        if excess <= 0:
+                            break
+                    self._conn.executemany( "DELETE FROM responses WHERE key = ?", keys )
+                    self.evictions += len( keys )
+
+    def clear( self ):
+        """Removes all cached responses and resets the counters"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute( "DELETE FROM responses" )
+            self.hits       = 0
+            self.misses     = 0
+            self.evictions  = 0
+
+    def stats( self ):
+        """Returns dictionary with hit/miss counters and cache size"""
+        with self._lock:
+            entries, size = self._conn.execute( "SELECT COUNT(*), COALESCE( SUM(size), 0) FROM responses" ).fetchone()
+
+        return { 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions,
+                 'entries' : entries, 'bytes' : size }
+
+    def close( self ):
+        with self._lock:
+            self._conn.close()
+
+    def __len__( self ):
+        with self._lock:
+            return self._conn.execute( "SELECT COUNT(*) FROM responses" ).fetchone()[0]
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+"""Interned table of route segments, and link load aggregation across many routes
+
+Every route from ruteplan carries its own list of nvdbReferenceLinks, and a city wide batch
+stores the same linear reference intervals (like 0.37648714-0.72087082@605474 'Against')
+thousands of times. SegmentTabell keeps each distinct (nvdbReferenceId, fromLength,
+toLength, direction) once, in compact NumPy columns, and each route is just a run of
+integer segment indices (CSR layout: route ii uses segments ruteindeks[offsets[ii]:offsets[ii+1]]).
+
+On top of this, belastning() computes the link load, i.e. how many routes (or the sum of
+route weights, e.g. number of trips) use each stretch of road. Where segments of the same
+link sequence and direction overlap, the result is split into sub-intervals, so a stretch
+used by 3 routes and the overlapping stretch used by 5 routes become separate rows, without
+any join over the individual route rows.
+
+Usage:
+
+    import segmenttabell
+    tabell = segmenttabell.SegmentTabell()
+    for r, antall_turer in zip( responser, turer ):
+        tabell.legg_til_respons( ruteplan.lesrespons( r ), vekt=antall_turer )
+    last = tabell.belastning()          # dictionary of numpy arrays
+    geom = segmenttabell.geometri( last, lager.veglenker( set( last['nvdbReferenceId'] ) ) )
+"""
+
+from array import array
+
+import numpy as np
+import shapely
+
+
+# Retning kodes som heltall, med oppslag i SegmentTabell.retninger
+RETNINGER = ( 'With', 'Against' )
+
+
+class SegmentTabell:
+    """Interned segments and the routes using them
+
+    Positions are rounded to 8 decimals (like NVDB) before interning.
+    """
+
+    def __init__( self ):
+        self._oppslag       = {}
+        self._vid           = array( 'q' )
+        self._fra           = array( 'd' )
+        self._til           = array( 'd' )
+        self._retning       = array( 'b' )
+        self.retninger      = list( RETNINGER )
+        self._retningskoder = { navn : kode for kode, navn in enumerate( RETNINGER ) }
+        self._ruteindeks    = array( 'q' )
+        self._offsets       = array( 'q', [ 0 ] )
+        self._vekt          = array( 'd' )
+
+    def __len__( self ):
+        """Number of distinct segments"""
+        return len( self._vid )
+
+    @property
+    def nruter( self ):
+        return len( self._offsets ) - 1
+
+    # Kolonnene som numpy-arrays, uten kopiering
+    @property
+    def nvdbReferenceId( self ):
+        return np.frombuffer( self._vid, dtype=np.int64 ) if len( self._vid ) else np.empty( 0, dtype=np.int64 )
+
+    @property
+    def fromLength( self ):
+        return np.frombuffer( self._fra, dtype=np.float64 ) if len( self._fra ) else np.empty( 0 )
+
+    @property
+    def toLength( self ):
+        return np.frombuffer( self._til, dtype=np.float64 ) if len( self._til ) else np.empty( 0 )
+
+    @property
+    def direction( self ):
+        return np.frombuffer( self._retning, dtype=np.int8 ) if len( self._retning ) else np.empty( 0, dtype=np.int8 )
+
+    @property
+    def ruteindeks( self ):
+        return np.frombuffer( self._ruteindeks, dtype=np.int64 ) if len( self._ruteindeks ) else np.empty( 0, dtype=np.int64 )
+
+    @property
+    def offsets( self ):
+        return np.frombuffer( self._offsets, dtype=np.int64 )
+
+    @property
+    def vekt( self ):
+        return np.frombuffer( self._vekt, dtype=np.float64 ) if len( self._vekt ) else np.empty( 0 )
+
+    @property
+    def nbytes( self ):
+        """Approximate memory use of the columns, in bytes (the interning dictionary not included)"""
+        return sum( a.itemsize * len( a ) for a in ( self._vid, self._fra, self._til, self._retning,
+                                                     self._ruteindeks, self._offsets, self._vekt ) )
+
+    def _retningskode( self, retning ):
+        kode = self._retningskoder.get( retning )
+        if kode is None:
+            kode = self._retningskoder[retning] = len( self.retninger )
+            self.retninger.append( retning )
+        return kode
+
+    def _ny( self, key ):
+        indeks = self._oppslag[key] = len( self._vid )
+        self._vid.append( int( key[0] ) )
+        self._fra.append( round( float( key[1] ), 8 ) )
+        self._til.append( round( float( key[2] ), 8 ) )
+        self._retning.append( self._retningskode( key[3] ) )
+        return indeks
+
+    def intern( self, nvdbReferenceId, fromLength, toLength, direction=None ):
+        """Returns the index of the segment, adding it to the table if it is new"""
+        key = ( int( nvdbReferenceId ), round( float( fromLength ), 8 ), round( float( toLength ), 8 ), direction )
+        indeks = self._oppslag.get( key )
+        if indeks is None:
+            indeks = self._ny( key )
+        return indeks
+
+    def legg_til_rute( self, linkrefs, vekt=1.0 ):
+        """Adds one route, given as a list of nvdbReferenceLinks. Returns the route number"""
+        # Slår først opp på verdiene slik de kommer fra ruteplan (id som tekst), og
+        # normaliserer bare når det er nødvendig. Begge variantene peker til samme indeks
+        oppslag = self._oppslag
+        indekser = []
+        for ref in linkrefs:
+            raa = ( ref['nvdbReferenceId'], ref['fromLength'], ref['toLength'], ref.get( 'direction' ) )
+            indeks = oppslag.get( raa )
+            if indeks is None:
+                indeks = self.intern( *raa )
+                oppslag[raa] = indeks
+            indekser.append( indeks )
+        self._ruteindeks.extend( indekser )
+        self._offsets.append( len( self._ruteindeks ) )
+        self._vekt.append( vekt )
+        return self.nruter - 1
+
+    def legg_til_respons( self, data, vekt=1.0, alle_alternativer=False ):
+        """Adds the routes of a decoded ruteplan response (see ruteplan.lesrespons)
+
+        KEYWORDS
+            vekt = 1.0, weight of the route, e.g. number of trips
+
+            alle_alternativer = False, add all route alternatives, not only the first (best) one
+
+        RETURNS
+            list of route numbers
+        """
+        ruter = data['routes'] if alle_alternativer else data['routes'][:1]
+        return [ self.legg_til_rute( rute.get( 'nvdbReferenceLinks', [] ), vekt=vekt ) for rute in ruter ]
+
+    def segmenter( self, rutenr ):
+        """Segment indices of a route"""
+        return self.ruteindeks[self._offsets[rutenr]:self._offsets[rutenr+1]]
+
+    def linkrefs( self, rutenr ):
+        """The nvdbReferenceLinks of a route, as a list of dictionaries"""
+        return [ { 'nvdbReferenceId' : str( self._vid[ii] ), 'fromLength' : self._fra[ii], 'toLength' : self._til[ii],
+                   'direction' : self.retninger[self._retning[ii]] } for ii in self.segmenter( rutenr ) ]
+
+    def segmentbelastning( self, ruter=None ):
+        """Number of routes and sum of route weights per segment
+
+        KEYWORDS
+            ruter = None, boolean mask or index array selecting routes. Default is all routes
+
+        RETURNS
+            tuple of numpy arrays ( antall, vekt ), one element per segment
+        """
+        lengder = np.diff( self.offsets )
+        vekt = self.vekt
+        if ruter is not None:
+            valgt = np.zeros( self.nruter, dtype=bool )
+            valgt[ruter] = True
+            vekt = np.where( valgt, vekt, 0.0 )
+            lengder_valgt = np.where( valgt, 1, 0 )
+        else:
+            lengder_valgt = np.ones( self.nruter, dtype=np.int64 )
+
+        indeks = self.ruteindeks
+        antall = np.bincount( indeks, weights=np.repeat( lengder_valgt, lengder ), minlength=len( self ) )
+        sum_vekt = np.bincount( indeks, weights=np.repeat( vekt, lengder ), minlength=len( self ) )
+        return antall.astype( np.int64 ), sum_vekt
+
+    def belastning( self, ruter=None, splitt=True, retningsdelt=True ):
+        """Link load: number of routes and sum of route weights per stretch of road
+
+        KEYWORDS
+            ruter = None, boolean mask or index array selecting routes. Default is all routes
+
+            splitt = True, split overlapping segments into sub-intervals with the combined load.
+            If False, the load is given per interned segment (overlaps are not combined)
+
+            retningsdelt = True, keep the two directions apart. If False, loads in both
+            directions are added, and 'direction' is None
+
+        RETURNS
+            dictionary of numpy arrays, one element per stretch: 'nvdbReferenceId', 'fromLength',
+            'toLength', 'direction' (text), 'antall' (number of routes) and 'vekt' (sum of weights).
+            Sorted by nvdbReferenceId, direction and position. Stretches without routes are left out
+        """
+        antall, vekt = self.segmentbelastning( ruter=ruter )
+        brukt = antall > 0
+        vid, fra, til = self.nvdbReferenceId[brukt], self.fromLength[brukt], self.toLength[brukt]
+        retning = self.direction[brukt] if retningsdelt else np.zeros( brukt.sum(), dtype=np.int8 )
+        antall, vekt = antall[brukt], vekt[brukt]
+        lo, hi = np.minimum( fra, til ), np.maximum( fra, til )
+
+        if not splitt:
+            order = np.lexsort( ( lo, retning, vid ) )
+            return self._resultat( vid[order], lo[order], hi[order], retning[order], antall[order], vekt[order], retningsdelt )
+
+        # Sveip: +last ved start og -last ved slutt av hvert intervall, summert kumulativt per gruppe
+        gruppe = vid * 128 + retning
+        n = len( vid )
+        ev_gruppe = np.concatenate( [ gruppe, gruppe ] )
+        ev_pos = np.concatenate( [ lo, hi ] )
+        ev_antall = np.concatenate( [ antall, -antall ] )
+        ev_vekt = np.concatenate( [ vekt, -vekt ] )
+        order = np.lexsort( ( ev_pos, ev_gruppe ) )
+        ev_gruppe, ev_pos, ev_antall, ev_vekt = ev_gruppe[order], ev_pos[order], ev_antall[order], ev_vekt[order]
+
+        cum_antall = np.cumsum( ev_antall )
+        cum_vekt = np.cumsum( ev_vekt )
+        # Trekker fra summen ved starten av gruppa, så avrundingsfeil ikke drar med seg fra gruppe til gruppe
+        ny = np.ones( 2 * n, dtype=bool )
+        ny[1:] = ev_gruppe[1:] != ev_gruppe[:-1]
+        start = np.maximum.accumulate( np.where( ny, np.arange( 2 * n ), 0 ) )
+        grunn = np.where( start > 0, cum_vekt[start - 1], 0.0 ) if n else cum_vekt
+        cum_vekt = cum_vekt - grunn
+
+        # Delintervall mellom to påfølgende hendelser i samme gruppe, der minst én rute går
+        i = np.arange( 2 * n - 1 )
+        gyldig = ( ev_gruppe[i] == ev_gruppe[i+1] ) & ( ev_pos[i+1] > ev_pos[i] ) & ( cum_antall[i] > 0 )
+        i = i[gyldig]
+        s_gruppe, s_fra, s_til = ev_gruppe[i], ev_pos[i], ev_pos[i+1]
+        s_antall, s_vekt = cum_antall[i], cum_vekt[i]
+
+        # Slår sammen nabointervall med samme last
+        if len( i ):
+            ny = np.ones( len( i ), dtype=bool )
+            ny[1:] = ( ( s_gruppe[1:] != s_gruppe[:-1] ) | ( s_fra[1:] != s_til[:-1] ) | ( s_antall[1:] != s_antall[:-1] )
+                       | ~np.isclose( s_vekt[1:], s_vekt[:-1] ) )
+            forste = np.flatnonzero( ny )
+            siste = np.append( forste[1:], len( i ) ) - 1
+            s_gruppe, s_fra, s_til = s_gruppe[forste], s_fra[forste], s_til[siste]
+            s_antall, s_vekt = s_antall[forste], s_vekt[forste]
+
+        return self._resultat( s_gruppe // 128, s_fra, s_til, ( s_gruppe % 128 ).astype( np.int8 ),
+                               s_antall, s_vekt, retningsdelt )
+
+    def _resultat( self, vid, fra, til, retning, antall, vekt, retningsdelt ):
+        if retningsdelt:
+            tekst = np.asarray( self.retninger, dtype=object )[retning] if len( retning ) else np.empty( 0, dtype=object )
+        else:
+            tekst = np.full( len( vid ), None, dtype=object )
+        return { 'nvdbReferenceId' : np.asarray( vid, dtype=np.int64 ), 'fromLength' : np.round( fra, 8 ),
+                 'toLength' : np.round( til, 8 ), 'direction' : tekst,
+                 'antall' : np.asarray( antall, dtype=np.int64 ), 'vekt' : np.asarray( vekt, dtype=np.float64 ) }
+
+
+def geometri( belastning, veglenker ):
+    """Geometry of each stretch in a link load result, cut from the road link geometries
+
+    ARGUMENTS
+        belastning : result from SegmentTabell.belastning
+
+        veglenker : road links of the link sequences, e.g. nvdbnettverk.VeglenkesekvensLager.veglenker,
+        with veglenkesekvensid, startposisjon, sluttposisjon and geometri (wkt)
+
+    RETURNS
+        numpy array of shapely geometries (None where no road link geometry is found)
+    """
+    from shapely.ops import substring
+
+    if hasattr( veglenker, 'to_dict' ):
+        veglenker = veglenker.to_dict( 'records' )
+    per_vid = {}
+    for lenke in veglenker:
+        if lenke.get( 'geometri' ):
+            per_vid.setdefault( int( lenke['veglenkesekvensid'] ), [] ).append(
+                ( float( lenke['startposisjon'] ), float( lenke['sluttposisjon'] ), lenke['geometri'] ) )
+    for vid in per_vid:
+        per_vid[vid].sort( key=lambda x: x[0] )
+    parsed = {}
+
+    resultat = np.full( len( belastning['nvdbReferenceId'] ), None, dtype=object )
+    for ii, ( vid, fra, til ) in enumerate( zip( belastning['nvdbReferenceId'], belastning['fromLength'], belastning['toLength'] ) ):
+        biter = []
+        for start, slutt, wkt in per_vid.get( int( vid ), [] ):
+            if slutt <= fra or start >= til or slutt <= start:
+                continue
+            if wkt not in parsed:
+                parsed[wkt] = shapely.force_2d( shapely.from_wkt( wkt ) )
+            bit = substring( parsed[wkt], ( max( fra, start ) - start ) / ( slutt - start ),
+                             ( min( til, slutt ) - start ) / ( slutt - start ), normalized=True )
+            if bit.geom_type == 'LineString':
+                biter.append( shapely.get_coordinates( bit ) )
+        if biter:
+            resultat[ii] = shapely.linestrings( np.concatenate( biter ) )
+    return resultat
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""Snapping of stop coordinates before routing, so nearby inputs share one ruteplan call
+
+anropruteplan builds the stops string from the raw coordinates, so two addresses a few
+meters apart on the same road become two different requests. This module snaps the stops
+either to a regular grid (Rutenett) or to a point on the nearest road link of a local copy
+of the road network (Vegnettsnapper), routes each unique combination of snapped stops once,
+and fans the result out to every input that snapped to the same stops.
+
+Usage:
+
+    import stoppsnapping
+    snapper = stoppsnapping.Rutenett( 25 )
+    statistikk = {}
+    for res in stoppsnapping.snapbatch( inputs, snapper, concurrency=4, statistikk=statistikk ):
+        ...
+    print( statistikk )     # { 'inndata' : 10000, 'unike' : 3412, 'spart' : 6588, ... }
+
+Snapping moves the stops, so the routes start and end up to a few meters off the original
+coordinates (at most half the grid diagonal with Rutenett, or the distance to the road plus
+half the resolution with Vegnettsnapper). Ruteplan snaps the stops to the road network
+anyway, so with a resolution of 10-50 m the difference is usually small. The result items
+also carry the snapped input, and results that are shared between inputs are the same object.
+"""
+
+import json
+
+import numpy as np
+import shapely
+
+import ruteplanbatch
+import instrumentering
+
+
+class Rutenett:
+    """Snaps coordinates to the nearest node of a regular grid
+
+    ARGUMENTS
+        storrelse : grid size in meters
+    """
+
+    def __init__( self, storrelse=10.0 ):
+        if storrelse <= 0:
+            raise ValueError( f"Grid size must be positive, not {storrelse}" )
+        self.storrelse = float( storrelse )
+
+    def snap( self, xy ):
+        """( n, 2 ) array of coordinates => ( n, 2 ) array of snapped coordinates"""
+        xy = np.asarray( xy, dtype=np.float64 ).reshape( -1, 2 )
+        return np.round( xy / self.storrelse ) * self.storrelse
+
+
+class Vegnettsnapper:
+    """Snaps coordinates to the nearest road link of a local road network
+
+    The point is moved to the nearest road link, and its position along the link rounded to
+    the given resolution, so all inputs using the same stretch of road get the same stop.
+    Points further from the road network than maks_avstand are handled by the fallback
+    snapper, or left as they are.
+
+    ARGUMENTS
+        veglenker : road link dictionaries (or DataFrame) with 'geometri' as wkt, e.g. from
+        nvdbnettverk.VeglenkesekvensLager.veglenker or lokalruting.syntetisknettverk. A
+        lokalruting.LokalRuter instance can be given instead, reusing its spatial index
+
+    KEYWORDS
+        opplosning = 10.0, resolution in meters along the road link
+
+        maks_avstand = 100.0, max distance in meters from the road network
+
+        reserve = None, snapper to use for points far from the road network, e.g. Rutenett( 10 )
+    """
+
+    def __init__( self, veglenker, opplosning=10.0, maks_avstand=100.0, reserve=None ):
+        if hasattr( veglenker, 'tree' ) and hasattr( veglenker, 'geom' ):
+            self.geom = veglenker.geom
+            self.tree = veglenker.tree
+        else:
+            if hasattr( veglenker, 'to_dict' ):
+                veglenker = veglenker.to_dict( 'records' )
+            # Samme utvalg som i lokalruting: Vegtrasé overlapper kjørebanene
+            wkt = [ lenke['geometri'] for lenke in veglenker
+                    if lenke.get( 'geometri' ) and lenke.get( 'detaljnivå' ) != 'Vegtrasé' ]
+            if not wkt:
+                raise ValueError( 'No road links with geometry to snap to' )
+            self.geom = shapely.force_2d( shapely.from_wkt( wkt ) )
+            self.tree = shapely.STRtree( self.geom )
+        self.lengde = shapely.length( self.geom )
+        self.opplosning = float( opplosning )
+        self.maks_avstand = maks_avstand
+        self.reserve = reserve
+
+    def snap( self, xy ):
+        """( n, 2 ) array of coordinates => ( n, 2 ) array of snapped coordinates"""
+        xy = np.asarray( xy, dtype=np.float64 ).reshape( -1, 2 )
+        punkter = shapely.points( xy )
+        resultat = xy.copy()
+        if not len( xy ):
+            return resultat
+
+        ( ip, ilenke ), avstand = self.tree.query_nearest( punkter, max_distance=self.maks_avstand,
+                                                           return_distance=True, all_matches=False )
+        if len( ip ):
+            geom = self.geom[ilenke]
+            pos = shapely.line_locate_point( geom, punkter[ip] )
+            pos = np.clip( np.round( pos / self.opplosning ) * self.opplosning, 0, self.lengde[ilenke] )
+            resultat[ip] = shapely.get_coordinates( shapely.line_interpolate_point( geom, pos ) )
+
+        utenfor = np.ones( len( xy ), dtype=bool )
+        utenfor[ip] = False
+        if self.reserve is not None and utenfor.any():
+            resultat[utenfor] = self.reserve.snap( xy[utenfor] )
+        return resultat
+
+
+def _koordinater( item ):
+    """Input item (as for ruteplanbatch.rutebatch) => ( list of (x,y), other keywords, uses stops string )"""
+    if isinstance( item, dict ):
+        kwargs = dict( item )
+        if 'stops' in kwargs:
+            stops = kwargs.pop( 'stops' )
+            return [ tuple( float( v ) for v in stopp.split( ',' ) ) for stopp in stops.split( ';' ) ], kwargs, True
+        if 'ruteplanparams' in kwargs and 'stops' in kwargs['ruteplanparams']:
+            # Stops i ruteplanparams overstyrer coordinates, se anropruteplan. Lar disse være i fred
+            return None, kwargs, False
+        return list( kwargs.pop( 'coordinates' ) ), kwargs, False
+    return list( item ), {}, False
+
+
+def _snappet( koordinater, kwargs, stopsform ):
+    """Builds the input item for ruteplanbatch from the snapped coordinates"""
+    koordinater = [ ( float( x ), float( y ) ) for x, y in koordinater ]
+    if stopsform:
+        return dict( kwargs, stops=';'.join( str( x ) + ',' + str( y ) for x, y in koordinater ) )
+    if kwargs:
+        return dict( kwargs, coordinates=koordinater )
+    return koordinater
+
+
+def grupper( inputs, snapper ):
+    """Snaps the stops of all inputs, and groups inputs with identical snapped stops
+
+    ARGUMENTS
+        inputs : list of input items, see ruteplanbatch.rutebatch
+
+        snapper : Rutenett, Vegnettsnapper or any object with a snap( xy ) method
+
+    RETURNS
+        tuple ( unike, gruppe, statistikk ):
+            unike : list of snapped input items, one per unique combination of stops
+            gruppe : numpy array, index into unike for every input
+            statistikk : dictionary with 'inndata', 'unike', 'spart' (calls saved),
+                'maks_flytt_m' and 'snitt_flytt_m' (how far the stops were moved)
+    """
+    deler = [ _koordinater( item ) for item in inputs ]
+    antall = [ len( koord ) if koord is not None else 0 for koord, _, _ in deler ]
+    alle = [ p for koord, _, _ in deler if koord is not None for p in koord ]
+    xy = np.asarray( alle, dtype=np.float64 ).reshape( -1, 2 )
+    snappet = snapper.snap( xy ) if len( xy ) else xy
+    flytt = np.hypot( *( snappet - xy ).T ) if len( xy ) else np.zeros( 0 )
+
+    oppslag = {}
+    unike = []
+    gruppe = np.empty( len( deler ), dtype=np.int64 )
+    start = 0
+    for ii, ( ( koord, kwargs, stopsform ), n ) in enumerate( zip( deler, antall ) ):
+        ekstra = json.dumps( kwargs, sort_keys=True, default=str )
+        if koord is None:
+            key = ( None, ekstra )
+            item = inputs[ii]
+        else:
+            punkter = snappet[start:start+n]
+            start += n
+            key = ( tuple( np.round( punkter, 3 ).ravel() ), ekstra, stopsform )
+            item = None
+        indeks = oppslag.get( key )
+        if indeks is None:
+            indeks = oppslag[key] = len( unike )
+            unike.append( item if item is not None else _snappet( punkter, kwargs, stopsform ) )
+        gruppe[ii] = indeks
+
+    statistikk = { 'inndata' : len( deler ), 'unike' : len( unike ), 'spart' : len( deler ) - len( unike ),
+                   'maks_flytt_m' : float( flytt.max() ) if len( flytt ) else 0.0,
+                   'snitt_flytt_m' : float( flytt.mean() ) if len( flytt ) else 0.0 }
+    return unike, gruppe, statistikk
+
+
+def snapbatch( inputs, snapper, statistikk=None, ordered=True, **kwargs ):
+    """Routes a batch of inputs with ruteplanbatch.rutebatch, one call per unique combination of snapped stops
+
+    Generator, yields one result dictionary per input item, like rutebatch:
+        { 'index' : position in input, 'input' : the original input item, 'snappet' : the item
+          actually routed, 'delt' : True if the result was reused from another input,
+          'data' : parsed data or None, 'error' : exception instance or None }
+
+    ARGUMENTS
+        inputs : iterable of input items, see ruteplanbatch.rutebatch. The whole batch is read
+        before routing starts, since duplicates can be anywhere in it
+
+        snapper : Rutenett, Vegnettsnapper or any object with a snap( xy ) method
+
+    KEYWORDS
+        statistikk = None, dictionary that is filled in with the numbers from grupper(), i.e.
+        how many calls were saved. Also counted as 'snapping.spart' in instrumentering
+
+        ordered = True, yield results in input order. If False, the results of each unique call
+        are yielded together as soon as the call completes
+
+        Any other keyword (klient, concurrency, ratelimiter, parse) is passed to rutebatch
+
+    RETURNS
+        generator of result dictionaries
+    """
+    inputs = list( inputs )
+    unike, gruppe, tall = grupper( inputs, snapper )
+    if statistikk is not None:
+        statistikk.update( tall )
+    instrumentering.tell( 'snapping.spart', tall['spart'] )
+
+    medlemmer = {}
+    for ii, g in enumerate( gruppe.tolist() ):
+        medlemmer.setdefault( g, [] ).append( ii )
+
+    def resultat( ii, res ):
+        return { 'index' : ii, 'input' : inputs[ii], 'snappet' : res['input'], 'delt' : ii != medlemmer[res['index']][0],
+                 'data' : res['data'], 'error' : res['error'] }
+
+    kall = ruteplanbatch.rutebatch( unike, ordered=ordered, **kwargs )
+    if not ordered:
+        for res in kall:
+            for ii in medlemmer[res['index']]:
+                yield resultat( ii, res )
+        return
+
+    # Unike kall kommer i rekkefølgen de først dukker opp i input, så alle tidligere input har
+    # allerede fått svar når et nytt kall er ferdig. Svar holdes bare til siste input som bruker dem
+    siste = { g : ii[-1] for g, ii in medlemmer.items() }
+    ferdige = {}
+    neste = 0
+    for res in kall:
+        ferdige[res['index']] = res
+        while neste < len( inputs ) and gruppe[neste] in ferdige:
+            g = int( gruppe[neste] )
+            yield resultat( neste, ferdige[g] )
+            if siste[g] == neste:
+                del ferdige[g]
+            neste += 1
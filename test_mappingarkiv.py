@@ -0,0 +1,105 @@
+"""Offline checks of mappingarkiv, with a local network store and a stub in place of NVDB api
+
+Run with pytest, or as a script: python test_mappingarkiv.py
+"""
+
+import os
+import sqlite3
+import tempfile
+
+import nvdbnettverk
+import nvdbsporring
+import mappingarkiv
+
+
+# Ett fartsgrenseobjekt går over alle VT-sekvensene, så det kommer fra flere chunks
+GJENNOMGAENDE = 999
+
+
+def _kjorebane( vid, super_vid, super_lengde=1.0 ):
+    """KB link sequence with two road links, superstedfestet to super_vid"""
+    veglenker = []
+    for ii, ( fra, til ) in enumerate( [ ( 0.0, 0.5 ), ( 0.5, 1.0 ) ] ):
+        veglenker.append( { 'veglenkenummer' : ii + 1, 'startposisjon' : fra, 'sluttposisjon' : til,
+                            'startdato' : '2020-01-01', 'type' : 'HOVED', 'detaljnivå' : 'Kjørebane',
+                            'geometri' : { 'wkt' : f"LINESTRING ({vid + 100*fra} 0, {vid + 100*til} 0)" },
+                            'superstedfesting' : { 'veglenkesekvensid' : super_vid, 'startposisjon' : fra * super_lengde,
+                                                   'sluttposisjon' : til * super_lengde, 'retning' : 'MED' } } )
+    return { 'veglenkesekvensid' : vid, 'veglenker' : veglenker }
+
+
+def _vegtrase( vid, sluttdato=None ):
+    """VT link sequence without superstedfesting, i.e. the routes refer to it directly"""
+    lenke = { 'veglenkenummer' : 1, 'startposisjon' : 0.0, 'sluttposisjon' : 1.0, 'startdato' : '2020-01-01',
+              'type' : 'HOVED', 'detaljnivå' : 'Vegtrasé', 'geometri' : { 'wkt' : f"LINESTRING ({vid} 0, {vid + 100} 0)" } }
+    if sluttdato:
+        lenke['sluttdato'] = sluttdato
+    return { 'veglenkesekvensid' : vid, 'veglenker' : [ lenke ] }
+
+
+class StubNVDB:
+    """Answers the 'veglenkesekvens' filter with speed limits per VT link sequence"""
+
+    def __init__( self ):
+        self.fartsgrense = { 1001 : 60, 1002 : 70, 3000 : 80 }
+
+    def __call__( self, objekttype, filter ):
+        records = []
+        for fra, til, vid in ( nvdbsporring._intervall( p ) for p in filter['veglenkesekvens'].split( ',' ) ):
+            for nvdbId, verdi in ( ( vid, self.fartsgrense[vid] ), ( GJENNOMGAENDE, 50 ) ):
+                records.append( { 'objekttype' : objekttype, 'nvdbId' : nvdbId, 'versjon' : 1, 'veglenkesekvensid' : vid,
+                                  'startposisjon' : fra, 'sluttposisjon' : til, 'Fartsgrense' : verdi,
+                                  'geometri' : f"LINESTRING ({vid + 100*fra} 0, {vid + 100*til} 0)" } )
+        return records
+
+
+def _rader( filnavn, lag='vegobjekt105' ):
+    conn = sqlite3.connect( filnavn )
+    try:
+        return sorted( conn.execute( f'SELECT nvdbId, versjon, veglenkesekvensid, startposisjon, sluttposisjon, Fartsgrense FROM "{lag}"' ) )
+    finally:
+        conn.close()
+
+
+def test_inkrementell_oppdatering_gir_samme_kartlag_som_full_gjenoppbygging():
+    with tempfile.TemporaryDirectory() as mappe:
+        lager = nvdbnettverk.VeglenkesekvensLager( ':memory:' )
+        for data in ( _kjorebane( 1, 1001 ), _kjorebane( 2, 1002 ), _vegtrase( 3000 ) ):
+            lager._lagre( data['veglenkesekvensid'], data )
+        arkiv = mappingarkiv.MappingArkiv( os.path.join( mappe, 'arkiv.sqlite' ), lager )
+        arkiv.legg_til( 'a', [ { 'nvdbReferenceId' : 1, 'fromLength' : 0, 'toLength' : 1 },
+                               { 'nvdbReferenceId' : 3000, 'fromLength' : 0, 'toLength' : 1 } ] )
+        arkiv.legg_til( 'b', [ { 'nvdbReferenceId' : 2, 'fromLength' : 0, 'toLength' : 1 } ] )
+        nvdb = StubNVDB()
+        # Kort url-lengde, så hver veglenkesekvens havner i en egen chunk
+        hent = { 'hentfunksjon' : nvdb, 'maks_lengde' : 20, 'concurrency' : 1 }
+
+        endring = arkiv.oppdater( hent=False, dato='2024-01-01' )
+        assert endring['vt_ids'] == { 1001, 1002, 3000 }
+        inkrementell = os.path.join( mappe, 'inkrementell.gpkg' )
+        mappingarkiv.oppdater_vegobjekter( arkiv, 105, inkrementell, vt_ids=endring['vt_ids'], **hent )
+        assert [ rad[2] for rad in _rader( inkrementell ) if rad[0] == GJENNOMGAENDE ] == [ 1001, 1002, 3000 ]
+
+        # Ny sluttdato på VT-sekvensen 3000 endrer ikke kartleggingen, men fartsgrensen der er ny.
+        # KB-sekvensen 2 er flyttet til en annen del av 1002
+        lager._lagre( 3000, _vegtrase( 3000, sluttdato='2030-01-01' ) )
+        lager._lagre( 2, _kjorebane( 2, 1002, super_lengde=0.5 ) )
+        nvdb.fartsgrense[3000] = 90
+
+        endring = arkiv.oppdater( hent=False, dato='2024-01-01' )
+        assert endring['endrede'] == { 2, 3000 }
+        assert endring['vt_ids'] == { 1002, 3000 }
+        mappingarkiv.oppdater_vegobjekter( arkiv, 105, inkrementell, vt_ids=endring['vt_ids'], **hent )
+
+        full = os.path.join( mappe, 'full.gpkg' )
+        mappingarkiv.oppdater_vegobjekter( arkiv, 105, full, **hent )
+        assert _rader( inkrementell ) == _rader( full )
+        assert ( GJENNOMGAENDE, 1, 3000, 0.0, 1.0, 50 ) in _rader( full )
+        assert ( 3000, 1, 3000, 0.0, 1.0, 90 ) in _rader( full )
+        arkiv.close()
+        lager.close()
+
+
+if __name__ == '__main__':
+    test_inkrementell_oppdatering_gir_samme_kartlag_som_full_gjenoppbygging()
+    print( 'OK' )
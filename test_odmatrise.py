@@ -0,0 +1,106 @@
+"""Offline checks of odmatrise, with a stub client in place of the ruteplan service
+
+Run with pytest, or as a script: python test_odmatrise.py
+"""
+
+import math
+import threading
+
+import numpy as np
+
+import odmatrise
+
+
+class _Svar:
+    """Stand-in for a requests response from the one-to-many endpoint"""
+
+    def __init__( self, data, url ):
+        self.data = data
+        self.url = url
+        self.ok = True
+        self.status_code = 200
+        self.reason = 'OK'
+
+    def json( self ):
+        return self.data
+
+
+class StubKlient:
+    """Answers one-to-many calls with the straight line distance, and counts calls and routed pairs"""
+
+    def __init__( self ):
+        self.url = 'http://stub/Route/best'
+        self.credentials = {}
+        self.ratelimiter = None
+        self.teller = { 'kall' : 0, 'par' : 0 }   # Delt med kopiene odmatrise lager
+        self._lock = threading.Lock()
+
+    def route( self, ruteplanparams={}, **kwargs ):
+        punkter = [ tuple( float( v ) for v in stopp.split( ',' ) ) for stopp in ruteplanparams['stops'].split( ';' ) ]
+        fra, til = punkter[0], punkter[1:]
+        with self._lock:
+            self.teller['kall'] += 1
+            self.teller['par'] += len( til )
+        routes = [ { 'statistic' : { 'totalLength' : math.dist( fra, p ), 'totalDriveTime' : math.dist( fra, p ) / 10,
+                                     'tollSmall' : 0, 'tollLarge' : 0 } } for p in til ]
+        return _Svar( { 'routes' : routes }, self.url )
+
+    @property
+    def kall( self ):
+        return self.teller['kall']
+
+    @property
+    def par( self ):
+        return self.teller['par']
+
+
+def _punkter( n, seed ):
+    rng = np.random.default_rng( seed )
+    return [ ( float( x ), float( y ) ) for x, y in rng.integers( 0, 10000, size=( n, 2 ) ) ]
+
+
+def _fasit( origins, destinations ):
+    return np.asarray( [ [ math.dist( a, b ) for b in destinations ] for a in origins ] )
+
+
+def test_symmetrisk_ulike_punkt_ruter_bare_start_til_maal():
+    depoter, kunder = _punkter( 10, 1 ), _punkter( 200, 2 )
+    vanlig, symmetrisk = StubKlient(), StubKlient()
+    a = odmatrise.odmatrise( depoter, kunder, klient=vanlig )
+    b = odmatrise.odmatrise( depoter, kunder, klient=symmetrisk, symmetric=True )
+    assert vanlig.kall == symmetrisk.kall == b['calls'] == 10
+    assert symmetrisk.par == 2000
+    np.testing.assert_allclose( b['totalLength'], a['totalLength'], rtol=1e-6 )
+
+
+def test_symmetrisk_delvis_overlapp_hopper_over_speilede_par():
+    felles = _punkter( 5, 3 )
+    origins = felles + _punkter( 3, 4 )
+    destinations = _punkter( 4, 5 ) + felles[::-1]
+    klient = StubKlient()
+    mat = odmatrise.odmatrise( origins, destinations, klient=klient, symmetric=True )
+    # 8 x 9 par, minus de 5 parene av samme punkt og de 10 speilede parene mellom felles punkt
+    assert klient.par == 8 * 9 - 5 - 5 * 4 // 2
+    np.testing.assert_allclose( mat['totalLength'], _fasit( origins, destinations ), rtol=1e-6 )
+
+
+def test_symmetrisk_samme_punkt_ruter_ovre_trekant():
+    punkter = _punkter( 20, 6 )
+    klient = StubKlient()
+    mat = odmatrise.odmatrise( punkter, None, klient=klient, symmetric=True )
+    assert klient.par == 20 * 19 // 2
+    assert klient.kall == 19
+    np.testing.assert_allclose( mat['totalLength'], _fasit( punkter, punkter ), rtol=1e-6 )
+
+    # Samme punktmengde i annen rekkefølge gir også bare øvre trekant
+    klient = StubKlient()
+    mat = odmatrise.odmatrise( punkter, punkter[::-1], klient=klient, symmetric=True )
+    assert klient.par == 20 * 19 // 2
+    np.testing.assert_allclose( mat['totalLength'], _fasit( punkter, punkter[::-1] ), rtol=1e-6 )
+
+
+if __name__ == '__main__':
+    test_symmetrisk_ulike_punkt_ruter_bare_start_til_maal()
+    test_symmetrisk_delvis_overlapp_hopper_over_speilede_par()
+    test_symmetrisk_samme_punkt_ruter_ovre_trekant()
+    print( 'OK' )
@@ -1,8 +1,51 @@
+import io
+import json
+import os
+
 import ruteplan 
 
 from shapely import wkt 
 
 
+RESPONSFIL = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'ruteplanrespons.json' )
+
+
+class _Svar: 
+    """Stand-in for a requests response, with a saved ruteplan payload"""
+
+    def __init__( self, content ): 
+        self.content = content
+        self.ok = True
+        self.status_code = 200
+        self.reason = 'OK'
+        self.url = 'http://stub/Route/best'
+
+    def json( self ): 
+        return json.loads( self.content )
+
+
+def test_iterruteplan_gir_samme_egenskaper_som_parseruteplan(): 
+    with open( RESPONSFIL, encoding='utf-8' ) as f: 
+        data = json.load( f )
+    # Nøkler som finnes både på featuren og i metadata: Metadata vinner, som i parseruteplan
+    data['routes'][0]['features'][0]['properties']['routeName'] = 'fra featuren'
+    egenskaper = { 'id' : 'Storgata-Munkedamsveien', 'time' : -1 }
+    innhold = json.dumps( data ).encode( 'utf-8' )
+
+    fasit = ruteplan.parseruteplan( _Svar( innhold ), egenskaper=egenskaper )
+    for features in ( ruteplan.iterruteplan( _Svar( innhold ), egenskaper=egenskaper ), 
+                      ruteplan.iterruteplanfil( io.BytesIO( innhold ), egenskaper=egenskaper ) ): 
+        features = list( features )
+        assert len( features ) == len( fasit )
+        for feature, gammel in zip( features, fasit ): 
+            # Samme verdier i samme rekkefølge, så kolonnene i tabeller blir de samme
+            assert list( dict( feature['properties'] ).items() ) == list( gammel['properties'].items() )
+            assert feature['geometry'] == gammel['geometry']
+    assert fasit[0]['properties']['routeName'] == data['routes'][0]['routeName']
+    assert fasit[0]['properties']['time'] == -1
+
+
+
 if __name__ == '__main__': 
 
     p1 =  wkt.loads( 'POINT(262819.18 6649657.89 )' ) # Storgata 51, Oslo 